@@ -0,0 +1,399 @@
+"""
+Anteprime dei file sul NAS: miniature delle immagini, forme d'onda (picchi
+JSON e PNG) e proxy audio a basso bitrate per wav, flac, mp3, ...
+
+Le anteprime vengono generate in background da un pool di worker e salvate
+in una cache locale con chiave utente + percorso + mtime + dimensione del
+file: un file modificato ottiene una chiave nuova, quindi un'anteprima in
+cache non cambia mai e puo essere servita con cache immutabile.
+
+- miniature: Pillow, con decodifica JPEG a risoluzione ridotta
+- forme d'onda wav: modulo wave, leggendo solo una finestra di campioni per
+  ogni picco (richieste readv pipelined, non l'intero file)
+- forme d'onda di altri formati e proxy audio: ffmpeg alimentato in streaming
+  dal NAS, se installato
+"""
+import array
+import concurrent.futures
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import wave
+from config import Config
+import metriche
+import nas_storage
+
+try:
+    from PIL import Image, ImageDraw, ImageOps, UnidentifiedImageError
+except ImportError:  # Pillow non installato: niente miniature ne forme d'onda PNG
+    Image = None
+    ImageDraw = None
+    ImageOps = None
+    UnidentifiedImageError = None
+
+logger = logging.getLogger(__name__)
+
+ESTENSIONI_IMMAGINE = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+ESTENSIONI_AUDIO = {'wav', 'flac', 'mp3', 'aif', 'aiff', 'ogg', 'm4a'}
+
+# Tipi di anteprima e mime type del file generato
+TIPI = {
+    'miniatura': 'image/webp',
+    'picchi': 'application/json',
+    'forma-onda': 'image/png',
+    'proxy': 'audio/mpeg',
+}
+
+# Immagini piu grandi non vengono scaricate per generare la miniatura
+DIMENSIONE_MAX_IMMAGINE = 100 * 1024 * 1024
+# Campioni letti per ogni picco della forma d'onda di un wav
+FRAME_PER_PICCO = 1024
+# Frequenza a cui ffmpeg ricampiona l'audio per calcolare i picchi
+FREQUENZA_PICCHI = 4000
+ALTEZZA_FORMA_ONDA = 120
+COLORE_FORMA_ONDA = (79, 70, 229, 255)
+
+# Secondi prima di ritentare una generazione fallita per un errore temporaneo (NAS, rete)
+RIPROVA_SECONDI = 300
+
+
+class ErroreFormato(Exception):
+    """Il file non puo essere decodificato: l'anteprima non viene ritentata finche non cambia."""
+
+
+# Errori che dipendono dal contenuto del file e non si risolvono ritentando
+_ERRORI_FORMATO = (ErroreFormato, wave.Error, ValueError)
+if Image is not None:
+    _ERRORI_FORMATO += (UnidentifiedImageError, Image.DecompressionBombError)
+
+_executor = None
+_lock = threading.RLock()
+_in_corso = {}
+_ffmpeg = None
+_ultima_pulizia = 0
+
+
+def _get_executor():
+    """Restituisce il pool di worker per la generazione delle anteprime."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=Config.ANTEPRIME_WORKERS,
+                    thread_name_prefix='anteprime'
+                )
+    return _executor
+
+
+def ffmpeg_disponibile():
+    global _ffmpeg
+    if _ffmpeg is None:
+        _ffmpeg = shutil.which(Config.FFMPEG) or ''
+    return bool(_ffmpeg)
+
+
+def _webp_disponibile():
+    return Image is not None and '.webp' in Image.registered_extensions()
+
+
+def tipi_disponibili(estensione):
+    """Tipi di anteprima che e possibile generare per un file con questa estensione."""
+    estensione = (estensione or '').lower()
+    tipi = []
+    if estensione in ESTENSIONI_IMMAGINE and _webp_disponibile():
+        tipi.append('miniatura')
+    elif estensione in ESTENSIONI_AUDIO:
+        if estensione == 'wav' or ffmpeg_disponibile():
+            tipi.append('picchi')
+            if Image is not None:
+                tipi.append('forma-onda')
+        if ffmpeg_disponibile():
+            tipi.append('proxy')
+    return tipi
+
+
+def versione(dimensione, mtime):
+    """Identificativo della versione di un file, da usare nell'URL dell'anteprima."""
+    return f"{int(mtime)}-{int(dimensione)}"
+
+
+def _chiave(username, percorso, dimensione, mtime):
+    dati = f"{username}\0{percorso}\0{versione(dimensione, mtime)}"
+    return hashlib.sha1(dati.encode('utf-8')).hexdigest()
+
+
+def _percorso_cache(chiave, tipo):
+    return os.path.join(Config.ANTEPRIME_FOLDER, chiave[:2], f"{chiave}-{tipo}")
+
+
+def richiedi(username, percorso, dimensione, mtime, tipo):
+    """Restituisce un'anteprima dalla cache, accodandone la generazione se manca.
+
+    Attende la generazione al massimo ANTEPRIME_ATTESA secondi.
+
+    Returns:
+        tupla (stato, percorso del file): stato e 'pronta', 'in_corso' oppure
+        'non_disponibile' (generazione fallita o non possibile per questo file)
+    """
+    chiave = _chiave(username, percorso, dimensione, mtime)
+    destinazione = _percorso_cache(chiave, tipo)
+    if os.path.exists(destinazione):
+        # Aggiorna la data di ultimo uso: la pulizia elimina solo le anteprime inutilizzate
+        os.utime(destinazione)
+        metriche.CACHE_RICHIESTE.inc(1, 'anteprime', 'hit')
+        return 'pronta', destinazione
+    if os.path.exists(destinazione + '.errore'):
+        return 'non_disponibile', None
+    try:
+        if time.time() - os.path.getmtime(destinazione + '.riprova') < RIPROVA_SECONDI:
+            return 'non_disponibile', None
+    except OSError:
+        pass
+    metriche.CACHE_RICHIESTE.inc(1, 'anteprime', 'miss')
+
+    future = _accoda(chiave, tipo, username, percorso, dimensione)
+    try:
+        future.result(timeout=Config.ANTEPRIME_ATTESA)
+    except concurrent.futures.TimeoutError:
+        return 'in_corso', None
+    if os.path.exists(destinazione):
+        return 'pronta', destinazione
+    return 'non_disponibile', None
+
+
+def _accoda(chiave, tipo, username, percorso, dimensione):
+    """Accoda una generazione, riusando quella gia in corso per la stessa anteprima."""
+    with _lock:
+        future = _in_corso.get((chiave, tipo))
+        if future is None:
+            future = _get_executor().submit(_genera, chiave, tipo, username, percorso, dimensione)
+            _in_corso[(chiave, tipo)] = future
+            future.add_done_callback(lambda f: _fine_generazione(chiave, tipo))
+        return future
+
+
+def _fine_generazione(chiave, tipo):
+    with _lock:
+        _in_corso.pop((chiave, tipo), None)
+
+
+def _genera(chiave, tipo, username, percorso, dimensione):
+    """Genera un'anteprima nella cache (eseguito dai worker)."""
+    destinazione = _percorso_cache(chiave, tipo)
+    if os.path.exists(destinazione) or os.path.exists(destinazione + '.errore'):
+        return
+    os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+    # Scrittura su file temporaneo + rename atomico, come per le varianti immagini
+    tmp = f"{destinazione}.{uuid.uuid4().hex}.tmp"
+    try:
+        if tipo == 'forma-onda':
+            picchi = _percorso_cache(chiave, 'picchi')
+            # Ritorna subito se i picchi sono gia segnati come non generabili (.errore)
+            _genera(chiave, 'picchi', username, percorso, dimensione)
+            if os.path.exists(picchi + '.errore'):
+                # File non decodificabile: anche la forma d'onda non va ritentata
+                raise ErroreFormato("picchi non generabili")
+            with open(picchi) as f:
+                _disegna_forma_onda(json.load(f)['picchi'], tmp)
+        else:
+            remote_path = f"{nas_storage._user_base_path(username)}/{percorso}"
+            estensione = percorso.rsplit('.', 1)[-1].lower()
+            ssh, sftp = nas_storage._get_sftp()
+            try:
+                with sftp.open(remote_path, 'rb') as sorgente:
+                    if tipo == 'miniatura':
+                        _genera_miniatura(sorgente, dimensione, tmp)
+                    elif tipo == 'picchi':
+                        picchi = None
+                        if estensione == 'wav':
+                            try:
+                                picchi = _picchi_wav(sorgente)
+                            except wave.Error:
+                                # wav non PCM (es. float): serve ffmpeg
+                                if not ffmpeg_disponibile():
+                                    raise
+                        if picchi is None:
+                            picchi = _picchi_ffmpeg(sorgente, dimensione)
+                        with open(tmp, 'w') as f:
+                            json.dump({'picchi': picchi}, f, separators=(',', ':'))
+                    elif tipo == 'proxy':
+                        _esegui_ffmpeg(sorgente, dimensione, [
+                            '-ac', '2', '-b:a', Config.ANTEPRIME_PROXY_BITRATE, '-f', 'mp3', '-y', tmp
+                        ])
+            finally:
+                sftp.close()
+                ssh.close()
+        os.replace(tmp, destinazione)
+        if os.path.exists(destinazione + '.riprova'):
+            os.remove(destinazione + '.riprova')
+    except Exception as e:
+        logger.warning(f"Impossibile generare l'anteprima {tipo} di {username}/{percorso}: {type(e).__name__}: {e}")
+        if isinstance(e, _ERRORI_FORMATO):
+            # Segnaposto: la generazione non viene ritentata finche il file non cambia
+            open(destinazione + '.errore', 'w').close()
+        else:
+            # Errore temporaneo (connessione o lettura SFTP, ...): si ritenta dopo RIPROVA_SECONDI
+            open(destinazione + '.riprova', 'w').close()
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _pulisci_cache()
+
+
+def _genera_miniatura(sorgente, dimensione, tmp):
+    if dimensione > DIMENSIONE_MAX_IMMAGINE:
+        raise ValueError(f"immagine troppo grande ({nas_storage.format_size(dimensione)})")
+    buffer = io.BytesIO()
+    for blocco in nas_storage._leggi_a_finestre(sorgente, dimensione):
+        buffer.write(blocco)
+    buffer.seek(0)
+    lato = Config.ANTEPRIME_MINIATURA
+    with Image.open(buffer) as img:
+        # Per i JPEG decodifica direttamente a una scala ridotta
+        img.draft('RGB', (lato, lato))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        img.thumbnail((lato, lato), Image.LANCZOS)
+        img.save(tmp, format='WEBP', quality=Config.IMMAGINI_QUALITA)
+
+
+def _campioni_16bit(data, larghezza):
+    """Converte frame PCM little-endian in un array di campioni a 16 bit."""
+    if larghezza == 1:
+        # PCM a 8 bit e senza segno
+        campioni = array.array('h', ((b - 128) << 8 for b in data))
+    elif larghezza == 2:
+        campioni = array.array('h', data)
+    else:
+        # 24/32 bit: bastano i due bytes piu significativi di ogni campione
+        buffer = bytearray(len(data) // larghezza * 2)
+        buffer[0::2] = data[larghezza - 2::larghezza]
+        buffer[1::2] = data[larghezza - 1::larghezza]
+        campioni = array.array('h', buffer)
+    if larghezza > 1 and sys.byteorder == 'big':
+        campioni.byteswap()
+    return campioni
+
+
+def _picchi_wav(sorgente):
+    """Picchi di un wav PCM leggendo una finestra di campioni per ogni picco."""
+    with wave.open(sorgente) as wav:
+        # wave si ferma all'inizio del blocco dati: la posizione corrente e l'offset dei campioni
+        inizio = sorgente.tell()
+        n_frame = wav.getnframes()
+        larghezza = wav.getsampwidth()
+        dimensione_frame = larghezza * wav.getnchannels()
+    n_picchi = min(Config.ANTEPRIME_PICCHI, n_frame)
+    if not n_picchi:
+        return []
+    finestre = []
+    for i in range(n_picchi):
+        frame = i * n_frame // n_picchi
+        lunghezza = min(FRAME_PER_PICCO, (i + 1) * n_frame // n_picchi - frame)
+        finestre.append((inizio + frame * dimensione_frame, max(lunghezza, 1) * dimensione_frame))
+    picchi = []
+    for data in sorgente.readv(finestre):
+        campioni = _campioni_16bit(data, larghezza)
+        picchi.append(_picco(campioni))
+    return picchi
+
+
+def _picco(campioni):
+    if not campioni:
+        return [0, 0]
+    return [round(min(campioni) / 32768, 3), round(max(campioni) / 32768, 3)]
+
+
+def _esegui_ffmpeg(sorgente, dimensione, argomenti):
+    """Esegue ffmpeg alimentandone lo stdin in streaming dal file remoto.
+
+    Returns:
+        output di ffmpeg su stdout
+    """
+    processo = subprocess.Popen(
+        [Config.FFMPEG, '-v', 'error', '-i', 'pipe:0', '-vn'] + argomenti,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    errori = []
+
+    def _alimenta():
+        try:
+            for blocco in nas_storage._leggi_a_finestre(sorgente, dimensione):
+                processo.stdin.write(blocco)
+        except BrokenPipeError:
+            pass  # ffmpeg ha smesso di leggere: l'esito lo da il codice di uscita
+        except Exception as e:
+            errori.append(e)
+            processo.kill()
+        finally:
+            try:
+                processo.stdin.close()
+            except OSError:
+                pass
+
+    alimentatore = threading.Thread(target=_alimenta, name='anteprime-ffmpeg', daemon=True)
+    alimentatore.start()
+    output = processo.stdout.read()
+    processo.wait()
+    alimentatore.join()
+    if errori:
+        raise errori[0]
+    if processo.returncode != 0:
+        raise ErroreFormato(f"ffmpeg terminato con codice {processo.returncode}")
+    return output
+
+
+def _picchi_ffmpeg(sorgente, dimensione):
+    """Picchi di un file audio qualsiasi, decodificato da ffmpeg in mono a bassa frequenza."""
+    pcm = _esegui_ffmpeg(sorgente, dimensione, [
+        '-ac', '1', '-ar', str(FREQUENZA_PICCHI), '-f', 's16le', 'pipe:1'
+    ])
+    campioni = _campioni_16bit(pcm[:len(pcm) - len(pcm) % 2], 2)
+    n_picchi = min(Config.ANTEPRIME_PICCHI, len(campioni))
+    return [
+        _picco(campioni[i * len(campioni) // n_picchi:(i + 1) * len(campioni) // n_picchi])
+        for i in range(n_picchi)
+    ]
+
+
+def _disegna_forma_onda(picchi, tmp):
+    larghezza = max(len(picchi), 1)
+    centro = ALTEZZA_FORMA_ONDA / 2
+    img = Image.new('RGBA', (larghezza, ALTEZZA_FORMA_ONDA), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for x, (minimo, massimo) in enumerate(picchi):
+        draw.line([(x, centro - massimo * centro), (x, centro - minimo * centro)], fill=COLORE_FORMA_ONDA)
+    img.save(tmp, format='PNG', optimize=True)
+
+
+def _pulisci_cache():
+    """Elimina le anteprime non usate da ANTEPRIME_CACHE_GIORNI (al massimo una volta l'ora)."""
+    global _ultima_pulizia
+    adesso = time.time()
+    with _lock:
+        if adesso - _ultima_pulizia < 3600:
+            return
+        _ultima_pulizia = adesso
+    limite = adesso - Config.ANTEPRIME_CACHE_GIORNI * 86400
+    eliminati = 0
+    for root, dirs, files in os.walk(Config.ANTEPRIME_FOLDER):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < limite:
+                    os.remove(path)
+                    eliminati += 1
+            except OSError:
+                pass
+    if eliminati:
+        logger.info(f"Cache anteprime: {eliminati} file eliminati")
@@ -1,15 +1,32 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, send_file, jsonify, session
+from flask import Flask, render_template, redirect, url_for, flash, request, send_file, send_from_directory, jsonify, session, abort, g, Response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 import nas_storage
+import nas_indice
+import nas_quote
+import nas_checksum
+import anteprime
+import cestino
+import nas_operazioni
+import immagini
+import upload_storage
+import static_assets
+import compressione
+import strumentazione
+import query_lente
+import metriche
+import profiler
+import migrazioni
+import importazione
+import esportazione
 from config import Config
-from database import init_database, get_db_connection
-from models import Utente, Menu, Permesso, CategoriaServizio, Servizio, News, Artista, MembroBand, Disco, Brano, Evento
-import re
-import unicodedata
+from database import get_db_connection
+from models import Utente, Menu, Permesso, CategoriaServizio, Servizio, News, Artista, MembroBand, Disco, Brano, Evento, genera_slug
 from datetime import datetime
 from functools import wraps
+from urllib.parse import quote
 import os
+import hmac
 import uuid
 import logging
 
@@ -25,6 +42,23 @@ app.config['MAX_CONTENT_LENGTH'] = None
 # Assicura che la cartella uploads esista
 os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
 
+# Fingerprint degli asset statici e Cache-Control immutable
+static_assets.init_app(app)
+
+# Profiler a campionamento delle richieste scelte (endpoint configurati o richiesta di un admin)
+profiler.init_app(app)
+
+# Durata delle richieste per le metriche Prometheus. Registrata prima della compressione
+# perche il suo hook after_request venga eseguito per ultimo e misuri l'intera risposta
+metriche.init_app(app)
+
+# Compressione gzip/brotli delle risposte e asset statici precompressi
+compressione.init_app(app)
+
+# Query SQL per richiesta: Server-Timing, segnalazione N+1 e pannello admin.
+# Registrata dopo la compressione perche i suoi hook after_request vengano eseguiti prima
+strumentazione.init_app(app)
+
 
 def allowed_file(filename):
     """Verifica se il file ha un'estensione permessa."""
@@ -33,36 +67,55 @@ def allowed_file(filename):
 
 
 def save_uploaded_file(file):
-    """Salva un file uploadato e restituisce il nome del file salvato."""
+    """Salva un file uploadato e restituisce il nome del file salvato.
+    Il nome deriva dall'hash del contenuto: file identici vengono salvati una volta sola."""
     if file and file.filename and allowed_file(file.filename):
-        # Genera un nome univoco per evitare conflitti
         ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4().hex}.{ext}"
-        filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        filename = upload_storage.salva(file.stream, ext)
+        # Le varianti ridimensionate vengono generate in background
+        immagini.genera_varianti_async(filename)
         return filename
     return None
 
 
 def delete_uploaded_file(filename):
-    """Elimina un file uploadato."""
+    """Rilascia un file uploadato.
+    L'eliminazione avviene a fine richiesta (dopo il salvataggio del record) e solo
+    se nessun altro record referenzia ancora lo stesso file."""
     if filename:
-        filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        g.setdefault('upload_da_rilasciare', set()).add(filename)
 
 
-def genera_slug(titolo):
-    """Genera uno slug URL-friendly dal titolo."""
-    # Normalizza unicode e converti in ASCII
-    slug = unicodedata.normalize('NFKD', titolo).encode('ascii', 'ignore').decode('ascii')
-    # Converti in minuscolo
-    slug = slug.lower()
-    # Sostituisci spazi e caratteri non alfanumerici con trattini
-    slug = re.sub(r'[^a-z0-9]+', '-', slug)
-    # Rimuovi trattini iniziali e finali
-    slug = slug.strip('-')
-    return slug
+@app.teardown_request
+def _rilascia_uploads(exc):
+    for filename in g.pop('upload_da_rilasciare', ()):
+        try:
+            upload_storage.rilascia(filename)
+        except Exception as e:
+            logging.error(f"Errore durante il rilascio dell'upload {filename}: {e}")
+
+
+@app.template_global()
+def immagine_url(filename, variante='card', formato=None):
+    """URL di una variante ridimensionata di un'immagine caricata.
+    Se la pipeline immagini non e disponibile restituisce l'originale."""
+    if not immagini.pipeline_attiva():
+        return url_for('static', filename='uploads/' + filename)
+    formato = formato or immagini.formati_disponibili()[0]
+    return url_for('immagine_variante', variante=variante, formato=formato, filename=filename)
+
+
+@app.template_global()
+def immagine_srcset(filename, formato=None):
+    """Valore per l'attributo srcset con tutte le varianti (es. '.../thumb 320w, ...')."""
+    if not immagini.pipeline_attiva():
+        return ''
+    formato = formato or immagini.formati_disponibili()[0]
+    varianti = sorted(Config.IMMAGINI_VARIANTI.items(), key=lambda v: v[1])
+    return ', '.join(
+        f"{url_for('immagine_variante', variante=nome, formato=formato, filename=filename)} {larghezza}w"
+        for nome, larghezza in varianti
+    )
 
 
 login_manager = LoginManager()
@@ -144,30 +197,40 @@ def _get_deleted_files(username):
     return result
 
 
-def _purge_expired_files():
-    """Elimina fisicamente dal NAS i file nel cestino da piu di 30 giorni."""
+def _esclusi_cartella(username, subpath):
+    """Nomi dei figli diretti di una cartella nel cestino e nascosti, letti con una sola query.
+
+    Returns:
+        tupla (nomi nel cestino, nomi nascosti)
+    """
+    prefisso = f"{subpath}/" if subpath else ''
+    like = nas_indice._escape_like(prefisso) + '%'
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        'SELECT id, username, percorso FROM file_cestino WHERE data_eliminazione < NOW() - INTERVAL 30 DAY'
-    )
-    expired = cursor.fetchall()
-    for item in expired:
-        # Separa subpath e filename dal percorso
-        percorso = item['percorso']
-        if '/' in percorso:
-            parts = percorso.rsplit('/', 1)
-            subpath, filename = parts[0], parts[1]
-        else:
-            subpath, filename = '', percorso
-        try:
-            nas_storage.delete_file(item['username'], subpath, filename)
-        except Exception:
-            pass
-        cursor.execute('DELETE FROM file_cestino WHERE id = %s', (item['id'],))
-    conn.commit()
+    cursor.execute('''
+        SELECT 'cestino' AS origine, percorso FROM file_cestino WHERE username = %s AND percorso LIKE %s
+        UNION ALL
+        SELECT 'nascosto' AS origine, percorso FROM file_nascosti WHERE username = %s AND percorso LIKE %s
+    ''', (username, like, username, like))
+    cestino, nascosti = set(), set()
+    for row in cursor.fetchall():
+        # LIKE non distingue maiuscole e minuscole: il prefisso va ricontrollato
+        nome = row['percorso'][len(prefisso):]
+        if row['percorso'].startswith(prefisso) and '/' not in nome:
+            (cestino if row['origine'] == 'cestino' else nascosti).add(nome)
     cursor.close()
     conn.close()
+    return cestino, nascosti
+
+
+def _accoda_operazione_nas(tipo, username, parametri, messaggio):
+    """Accoda un'operazione NAS per i worker in background e avvisa l'utente."""
+    try:
+        nas_operazioni.accoda(tipo, username, parametri, current_user.id)
+        flash(messaggio, 'info')
+    except Exception as e:
+        logging.error(f"Errore accodamento operazione NAS {tipo} per {username}: {type(e).__name__}: {e}")
+        flash('Errore durante l\'avvio dell\'operazione.', 'danger')
 
 
 # Mapping per route che non corrispondono direttamente a un URL di menu
@@ -395,39 +458,33 @@ def file_manager():
             else:
                 selected_user_id = None
 
+    ordine, decrescente = _ordine_file_manager()
     try:
-        files = nas_storage.list_files(target_username, subpath)
-        logging.info(f"list_files OK per {target_username}, {len(files)} file trovati")
+        files, totale = _pagina_file_manager(target_username, subpath, shared, selected_user_id,
+                                             ordine, decrescente)
+        logging.info(f"list_files OK per {target_username}, {totale} file trovati")
     except Exception as e:
         logging.error(f"ERRORE list_files per {target_username}: {type(e).__name__}: {e}", exc_info=True)
         flash(f'Errore di connessione al NAS: {str(e)}', 'danger')
-        files = []
-
-    # Purge file scaduti dal cestino (oltre 30 giorni)
+        files, totale = [], 0
+
+    # Avvia (se non gia attivi) il crawler dell'indice NAS e i worker della coda operazioni,
+    # che eliminano anche i file scaduti dal cestino
+    nas_indice.avvia_crawler()
+    nas_operazioni.avvia_worker()
+    utilizzo = {}
+    cartelle = []
+    operazioni = []
     try:
-        _purge_expired_files()
-    except Exception:
-        pass
-
-    # Filtraggio file nel cestino (eliminati logicamente)
-    deleted = _get_deleted_files(target_username)
-    if deleted:
-        files = [f for f in files if _build_file_path(subpath, f['name']) not in deleted]
-
-    # Filtraggio file nascosti
-    if not current_user.is_admin and not shared:
-        # Artista: nascondi i file marcati come nascosti
-        hidden = _get_hidden_files(target_username)
-        if hidden:
-            files = [f for f in files if _build_file_path(subpath, f['name']) not in hidden]
-    elif current_user.is_admin and selected_user_id and not shared:
-        # Admin che naviga file di un artista: mostra tutto ma segna i nascosti
-        hidden = _get_hidden_files(target_username)
-        for f in files:
-            f['nascosto'] = _build_file_path(subpath, f['name']) in hidden
-    else:
-        for f in files:
-            f['nascosto'] = False
+        operazioni = nas_operazioni.elenco(current_user.id)
+    except Exception as e:
+        logging.error(f"Errore lettura coda operazioni NAS: {e}")
+    try:
+        cartelle = nas_indice.cartelle(target_username)
+        if all_users:
+            utilizzo = nas_quote.utilizzo_tutti()
+    except Exception as e:
+        logging.error(f"Errore lettura indice NAS: {e}")
 
     # Costruisci breadcrumb
     breadcrumb = []
@@ -442,7 +499,118 @@ def file_manager():
     return render_template('file_manager.html', files=files, subpath=subpath,
                            breadcrumb=breadcrumb, get_file_icon=nas_storage.get_file_icon,
                            all_users=all_users, selected_user_id=selected_user_id,
-                           shared=shared)
+                           shared=shared, utilizzo=utilizzo, format_size=nas_storage.format_size,
+                           cartelle=cartelle, totale=totale, ordine=ordine, decrescente=decrescente,
+                           operazioni=operazioni,
+                           prossimo=len(files) if len(files) < totale else None)
+
+
+def _ordine_file_manager():
+    """Ordinamento richiesto per l'elenco file (parametri ordine e dir)."""
+    ordine = request.args.get('ordine', 'nome')
+    if ordine not in nas_storage.ORDINAMENTI:
+        ordine = 'nome'
+    return ordine, request.args.get('dir') == 'desc'
+
+
+def _pagina_file_manager(username, subpath, shared, selected_user_id, ordine, decrescente, offset=0):
+    """Una pagina dell'elenco di una cartella, pronta per il template delle righe.
+
+    File nel cestino e (per l'artista) file nascosti sono esclusi prima della
+    paginazione, cosi ogni pagina ha sempre lo stesso numero di voci.
+
+    Returns:
+        tupla (voci della pagina, totale delle voci visibili)
+    """
+    subpath = nas_storage._safe_subpath(subpath)
+    esclusi, nascosti = _esclusi_cartella(username, subpath)
+    hidden = set()
+    if not current_user.is_admin and not shared:
+        # Artista: nascondi i file marcati come nascosti
+        esclusi |= nascosti
+    elif current_user.is_admin and selected_user_id and not shared:
+        # Admin che naviga file di un artista: mostra tutto ma segna i nascosti
+        hidden = nascosti
+
+    files, totale = nas_storage.list_files_pagina(username, subpath, ordine, decrescente, offset, esclusi=esclusi,
+                                                  firma=nas_operazioni.firma_modifiche(username))
+
+    # Dimensioni delle cartelle dall'indice NAS
+    if any(f['is_dir'] for f in files):
+        try:
+            dimensioni = nas_indice.dimensioni_cartelle(username, subpath)
+            for f in files:
+                if f['is_dir'] and f['name'] in dimensioni:
+                    f['size'] = dimensioni[f['name']]
+                    f['size_human'] = nas_storage.format_size(f['size'])
+        except Exception as e:
+            logging.error(f"Errore lettura indice NAS: {e}")
+
+    for f in files:
+        f['nascosto'] = f['name'] in hidden
+        # Anteprime disponibili per ogni file, con la versione da usare negli URL
+        if not f['is_dir']:
+            f['anteprime'] = anteprime.tipi_disponibili(f['extension'])
+            f['versione'] = anteprime.versione(f['size'], f['modified'].timestamp())
+    return files, totale
+
+
+@app.route('/file-manager/elenco')
+@login_required
+def file_manager_elenco():
+    """Pagina successiva dell'elenco di una cartella, per l'elenco a finestra del file manager (JSON)."""
+    subpath = nas_storage._safe_subpath(request.args.get('path', ''))
+    shared = request.args.get('shared') == '1' and current_user.is_admin
+    target_username = _get_file_manager_username()
+    selected_user_id = request.args.get('user_id') if current_user.is_admin and not shared else None
+    ordine, decrescente = _ordine_file_manager()
+    offset = request.args.get('offset', '0')
+    offset = int(offset) if offset.isdigit() else 0
+
+    try:
+        files, totale = _pagina_file_manager(target_username, subpath, shared, selected_user_id,
+                                             ordine, decrescente, offset)
+    except Exception as e:
+        logging.error(f"ERRORE list_files per {target_username}: {type(e).__name__}: {e}")
+        return jsonify(errore='Errore di connessione al NAS.'), 500
+
+    html = render_template('file_manager_righe.html', files=files, subpath=subpath,
+                           get_file_icon=nas_storage.get_file_icon,
+                           selected_user_id=selected_user_id, shared=shared)
+    fine = offset + len(files)
+    return jsonify(html=html, totale=totale, prossimo=fine if fine < totale else None)
+
+
+def _operazione_nas_o_404(operazione_id):
+    """Operazione della coda NAS visibile all'utente corrente (chi l'ha avviata o un admin)."""
+    operazione = nas_operazioni.get(operazione_id)
+    if operazione is None or (operazione['creato_da'] != current_user.id and not current_user.is_admin):
+        abort(404)
+    return operazione
+
+
+@app.route('/file-manager/operazioni')
+@login_required
+def file_manager_operazioni():
+    """Operazioni NAS attive e recenti dell'utente, con avanzamento (JSON)."""
+    return jsonify(operazioni=nas_operazioni.elenco(current_user.id))
+
+
+@app.route('/file-manager/operazioni/<int:operazione_id>')
+@login_required
+def file_manager_operazione(operazione_id):
+    """Stato e avanzamento di un'operazione NAS (JSON)."""
+    return jsonify(_operazione_nas_o_404(operazione_id))
+
+
+@app.route('/file-manager/operazioni/<int:operazione_id>/annulla', methods=['POST'])
+@login_required
+def file_manager_operazione_annulla(operazione_id):
+    """Annulla un'operazione NAS in coda o interrompe una interrompibile in corso (JSON)."""
+    _operazione_nas_o_404(operazione_id)
+    if not nas_operazioni.annulla(operazione_id):
+        return jsonify(errore='L\'operazione non puo piu essere annullata.'), 409
+    return jsonify(nas_operazioni.get(operazione_id))
 
 
 def _file_manager_redirect(subpath, user_id=None, shared=False):
@@ -458,6 +626,15 @@ def _file_manager_redirect(subpath, user_id=None, shared=False):
 @app.route('/file-manager/upload', methods=['POST'])
 @login_required
 def file_manager_upload():
+    # Controllo preventivo sulla dimensione dichiarata, prima di leggere il corpo
+    # della richiesta (vale per l'artista che carica nella propria cartella)
+    if not current_user.is_admin:
+        disponibile = nas_quote.spazio_disponibile(current_user.quota_nas, current_user.username)
+        if disponibile is not None and (request.content_length or 0) > disponibile:
+            flash(f'Spazio insufficiente: restano {nas_storage.format_size(disponibile)} '
+                  f'della quota di {nas_storage.format_size(current_user.quota_nas)}.', 'danger')
+            return _file_manager_redirect(request.args.get('path', ''))
+
     subpath = request.form.get('subpath', '')
     target_username = _get_file_manager_username()
     user_id = request.form.get('target_user_id', '')
@@ -467,27 +644,28 @@ def file_manager_upload():
         flash('Nessun file selezionato.', 'warning')
         return _file_manager_redirect(subpath, user_id, shared)
 
-    files = request.files.getlist('files')
-    uploaded = 0
-    errors = 0
-
-    for file in files:
-        if file and file.filename:
+    # I file vengono salvati in locale e caricati sul NAS da un worker della coda
+    # (la quota viene verificata durante il caricamento)
+    ricevuti = []
+    try:
+        for file in request.files.getlist('files'):
+            if file and file.filename:
+                ricevuti.append(nas_operazioni.salva_upload(file))
+        if ricevuti:
+            nas_operazioni.accoda('upload', target_username,
+                                  {'subpath': nas_storage._safe_subpath(subpath), 'file': ricevuti},
+                                  current_user.id, totale=sum(f['dimensione'] for f in ricevuti))
+            flash(f'{len(ricevuti)} file ricevuto/i: caricamento sul NAS in corso.', 'info')
+        else:
+            flash('Nessun file selezionato.', 'warning')
+    except Exception as e:
+        logging.error(f"Errore upload per {target_username}: {type(e).__name__}: {e}")
+        for file in ricevuti:
             try:
-                success = nas_storage.upload_file(
-                    target_username, subpath, file.stream, file.filename
-                )
-                if success:
-                    uploaded += 1
-                else:
-                    errors += 1
-            except Exception:
-                errors += 1
-
-    if uploaded > 0:
-        flash(f'{uploaded} file caricato/i con successo.', 'success')
-    if errors > 0:
-        flash(f'{errors} file non caricato/i per errori.', 'danger')
+                os.remove(file['locale'])
+            except OSError:
+                pass
+        flash('Errore durante il caricamento dei file.', 'danger')
 
     return _file_manager_redirect(subpath, user_id, shared)
 
@@ -512,13 +690,166 @@ def file_manager_download():
     if not filename:
         return 'File non specificato.', 400
 
-    buffer = nas_storage.download_file(target_username, subpath, filename)
+    percorso = nas_storage._build_path(nas_storage._safe_subpath(subpath), nas_storage._safe_name(filename))
+    try:
+        buffer = nas_storage.download_file(target_username, subpath, filename,
+                                           checksum=nas_checksum.verificatore(target_username, percorso))
+    except nas_storage.IntegritaNonVerificata:
+        return 'Il file sul NAS non corrisponde al checksum registrato al caricamento.', 500
     if buffer is None:
         return 'Errore durante il download del file.', 500
 
     return send_file(buffer, download_name=filename, as_attachment=True, mimetype='application/octet-stream')
 
 
+@app.route('/file-manager/duplicati')
+@login_required
+@admin_required
+def file_manager_duplicati():
+    """File con lo stesso contenuto (stesso SHA-256), anche tra utenti diversi (JSON)."""
+    gruppi = nas_checksum.duplicati(request.args.get('utente') or None)
+    for gruppo in gruppi:
+        gruppo['dimensione_human'] = nas_storage.format_size(gruppo['dimensione'])
+    return jsonify({'duplicati': gruppi})
+
+
+@app.route('/file-manager/download-cartella')
+@login_required
+def file_manager_download_cartella():
+    subpath = request.args.get('path', '')
+    folder_name = request.args.get('folder', '')
+    target_username = _get_file_manager_username()
+    shared = request.args.get('shared') == '1' and current_user.is_admin
+
+    if not folder_name:
+        return 'Cartella non specificata.', 400
+
+    # Esclude i file nel cestino e, per gli artisti, quelli nascosti
+    esclusi = _get_deleted_files(target_username)
+    if not current_user.is_admin and not shared:
+        esclusi |= _get_hidden_files(target_username)
+
+    try:
+        stream = nas_storage.zip_folder_stream(target_username, subpath, folder_name, esclusi)
+    except Exception as e:
+        logging.error(f"ERRORE download cartella {folder_name} per {target_username}: {type(e).__name__}: {e}")
+        return 'Errore durante il download della cartella.', 500
+
+    zip_name = f"{folder_name}.zip"
+    return Response(stream, mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_name)}",
+    })
+
+
+@app.route('/file-manager/cerca')
+@login_required
+def file_manager_cerca():
+    """Ricerca nell'intero albero dell'utente, servita dall'indice NAS (JSON)."""
+    target_username = _get_file_manager_username()
+    shared = request.args.get('shared') == '1' and current_user.is_admin
+
+    def _intero(nome):
+        valore = request.args.get(nome, '').strip()
+        return int(valore) if valore.isdigit() else None
+
+    def _timestamp(nome, fine_giornata=False):
+        valore = request.args.get(nome, '').strip()
+        if not valore:
+            return None
+        try:
+            data = datetime.strptime(valore, '%Y-%m-%d')
+        except ValueError:
+            return None
+        return int(data.timestamp()) + (86399 if fine_giornata else 0)
+
+    nome = request.args.get('q', '').strip()
+    estensione = request.args.get('ext', '').strip()
+    filtri = dict(
+        dimensione_min=_intero('min'), dimensione_max=_intero('max'),
+        modificato_dal=_timestamp('dal'), modificato_al=_timestamp('al', fine_giornata=True),
+    )
+    if not nome and not estensione and all(v is None for v in filtri.values()):
+        return jsonify(risultati=[])
+
+    try:
+        righe = nas_indice.cerca(target_username, nome=nome, estensione=estensione,
+                                 escludi_nascosti=not current_user.is_admin and not shared, **filtri)
+    except Exception as e:
+        logging.error(f"ERRORE ricerca NAS per {target_username}: {type(e).__name__}: {e}")
+        return jsonify(errore='Errore durante la ricerca.'), 500
+
+    risultati = []
+    for riga in righe:
+        risultati.append({
+            'percorso': riga['percorso'],
+            'cartella': riga['parent'],
+            'nome': riga['nome'],
+            'is_dir': bool(riga['is_dir']),
+            'dimensione': riga['dimensione'],
+            'dimensione_human': nas_storage.format_size(riga['dimensione']),
+            'modificato': datetime.fromtimestamp(riga['mtime']).strftime('%d/%m/%Y %H:%M'),
+            'icona': 'bi bi-folder-fill' if riga['is_dir'] else nas_storage.get_file_icon(riga['estensione']),
+        })
+    return jsonify(risultati=risultati, limite=len(righe) >= nas_indice.LIMITE_RICERCA)
+
+
+@app.route('/file-manager/anteprima/<tipo>')
+@login_required
+def file_manager_anteprima(tipo):
+    """Serve l'anteprima di un file NAS (miniatura, picchi, forma d'onda, proxy audio).
+
+    Risponde 202 finche l'anteprima e in generazione. Se l'URL contiene la
+    versione corrente del file (parametro v) la risposta e immutabile.
+    """
+    subpath = nas_storage._safe_subpath(request.args.get('path', ''))
+    filename = request.args.get('file', '')
+    target_username = _get_file_manager_username()
+    shared = request.args.get('shared') == '1' and current_user.is_admin
+
+    estensione = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if tipo not in anteprime.tipi_disponibili(estensione):
+        abort(404)
+
+    percorso = _build_file_path(subpath, nas_storage._safe_name(filename))
+    esclusi = _get_deleted_files(target_username)
+    if not current_user.is_admin and not shared:
+        esclusi |= _get_hidden_files(target_username)
+    if nas_storage._is_escluso(percorso, esclusi):
+        abort(404)
+
+    # Dimensione e mtime dall'indice; dal NAS solo se l'indice non e aggiornato
+    versione = request.args.get('v')
+    try:
+        metadati = nas_indice.metadati(target_username, percorso)
+    except Exception as e:
+        logging.error(f"Errore lettura indice NAS: {e}")
+        metadati = None
+    if metadati is None or (versione and versione != anteprime.versione(*metadati)):
+        try:
+            metadati = nas_storage.stat_file(target_username, subpath, filename)
+        except Exception as e:
+            logging.error(f"ERRORE anteprima {percorso} per {target_username}: {type(e).__name__}: {e}")
+            return 'Errore di connessione al NAS.', 500
+    if metadati is None:
+        abort(404)
+
+    stato, path = anteprime.richiedi(target_username, percorso, *metadati, tipo)
+    if stato == 'in_corso':
+        response = jsonify(stato='in_corso')
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
+    if stato == 'non_disponibile':
+        abort(404)
+
+    response = send_file(path, mimetype=anteprime.TIPI[tipo], conditional=True)
+    if versione == anteprime.versione(*metadati):
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/file-manager/delete', methods=['POST'])
 @login_required
 def file_manager_delete():
@@ -566,12 +897,31 @@ def file_manager_rinomina():
         flash('Nome non valido.', 'danger')
         return _file_manager_redirect(subpath, user_id, shared)
 
-    success = nas_storage.rename_item(target_username, subpath, old_name, new_name)
-    if success:
-        flash(f'"{old_name}" rinominato in "{new_name}" con successo.', 'success')
-    else:
-        flash(f'Errore durante la rinomina. Verifica che il nuovo nome non sia già in uso.', 'danger')
+    _accoda_operazione_nas('rinomina', target_username, {
+        'subpath': nas_storage._safe_subpath(subpath), 'vecchio': old_name, 'nuovo': new_name,
+    }, f'Rinomina di "{old_name}" in corso.')
+    return _file_manager_redirect(subpath, user_id, shared)
+
 
+@app.route('/file-manager/sposta', methods=['POST'])
+@login_required
+def file_manager_sposta():
+    subpath = request.form.get('subpath', '')
+    nome = request.form.get('nome', '')
+    destinazione = nas_storage._safe_subpath(request.form.get('destinazione', ''))
+    copia = request.form.get('operazione') == 'copia'
+    target_username = _get_file_manager_username()
+    user_id = request.form.get('target_user_id', '')
+    shared = request.form.get('shared') == '1'
+
+    if not nome:
+        flash('Elemento non specificato.', 'danger')
+        return _file_manager_redirect(subpath, user_id, shared)
+
+    sorgente = _build_file_path(nas_storage._safe_subpath(subpath), nas_storage._safe_name(nome))
+    _accoda_operazione_nas('copia' if copia else 'sposta', target_username, {
+        'sorgente': sorgente, 'destinazione': destinazione,
+    }, f'{"Copia" if copia else "Spostamento"} di "{nome}" in corso.')
     return _file_manager_redirect(subpath, user_id, shared)
 
 
@@ -588,12 +938,9 @@ def file_manager_nuova_cartella():
         flash('Nome cartella non valido.', 'danger')
         return _file_manager_redirect(subpath, user_id, shared)
 
-    success = nas_storage.create_folder(target_username, subpath, folder_name)
-    if success:
-        flash(f'Cartella "{folder_name}" creata con successo.', 'success')
-    else:
-        flash(f'Errore durante la creazione della cartella.', 'danger')
-
+    _accoda_operazione_nas('nuova_cartella', target_username, {
+        'subpath': nas_storage._safe_subpath(subpath), 'nome': folder_name,
+    }, f'Creazione della cartella "{folder_name}" in corso.')
     return _file_manager_redirect(subpath, user_id, shared)
 
 
@@ -630,6 +977,69 @@ def file_manager_elimina_cartella():
     return _file_manager_redirect(subpath, user_id, shared)
 
 
+@app.route('/file-manager/cestino')
+@login_required
+def file_manager_cestino():
+    """Elementi nel cestino, paginati per data di eliminazione."""
+    utenti = []
+    filtro_utente = None
+    if current_user.is_admin:
+        utenti = Utente.get_all()
+        filtro_utente = request.args.get('utente') or None
+        righe, prossimo = cestino.elenco(filtro_utente, request.args.get('dopo'))
+    else:
+        righe, prossimo = cestino.elenco(current_user.username, request.args.get('dopo'), escludi_nascosti=True)
+
+    for riga in righe:
+        riga['nome'] = riga['percorso'].rsplit('/', 1)[-1]
+        riga['cartella'] = riga['percorso'].rsplit('/', 1)[0] if '/' in riga['percorso'] else ''
+        riga['dimensione_human'] = nas_storage.format_size(riga['dimensione']) \
+            if riga['dimensione'] is not None and not riga['is_dir'] else '-'
+        riga['estensione'] = riga['nome'].rsplit('.', 1)[1].lower() if '.' in riga['nome'] else ''
+
+    return render_template('cestino.html', righe=righe, prossimo=prossimo, utenti=utenti,
+                           filtro_utente=filtro_utente, primo=not request.args.get('dopo'),
+                           giorni=cestino.GIORNI_CONSERVAZIONE, get_file_icon=nas_storage.get_file_icon)
+
+
+def _cestino_redirect():
+    utente = request.form.get('utente') if current_user.is_admin else None
+    return redirect(url_for('file_manager_cestino', utente=utente or None))
+
+
+@app.route('/file-manager/cestino/ripristina', methods=['POST'])
+@login_required
+def file_manager_cestino_ripristina():
+    ids = [i for i in request.form.getlist('ids') if i.isdigit()]
+    if not ids:
+        flash('Nessun elemento selezionato.', 'warning')
+        return _cestino_redirect()
+
+    # L'artista puo ripristinare solo i propri file
+    username = None if current_user.is_admin else current_user.username
+    ripristinati = cestino.ripristina(ids, username)
+    flash(f'{ripristinati} elemento/i ripristinato/i.', 'success')
+    return _cestino_redirect()
+
+
+@app.route('/file-manager/cestino/elimina', methods=['POST'])
+@login_required
+@admin_required
+def file_manager_cestino_elimina():
+    svuota_utente = request.form.get('svuota_utente')
+    if svuota_utente:
+        parametri = {'ids': None, 'username': svuota_utente}
+    else:
+        ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+        if not ids:
+            flash('Nessun elemento selezionato.', 'warning')
+            return _cestino_redirect()
+        parametri = {'ids': ids, 'username': None}
+    _accoda_operazione_nas('elimina_definitivamente', svuota_utente or '', parametri,
+                           'Eliminazione definitiva in corso.')
+    return _cestino_redirect()
+
+
 @app.route('/file-manager/nascondi', methods=['POST'])
 @login_required
 @admin_required
@@ -733,6 +1143,87 @@ def api_immagini():
     return json.dumps(immagini), 200, {'Content-Type': 'application/json'}
 
 
+@app.route('/media/<variante>/<formato>/<filename>')
+def immagine_variante(variante, formato, filename):
+    """Serve una variante ridimensionata, generandola al primo accesso se manca."""
+    if variante not in Config.IMMAGINI_VARIANTI or filename != secure_filename(filename) \
+            or not allowed_file(filename):
+        abort(404)
+
+    path = immagini.genera_variante(filename, variante, formato)
+    if path is None:
+        # Pipeline non disponibile o immagine non convertibile: serve l'originale
+        return send_from_directory(Config.UPLOAD_FOLDER, filename)
+
+    # Il nome della variante include la larghezza: il contenuto non cambia mai
+    response = send_from_directory(Config.IMMAGINI_VARIANTI_FOLDER, os.path.basename(path),
+                                   mimetype=immagini.MIMETYPES[formato])
+    response.headers['Cache-Control'] = static_assets.CACHE_IMMUTABILE
+    return response
+
+
+# ============ ROUTES ADMIN QUERY LENTE ============
+
+@app.route('/admin/query-lente')
+@login_required
+@admin_required
+def query_lente_elenco():
+    ordine = request.args.get('ordine', 'totale')
+    if ordine not in query_lente.ORDINAMENTI:
+        ordine = 'totale'
+    return render_template('admin/query_lente.html', query=query_lente.elenco(ordine), ordine=ordine,
+                           soglia=Config.SQL_LENTE_SOGLIA_MS)
+
+
+@app.route('/admin/query-lente/azzera', methods=['POST'])
+@login_required
+@admin_required
+def query_lente_azzera():
+    query_lente.azzera()
+    flash('Log delle query lente svuotato.', 'success')
+    return redirect(url_for('query_lente_elenco'))
+
+
+# ============ ROUTES ADMIN PROFILI ============
+
+@app.route('/admin/profili')
+@login_required
+@admin_required
+def profili_elenco():
+    return render_template('admin/profili.html', profili=profiler.elenco(),
+                           funzioni_costose=profiler.funzioni_costose)
+
+
+@app.route('/admin/profili/<int:profilo_id>/<formato>')
+@login_required
+@admin_required
+def profilo_scarica(profilo_id, formato):
+    profilo = profiler.get(profilo_id)
+    if profilo is None or formato not in ('speedscope', 'collassato'):
+        abort(404)
+    if formato == 'speedscope':
+        response = jsonify(profiler.speedscope(profilo))
+        nome = f'profilo-{profilo_id}.speedscope.json'
+    else:
+        response = Response(profiler.collassato(profilo), mimetype='text/plain')
+        nome = f'profilo-{profilo_id}.folded'
+    response.headers['Content-Disposition'] = f'attachment; filename="{nome}"'
+    return response
+
+
+# ============ METRICHE ============
+
+@app.route('/metrics')
+def metriche_prometheus():
+    # Senza token l'endpoint non e esposto: dietro un reverse proxy sullo stesso host
+    # ogni richiesta arriverebbe da localhost
+    if not Config.METRICHE or not Config.METRICHE_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {Config.METRICHE_TOKEN}'):
+        abort(401)
+    return Response(metriche.esporta(), mimetype='text/plain; version=0.0.4')
+
+
 # ============ ROUTES ADMIN UTENTI ============
 
 @app.route('/admin/utenti')
@@ -740,7 +1231,25 @@ def api_immagini():
 @admin_required
 def lista_utenti():
     utenti = Utente.get_all()
-    return render_template('admin/utenti.html', utenti=utenti)
+    try:
+        utilizzo = nas_quote.utilizzo_tutti()
+    except Exception as e:
+        logging.error(f"Errore lettura utilizzo NAS: {e}")
+        utilizzo = {}
+    return render_template('admin/utenti.html', utenti=utenti, utilizzo=utilizzo,
+                           format_size=nas_storage.format_size)
+
+
+def _quota_da_form():
+    """Legge la quota NAS (in GB) dal form utente: None se vuota."""
+    valore = (request.form.get('quota_nas_gb') or '').strip().replace(',', '.')
+    if not valore:
+        return None
+    try:
+        gb = float(valore)
+    except ValueError:
+        return None
+    return int(gb * 1024 ** 3) if gb > 0 else None
 
 
 @app.route('/admin/utenti/nuovo', methods=['GET', 'POST'])
@@ -770,7 +1279,8 @@ def nuovo_utente():
             nome=nome,
             cognome=cognome,
             email=email,
-            is_admin=is_admin
+            is_admin=is_admin,
+            quota_nas=_quota_da_form()
         )
         utente.set_password(password)
         utente.save()
@@ -806,6 +1316,7 @@ def modifica_utente(id):
         utente.email = request.form.get('email') or None
         utente.is_admin = request.form.get('is_admin') == 'on'
         utente.attivo = request.form.get('attivo') == 'on'
+        utente.quota_nas = _quota_da_form()
 
         new_password = request.form.get('password')
         if new_password:
@@ -1517,9 +2028,16 @@ def elimina_artista(id):
         flash('Artista non trovato.', 'danger')
         return redirect(url_for('lista_artisti'))
 
-    # Elimina le immagini associate
+    # Elimina le immagini associate (anche quelle di membri, dischi ed eventi
+    # che vengono rimossi in cascata)
     delete_uploaded_file(artista.foto)
     delete_uploaded_file(artista.foto_copertina)
+    for membro in artista.get_membri():
+        delete_uploaded_file(membro.foto)
+    for disco in artista.get_dischi():
+        delete_uploaded_file(disco.copertina)
+    for evento in artista.get_eventi():
+        delete_uploaded_file(evento.immagine)
 
     artista.delete()
     flash('Artista eliminato con successo.', 'success')
@@ -2051,6 +2569,60 @@ def elimina_brano(id):
     return redirect(url_for('lista_brani'))
 
 
+@app.route('/admin/brani/importa', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def importa_catalogo():
+    rapporto = None
+    if request.method == 'POST':
+        file = request.files.get('catalogo')
+        formato = importazione.formato_da_nome(file.filename) if file and file.filename else None
+        if formato not in ('csv', 'json', 'ndjson'):
+            flash('Seleziona un file CSV, JSON o NDJSON.', 'danger')
+            return redirect(url_for('importa_catalogo'))
+        verifica = request.form.get('verifica') == '1'
+        rapporto = importazione.importa(file.stream, formato, verifica=verifica)
+        logging.info(f"Importazione catalogo {file.filename} da {current_user.username}: "
+                    f"{rapporto['valide']}/{rapporto['righe']} righe valide in {rapporto['durata']:.1f} s"
+                    + (" (verifica)" if verifica else ""))
+        rapporto['verifica'] = verifica
+        rapporto['file'] = file.filename
+    return render_template('admin/importazione.html', rapporto=rapporto)
+
+
+# ============ ROUTES ADMIN ESPORTAZIONE ============
+
+@app.route('/admin/esporta')
+@login_required
+@admin_required
+def esportazione_catalogo():
+    entita = {nome: esportazione.colonne_disponibili(nome) for nome in esportazione.ENTITA}
+    return render_template('admin/esportazione.html', entita=entita, formati=esportazione.FORMATI)
+
+
+@app.route('/admin/esporta/<entita>')
+@login_required
+@admin_required
+def esporta_catalogo(entita):
+    if entita not in esportazione.ENTITA:
+        abort(404)
+    formato = request.args.get('formato', 'csv')
+    if formato not in esportazione.FORMATI:
+        abort(400)
+    # Colonne come parametri ripetuti (?colonne=id&colonne=titolo) o separate da virgole
+    richieste = [c.strip() for valore in request.args.getlist('colonne') for c in valore.split(',') if c.strip()]
+    try:
+        colonne = esportazione.scegli_colonne(entita, richieste)
+    except ValueError:
+        abort(400)
+    comprimi = request.args.get('gzip') == '1'
+    response = Response(esportazione.esporta(entita, formato, colonne, comprimi),
+                        mimetype='application/gzip' if comprimi else esportazione.FORMATI[formato])
+    nome = esportazione.nome_file(entita, formato, comprimi)
+    response.headers['Content-Disposition'] = f'attachment; filename="{nome}"'
+    return response
+
+
 # ============ ROUTES ADMIN EVENTI ============
 
 @app.route('/admin/eventi')
@@ -2246,7 +2818,14 @@ def elimina_evento(id):
 
 def init_db():
     """Inizializza il database con tabelle e dati di default."""
-    init_database()
+    for migrazione in migrazioni.esegui():
+        print(f"Migrazione {migrazione['versione']} applicata: {migrazione['descrizione']}")
+
+    # Elimina gli upload non piu referenziati da nessun record
+    try:
+        upload_storage.garbage_collect()
+    except Exception as e:
+        print(f'Garbage collection uploads non riuscita: {e}')
 
     # Crea admin se non esiste
     if not Utente.get_by_username('admin'):
@@ -2273,6 +2852,9 @@ def init_db():
         ('Discografia', 'bi-disc-fill', '/admin/dischi', 11),
         ('Brani', 'bi-music-note-beamed', '/admin/brani', 12),
         ('Eventi', 'bi-calendar-event-fill', '/admin/eventi', 13),
+        ('Query Lente', 'bi-hourglass-split', '/admin/query-lente', 20),
+        ('Profili', 'bi-activity', '/admin/profili', 21),
+        ('Esportazione', 'bi-box-arrow-up', '/admin/esporta', 22),
     ]
 
     conn = get_db_connection()
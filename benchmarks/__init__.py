@@ -0,0 +1,6 @@
+"""
+Benchmark delle prestazioni dell'applicazione.
+
+Eseguire dalla cartella principale del progetto, ad esempio:
+    python -m benchmarks.nas --help
+"""
@@ -0,0 +1,328 @@
+"""
+Load test HTTP dell'applicazione attraverso l'app WSGI.
+
+Popola un database MySQL dedicato con artisti, dischi, brani, eventi e news
+sintetici (generati con seme fisso, quindi riproducibili), avvia un server
+SFTP locale come NAS e invia richieste alle landing page, alle liste di
+amministrazione, al portale artista e al file manager da piu thread
+concorrenti, ognuno con il proprio client di test Flask (nessun server HTTP:
+si misura il costo dell'applicazione, non della rete).
+
+Per ogni route riporta richieste, errori, throughput, latenze p50/p95/p99 e
+numero di query SQL per richiesta (dall'header Server-Timing della
+strumentazione SQL, attivata per tutti gli utenti con SQL_STRUMENTAZIONE e
+SQL_SERVER_TIMING_TUTTI), in JSON.
+
+Il database deve essere indicato esplicitamente e viene creato se non esiste;
+il popolamento (--popola) rifiuta un database che contiene gia artisti, per
+non mescolare dati sintetici a dati reali.
+
+Utilizzo:
+    python -m benchmarks.carico --database maquetaweb_carico --popola --scala 100000
+    python -m benchmarks.carico --database maquetaweb_carico --concorrenza 8 --durata 30 --output carico.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+import pymysql
+from config import Config
+from benchmarks.sftp_locale import ServerSFTP
+from benchmarks.misure import percentile, rss_massimo_kb, commit
+
+PASSWORD = 'carico'
+UTENTE_ADMIN = 'carico_admin'
+UTENTE_ARTISTA = 'carico_artista'
+LOTTO = 1000  # righe per INSERT
+
+ROUTE_PUBBLICHE = ['/landing/moderno', '/landing/scuro', '/landing/elegante', '/landing/creativo', '/landing/magazine']
+ROUTE_ADMIN = ['/dashboard', '/admin/utenti', '/admin/news', '/admin/artisti', '/admin/dischi', '/admin/brani',
+               '/admin/eventi', '/file-manager', '/file-manager/elenco?offset=0']
+ROUTE_ARTISTA = ['/artista/dashboard', '/artista/profilo', '/artista/dischi', '/artista/brani', '/artista/eventi',
+                 '/file-manager']
+
+GENERI = ['Rock', 'Pop', 'Jazz', 'Elettronica', 'Hip Hop', 'Indie', 'Metal', 'Folk', 'Classica', 'Soul']
+CITTA = ['Milano', 'Roma', 'Torino', 'Bologna', 'Napoli', 'Firenze', 'Genova', 'Bari', 'Verona', 'Padova']
+
+
+_RE_QUERY = re.compile(r'sql;dur=[\d.]+;desc="(\d+) query"')
+
+
+def _numero_query(risposta):
+    """Query SQL della richiesta, dall'header Server-Timing della strumentazione."""
+    for valore in risposta.headers.getlist('Server-Timing'):
+        trovato = _RE_QUERY.search(valore)
+        if trovato:
+            return int(trovato.group(1))
+    return 0
+
+
+# ============ POPOLAMENTO ============
+
+def _crea_database(nome):
+    conn = pymysql.connect(host=Config.MYSQL_HOST, user=Config.MYSQL_USER, password=Config.MYSQL_PASSWORD,
+                           charset='utf8mb4')
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{nome}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def _inserisci(cursor, tabella, colonne, righe):
+    sql = f"INSERT INTO {tabella} ({', '.join(colonne)}) VALUES ({', '.join(['%s'] * len(colonne))})"
+    for i in range(0, len(righe), LOTTO):
+        cursor.executemany(sql, righe[i:i + LOTTO])
+
+
+def popola(scala):
+    """Inserisce dati sintetici: scala brani, scala/10 dischi e news, scala/5 eventi, scala/1000 artisti (min 10)."""
+    from database import get_db_connection
+    rnd = random.Random(42)
+    oggi = date.today()
+    n_artisti = max(scala // 1000, 10)
+    n_dischi = max(scala // 10, n_artisti)
+    n_eventi = max(scala // 5, 1)
+    n_news = max(scala // 10, 1)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) AS n FROM artisti')
+    if cursor.fetchone()['n']:
+        cursor.close()
+        conn.close()
+        raise SystemExit("Il database contiene gia artisti: popolamento annullato")
+
+    _inserisci(cursor, 'artisti',
+               ['nome', 'nome_arte', 'slug', 'bio', 'genere', 'citta', 'paese', 'attivo', 'in_evidenza', 'ordine'],
+               [(f"Artista {i}", f"Nome d'arte {i}", f"artista-{i}", f"Biografia dell'artista {i}. " * 20,
+                 rnd.choice(GENERI), rnd.choice(CITTA), 'Italia', True, i < 6, i)
+                for i in range(n_artisti)])
+    cursor.execute('SELECT id FROM artisti ORDER BY id')
+    artisti = [row['id'] for row in cursor.fetchall()]
+
+    _inserisci(cursor, 'dischi',
+               ['artista_id', 'titolo', 'slug', 'tipo', 'anno_uscita', 'data_uscita', 'descrizione',
+                'pubblicato', 'in_evidenza', 'ordine'],
+               [(artisti[i % len(artisti)], f"Disco {i}", f"disco-{i}",
+                 rnd.choice(['album', 'ep', 'singolo', 'live']), 2000 + i % 25,
+                 oggi - timedelta(days=rnd.randint(0, 9000)), f"Descrizione del disco {i}.",
+                 rnd.random() < 0.9, i < 8, i)
+                for i in range(n_dischi)])
+    cursor.execute('SELECT id, artista_id FROM dischi ORDER BY id')
+    dischi = [(row['id'], row['artista_id']) for row in cursor.fetchall()]
+
+    brani = []
+    for i in range(scala):
+        disco_id, artista_id = dischi[i % len(dischi)]
+        brani.append((disco_id, artista_id, f"Brano {i}", f"brano-{i}",
+                      f"{rnd.randint(2, 6)}:{rnd.randint(0, 59):02d}", i // len(dischi) + 1,
+                      rnd.choice(GENERI), 2000 + i % 25, rnd.random() < 0.9, rnd.random() < 0.05,
+                      oggi - timedelta(days=rnd.randint(0, 9000))))
+    _inserisci(cursor, 'brani',
+               ['disco_id', 'artista_id', 'titolo', 'slug', 'durata', 'numero_traccia', 'genere', 'anno',
+                'pubblicato', 'is_singolo', 'data_uscita'],
+               brani)
+
+    _inserisci(cursor, 'eventi',
+               ['artista_id', 'titolo', 'slug', 'tipo', 'descrizione', 'data_evento', 'venue', 'citta',
+                'stato', 'pubblicato', 'in_evidenza'],
+               [(artisti[i % len(artisti)], f"Evento {i}", f"evento-{i}",
+                 rnd.choice(['concerto', 'festival', 'showcase', 'dj_set']), f"Descrizione dell'evento {i}.",
+                 oggi + timedelta(days=rnd.randint(-365, 365)), f"Locale {i % 200}", rnd.choice(CITTA),
+                 rnd.choice(['programmato', 'confermato']), rnd.random() < 0.9, i < 6)
+                for i in range(n_eventi)])
+
+    _inserisci(cursor, 'news',
+               ['titolo', 'slug', 'contenuto', 'estratto', 'categoria', 'pubblicato', 'in_evidenza',
+                'data_pubblicazione'],
+               [(f"News {i}", f"news-{i}", f"Contenuto della news {i}. " * 50, f"Estratto della news {i}.",
+                 rnd.choice(['Uscite', 'Eventi', 'Interviste']), rnd.random() < 0.9, i < 4,
+                 datetime.now() - timedelta(hours=rnd.randint(0, 24 * 3650)))
+                for i in range(n_news)])
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return {'artisti': n_artisti, 'dischi': n_dischi, 'brani': scala, 'eventi': n_eventi, 'news': n_news}
+
+
+def _crea_utenti():
+    """Utenti del load test (admin e artista collegato al primo artista), creati se mancano."""
+    from models import Utente, Artista
+    if not Utente.get_by_username(UTENTE_ADMIN):
+        admin = Utente(username=UTENTE_ADMIN, nome='Carico', cognome='Admin', email='carico_admin@carico.local',
+                       is_admin=True)
+        admin.set_password(PASSWORD)
+        admin.save()
+    if not Utente.get_by_username(UTENTE_ARTISTA):
+        artisti = Artista.get_all_active()
+        if not artisti:
+            raise SystemExit("Nessun artista nel database: eseguire prima con --popola")
+        artista = Utente(username=UTENTE_ARTISTA, nome='Carico', cognome='Artista',
+                         email='carico_artista@carico.local', artista_id=artisti[0].id)
+        artista.set_password(PASSWORD)
+        artista.save()
+
+
+def _crea_file_nas(radice, voci):
+    """Cartelle NAS degli utenti del load test con voci file ciascuna."""
+    for utente in (UTENTE_ADMIN, UTENTE_ARTISTA):
+        cartella = os.path.join(radice, Config.NAS_BASE_PATH, utente)
+        os.makedirs(os.path.join(cartella, 'Progetti'))
+        for i in range(voci):
+            with open(os.path.join(cartella, f"traccia_{i}.wav"), 'wb') as f:
+                f.write(b'\0' * 1024)
+
+
+# ============ ESECUZIONE ============
+
+def _client(app, username):
+    client = app.test_client()
+    if username:
+        risposta = client.post('/login', data={'username': username, 'password': PASSWORD})
+        if risposta.status_code != 302:
+            raise SystemExit(f"Login di {username} non riuscito")
+    return client
+
+
+def _lavoratore(app, profili, fine, risultati, lock, seme):
+    """Un thread: un client per profilo, richieste a rotazione sulle route fino a fine."""
+    rnd = random.Random(seme)
+    sequenza = [(_client(app, username), route) for username, rotte in profili for route in rotte]
+    rnd.shuffle(sequenza)
+    locali = {}
+    i = 0
+    while time.monotonic() < fine:
+        client, route = sequenza[i % len(sequenza)]
+        i += 1
+        inizio = time.perf_counter()
+        risposta = client.get(route)
+        durata = time.perf_counter() - inizio
+        voce = locali.setdefault(route, {'durate': [], 'query': [], 'errori': 0})
+        voce['durate'].append(durata)
+        voce['query'].append(_numero_query(risposta))
+        if risposta.status_code != 200:
+            voce['errori'] += 1
+    with lock:
+        for route, voce in locali.items():
+            totale = risultati.setdefault(route, {'durate': [], 'query': [], 'errori': 0})
+            totale['durate'] += voce['durate']
+            totale['query'] += voce['query']
+            totale['errori'] += voce['errori']
+
+
+def esegui(args):
+    import app as applicazione
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    applicazione.init_db()
+    _crea_utenti()
+    app = applicazione.app
+
+    radice = tempfile.mkdtemp(prefix='carico_nas_')
+    server = ServerSFTP(radice)
+    Config.NAS_HOST, Config.NAS_PORT = '127.0.0.1', server.porta
+    Config.NAS_USER, Config.NAS_PASSWORD = 'carico', 'carico'
+    Config.NAS_BASE_PATH = 'nas'
+    _crea_file_nas(radice, args.voci)
+
+    profili = [(None, ROUTE_PUBBLICHE), (UTENTE_ADMIN, ROUTE_ADMIN), (UTENTE_ARTISTA, ROUTE_ARTISTA)]
+    try:
+        # Riscaldamento: template compilati e cache popolate prima delle misure
+        for username, rotte in profili:
+            client = _client(app, username)
+            for route in rotte:
+                client.get(route)
+
+        risultati = {}
+        lock = threading.Lock()
+        fine = time.monotonic() + args.durata
+        thread = [threading.Thread(target=_lavoratore, args=(app, profili, fine, risultati, lock, i))
+                  for i in range(args.concorrenza)]
+        inizio = time.monotonic()
+        for t in thread:
+            t.start()
+        for t in thread:
+            t.join()
+        durata = time.monotonic() - inizio
+    finally:
+        server.chiudi()
+        shutil.rmtree(radice, ignore_errors=True)
+
+    route = {}
+    for nome, voce in sorted(risultati.items()):
+        durate, query = voce['durate'], voce['query']
+        route[nome] = {
+            'richieste': len(durate),
+            'errori': voce['errori'],
+            'rps': round(len(durate) / durata, 2),
+            'p50_ms': round(percentile(durate, 50) * 1000, 3),
+            'p95_ms': round(percentile(durate, 95) * 1000, 3),
+            'p99_ms': round(percentile(durate, 99) * 1000, 3),
+            'query_media': round(sum(query) / len(query), 2),
+            'query_max': max(query),
+        }
+    richieste = sum(r['richieste'] for r in route.values())
+    return {
+        'commit': commit(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'parametri': {
+            'database': Config.MYSQL_DB,
+            'concorrenza': args.concorrenza,
+            'durata_s': args.durata,
+            'voci_nas': args.voci,
+        },
+        'totale': {
+            'richieste': richieste,
+            'errori': sum(r['errori'] for r in route.values()),
+            'rps': round(richieste / durata, 2),
+            'rss_max_kb': rss_massimo_kb(),
+        },
+        'route': route,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test HTTP dell'applicazione (app WSGI)")
+    parser.add_argument('--database', required=True, help="database MySQL dedicato al load test")
+    parser.add_argument('--popola', action='store_true', help="popola il database con dati sintetici")
+    parser.add_argument('--scala', type=int, default=10000, help="brani generati da --popola (default 10000)")
+    parser.add_argument('--concorrenza', type=int, default=4, help="thread concorrenti (default 4)")
+    parser.add_argument('--durata', type=float, default=30, help="secondi di misura (default 30)")
+    parser.add_argument('--voci', type=int, default=200, help="file nella cartella NAS degli utenti (default 200)")
+    parser.add_argument('--output', help="file JSON dei risultati (default stdout)")
+    args = parser.parse_args()
+
+    Config.MYSQL_DB = args.database
+    Config.SQL_STRUMENTAZIONE = True
+    Config.SQL_SERVER_TIMING_TUTTI = True  # anche route pubbliche e portale artista
+    _crea_database(args.database)
+    if args.popola:
+        import app as applicazione
+        applicazione.init_db()
+        inizio = time.monotonic()
+        righe = popola(args.scala)
+        print(f"Popolamento completato in {time.monotonic() - inizio:.1f}s: {righe}", file=sys.stderr)
+
+    risultato = esegui(args)
+    testo = json.dumps(risultato, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(testo + '\n')
+    else:
+        print(testo)
+
+
+if __name__ == '__main__':
+    main()
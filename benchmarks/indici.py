@@ -0,0 +1,379 @@
+"""
+Consigli di indici per le query dei modelli.
+
+Estrae le SELECT letterali passate a cursor.execute in models.py (o nei file
+indicati), ne ricava le forme su una sola tabella (condizioni di uguaglianza,
+intervalli, ORDER BY) e propone per ognuna un indice composto nell'ordine
+uguaglianze, ordinamento, intervallo: con questo ordine MySQL filtra e
+restituisce le righe gia ordinate, senza filesort. Le condizioni che non
+possono usare un prefisso dell'indice (OR, NOT IN) sono aggiunte in coda
+per essere valutate sull'indice (index condition pushdown).
+
+Le proposte sono confrontate con gli indici esistenti: quelli dichiarati
+dalle migrazioni (default, non serve un database) o, con --database, quelli
+letti da information_schema. Per le proposte mancanti viene stampato il
+passo Indice da aggiungere a una nuova migrazione.
+
+Con --misura esegue le query senza parametri sul database indicato e ne
+riporta tempo mediano e piano EXPLAIN: eseguita prima e dopo
+"python init_db.py" da i numeri prima/dopo della migrazione.
+
+Utilizzo:
+    python -m benchmarks.indici
+    python -m benchmarks.indici --database maquetaweb_carico --misura --ripetizioni 50
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+from config import Config
+from benchmarks.misure import percentile, commit
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAX_COLONNE = 5  # colonne oltre cui non si aggiungono le condizioni residue
+
+_RE_SELECT = re.compile(
+    r"^SELECT\s+(?P<colonne>.+?)\s+FROM\s+(?P<tabella>\w+)(?:\s+(?P<alias>\w+))?"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?(?:\s+ORDER\s+BY\s+(?P<ordine>.+?))?(?:\s+LIMIT\s+.+)?$",
+    re.IGNORECASE | re.DOTALL,
+)
+_RE_UGUALE = re.compile(r"^(\w+)\s*=\s*[^=]+$|^(\w+)\s+IS\s+NULL$", re.IGNORECASE)
+_RE_IN = re.compile(r"^(\w+)\s+IN\s*\(", re.IGNORECASE)
+_RE_INTERVALLO = re.compile(r"^(\w+)\s*(?:>=|<=|>|<)|^(\w+)\s+BETWEEN\b", re.IGNORECASE)
+_RE_COLONNA_CONDIZIONE = re.compile(r"(\w+)\s*(?:IS\b|<=|>=|<>|!=|=|<|>|NOT\s+IN\b|IN\b|BETWEEN\b)", re.IGNORECASE)
+_RE_PAROLE_CHIAVE = {'AND', 'OR', 'NOT', 'NULL', 'TRUE', 'FALSE', 'IS', 'IN'}
+_RE_SPAZI = re.compile(r"\s+")
+_RE_ESPRESSIONE = re.compile(r"\s+(ASC|DESC)$", re.IGNORECASE)
+_RE_PREFISSO = re.compile(r"\(\d+\)")
+_RE_INDICE_ALTER = re.compile(r"ALTER TABLE (\w+) ADD (?:UNIQUE )?INDEX (\w+) \((.+)\)")
+
+
+# ============ QUERY ============
+
+def estrai_query(percorso):
+    """SELECT letterali passate a execute(): [(funzione, riga, sql)]."""
+    with open(percorso, encoding='utf-8') as f:
+        albero = ast.parse(f.read(), percorso)
+    trovate = []
+
+    def visita(nodo, contesto):
+        for figlio in ast.iter_child_nodes(nodo):
+            if isinstance(figlio, ast.ClassDef):
+                visita(figlio, figlio.name)
+            elif isinstance(figlio, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                visita(figlio, f"{contesto}.{figlio.name}" if contesto else figlio.name)
+            else:
+                if (isinstance(figlio, ast.Call) and isinstance(figlio.func, ast.Attribute)
+                        and figlio.func.attr == 'execute' and figlio.args
+                        and isinstance(figlio.args[0], ast.Constant) and isinstance(figlio.args[0].value, str)):
+                    sql = _RE_SPAZI.sub(' ', figlio.args[0].value).strip()
+                    if sql.upper().startswith('SELECT'):
+                        trovate.append((contesto, figlio.lineno, sql))
+                visita(figlio, contesto)
+
+    visita(albero, '')
+    return trovate
+
+
+def _dividi_and(where):
+    """Condizioni in AND al livello piu esterno (le parentesi restano intere)."""
+    parti, profondita, inizio = [], 0, 0
+    token = re.finditer(r"\(|\)|\bAND\b|\bBETWEEN\b", where, re.IGNORECASE)
+    tra = False
+    for t in token:
+        testo = t.group(0).upper()
+        if testo == '(':
+            profondita += 1
+        elif testo == ')':
+            profondita -= 1
+        elif testo == 'BETWEEN' and profondita == 0:
+            tra = True
+        elif testo == 'AND' and profondita == 0:
+            if tra:
+                tra = False  # AND di BETWEEN x AND y
+                continue
+            parti.append(where[inizio:t.start()].strip())
+            inizio = t.end()
+    parti.append(where[inizio:].strip())
+    return [p for p in parti if p]
+
+
+def analizza(sql):
+    """Forma di una SELECT su una sola tabella, o None se non analizzabile (JOIN, sottoquery, niente WHERE)."""
+    corrispondenza = _RE_SELECT.match(sql)
+    if not corrispondenza or re.search(r"\bJOIN\b|\(\s*SELECT\b", sql, re.IGNORECASE):
+        return None
+    if not corrispondenza.group('where'):
+        return None
+    forma = {'tabella': corrispondenza.group('tabella'), 'uguaglianze': [], 'liste': [],
+             'intervalli': [], 'residue': [], 'ordine': [], 'direzioni': set(),
+             'colonne': [c.strip() for c in corrispondenza.group('colonne').split(',')]}
+    for condizione in _dividi_and(corrispondenza.group('where')):
+        uguale = _RE_UGUALE.match(condizione)
+        lista = _RE_IN.match(condizione)
+        intervallo = _RE_INTERVALLO.match(condizione)
+        if uguale:
+            forma['uguaglianze'].append(uguale.group(1) or uguale.group(2))
+        elif lista:
+            forma['liste'].append(lista.group(1))
+        elif intervallo:
+            forma['intervalli'].append(intervallo.group(1) or intervallo.group(2))
+        else:
+            forma['residue'].extend(c for c in _RE_COLONNA_CONDIZIONE.findall(condizione)
+                                    if c.upper() not in _RE_PAROLE_CHIAVE)
+    for espressione in (corrispondenza.group('ordine') or '').split(','):
+        espressione = espressione.strip()
+        if not espressione:
+            continue
+        direzione = _RE_ESPRESSIONE.search(espressione)
+        forma['direzioni'].add(direzione.group(1).upper() if direzione else 'ASC')
+        forma['ordine'].append(_RE_ESPRESSIONE.sub('', espressione))
+    return forma
+
+
+def proponi(forma):
+    """Colonne dell'indice proposto: (uguaglianze, resto in ordine)."""
+    uguaglianze = list(dict.fromkeys(forma['uguaglianze']))
+    resto = []
+    # L'ordinamento si legge dall'indice solo dopo sole uguaglianze e con un'unica direzione
+    # (indici ASC letti anche all'indietro); una lista IN lo impedisce
+    if forma['ordine'] and not forma['liste'] and len(forma['direzioni']) == 1 \
+            and all(re.fullmatch(r"\w+", c) for c in forma['ordine']):
+        resto.extend(c for c in forma['ordine'] if c not in uguaglianze)
+    # Dopo il primo intervallo le colonne non restringono piu la scansione: al piu uno
+    for colonna in forma['liste'] + forma['intervalli']:
+        if colonna not in uguaglianze and colonna not in resto:
+            resto.append(colonna)
+            break
+    for colonna in forma['residue']:
+        if colonna not in uguaglianze and colonna not in resto and len(uguaglianze) + len(resto) < MAX_COLONNE:
+            resto.append(colonna)
+    return uguaglianze, resto
+
+
+def _soddisfa(indice, uguaglianze, resto):
+    """True se le prime colonne dell'indice sono quelle proposte (uguaglianze in qualunque ordine)."""
+    n = len(uguaglianze)
+    return (len(indice) >= n + len(resto) and set(indice[:n]) == set(uguaglianze)
+            and indice[n:n + len(resto)] == resto)
+
+
+def _prefisso(indice, uguaglianze, colonne):
+    """True se l'indice esistente e un prefisso della proposta (che puo riordinare le uguaglianze)."""
+    n = len(uguaglianze)
+    if len(indice) <= n:
+        return set(indice) <= set(uguaglianze)
+    return set(indice[:n]) == set(uguaglianze) and indice[n:] == colonne[n:len(indice)]
+
+
+# ============ INDICI ESISTENTI ============
+
+def indici_da_migrazioni():
+    """{tabella: {nome: [colonne]}} dopo tutte le migrazioni di migrazioni.MIGRAZIONI."""
+    import migrazioni
+    indici = {}
+    for _versione, _descrizione, passi in migrazioni.MIGRAZIONI:
+        for passo in passi:
+            if isinstance(passo, migrazioni.RimuoviIndice):
+                indici.get(passo.tabella, {}).pop(passo.nome, None)
+                continue
+            sql = passo if isinstance(passo, str) else passo.sql
+            alter = _RE_INDICE_ALTER.match(sql)
+            if alter:
+                indici.setdefault(alter.group(1), {})[alter.group(2)] = _colonne(alter.group(3))
+                continue
+            crea = re.search(r"CREATE TABLE IF NOT EXISTS (\w+) \((.*)\)\s*$", sql, re.DOTALL)
+            if crea:
+                indici.setdefault(crea.group(1), {}).update(_indici_create(crea.group(2)))
+    return indici
+
+
+def _colonne(elenco):
+    return [_RE_PREFISSO.sub('', c).strip() for c in elenco.split(',')]
+
+
+def _indici_create(corpo):
+    indici = {}
+    chiavi_esterne = []
+    for riga in corpo.split('\n'):
+        riga = riga.strip().rstrip(',')
+        chiave = re.match(r"(?:(?:UNIQUE\s+)?(?:KEY|INDEX))\s+(\w+)\s*\((.+)\)$", riga, re.IGNORECASE)
+        esterna = re.match(r"FOREIGN KEY \((\w+)\)", riga, re.IGNORECASE)
+        colonna = re.match(r"(\w+)\s+\w+", riga)
+        if chiave:
+            indici[chiave.group(1)] = _colonne(chiave.group(2))
+        elif esterna:
+            chiavi_esterne.append(esterna.group(1))
+        elif colonna and re.search(r"\bPRIMARY KEY\b", riga, re.IGNORECASE):
+            indici['PRIMARY'] = [colonna.group(1)]
+        elif colonna and re.search(r"\bUNIQUE\b", riga, re.IGNORECASE):
+            indici[colonna.group(1)] = [colonna.group(1)]
+    # MySQL crea un indice per ogni chiave esterna che non ne abbia gia uno che inizi con la colonna
+    for colonna in chiavi_esterne:
+        if not any(colonne[0] == colonna for colonne in indici.values()):
+            indici[colonna] = [colonna]
+    return indici
+
+
+def indici_da_database(cursor):
+    """{tabella: {nome: [colonne]}} da information_schema."""
+    cursor.execute('''
+        SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+    ''')
+    indici = {}
+    for riga in cursor.fetchall():
+        indici.setdefault(riga['TABLE_NAME'], {}).setdefault(riga['INDEX_NAME'], []).append(riga['COLUMN_NAME'])
+    return indici
+
+
+# ============ RAPPORTO ============
+
+def consigli(file, indici):
+    """Proposte per le query dei file, raggruppate per tabella e colonne.
+
+    Returns:
+        lista di dict: tabella, colonne, uguaglianze, query [(file, funzione, riga, sql)],
+        presente (nome dell'indice che la soddisfa o None), estende (indici esistenti che
+        sono un prefisso della proposta), coprente (la query legge solo colonne dell'indice)
+    """
+    proposte = {}
+    for percorso in file:
+        for funzione, riga, sql in estrai_query(percorso):
+            forma = analizza(sql)
+            if forma is None:
+                continue
+            uguaglianze, resto = proponi(forma)
+            if not uguaglianze and not resto:
+                continue
+            chiave = (forma['tabella'], frozenset(uguaglianze), tuple(resto))
+            proposta = proposte.setdefault(chiave, {
+                'tabella': forma['tabella'], 'uguaglianze': uguaglianze, 'colonne': uguaglianze + resto,
+                'query': [], 'coprente': True,
+            })
+            proposta['query'].append((os.path.relpath(percorso, RADICE), funzione, riga, sql))
+            letti = {c.split('.')[-1] for c in forma['colonne'] if not c.upper().startswith('COUNT(')}
+            if '*' in letti or not letti <= set(proposta['colonne']):
+                proposta['coprente'] = False
+
+    # Una proposta che e il prefisso di un'altra sulla stessa tabella e gia soddisfatta da quella
+    elenco = list(proposte.values())
+    for proposta in elenco:
+        for altra in elenco:
+            if altra is not proposta and altra['tabella'] == proposta['tabella'] and \
+                    len(altra['colonne']) > len(proposta['colonne']) and \
+                    _soddisfa(altra['colonne'], proposta['uguaglianze'], proposta['colonne'][len(proposta['uguaglianze']):]):
+                proposta['inclusa_in'] = altra['colonne']
+                break
+
+    for proposta in elenco:
+        esistenti = indici.get(proposta['tabella'], {})
+        n = len(proposta['uguaglianze'])
+        resto = proposta['colonne'][n:]
+        proposta['presente'] = next((nome for nome, colonne in esistenti.items()
+                                     if _soddisfa(colonne, proposta['uguaglianze'], resto)), None)
+        proposta['estende'] = sorted(nome for nome, colonne in esistenti.items()
+                                     if nome != 'PRIMARY' and len(colonne) < len(proposta['colonne'])
+                                     and _prefisso(colonne, proposta['uguaglianze'], proposta['colonne']))
+        if proposta['estende'] and not proposta['presente']:
+            # Uguaglianze nell'ordine dell'indice esteso piu lungo, che la proposta puo sostituire
+            esteso = max((esistenti[nome] for nome in proposta['estende']), key=len)
+            proposta['uguaglianze'] = sorted(proposta['uguaglianze'],
+                                             key=lambda c: esteso.index(c) if c in esteso else len(esteso))
+            proposta['colonne'] = proposta['uguaglianze'] + resto
+    return sorted(elenco, key=lambda p: (p['presente'] is not None, p['tabella'], p['colonne']))
+
+
+def _nome_indice(tabella, colonne):
+    return f"idx_{tabella}_{'_'.join(colonne)}"[:64]
+
+
+def stampa(proposte):
+    mancanti = [p for p in proposte if not p['presente'] and not p.get('inclusa_in')]
+    for proposta in proposte:
+        if proposta['presente']:
+            stato = f"presente ({proposta['presente']})"
+        elif proposta.get('inclusa_in'):
+            stato = f"coperta dalla proposta ({', '.join(proposta['inclusa_in'])})"
+        else:
+            stato = 'MANCANTE'
+        print(f"{proposta['tabella']} ({', '.join(proposta['colonne'])}): {stato}")
+        if not proposta['presente'] and proposta['estende']:
+            print(f"    estende: {', '.join(proposta['estende'])} (ridondanti se non servono a chiavi esterne)")
+        if proposta['coprente']:
+            print("    coprente: la query legge solo colonne dell'indice")
+        for file, funzione, riga, sql in proposta['query']:
+            print(f"    {file}:{riga} {funzione}: {sql[:140]}")
+    if mancanti:
+        print("\n# Passi per una nuova migrazione (migrazioni.MIGRAZIONI)")
+        for proposta in mancanti:
+            print(f"Indice('{proposta['tabella']}', '{_nome_indice(proposta['tabella'], proposta['colonne'])}', "
+                  f"'{', '.join(proposta['colonne'])}'),")
+
+
+def misura(cursor, file, ripetizioni):
+    """Tempo mediano e piano EXPLAIN delle query senza parametri (con forma analizzabile)."""
+    risultati = []
+    for percorso in file:
+        for funzione, riga, sql in estrai_query(percorso):
+            if '%s' in sql or analizza(sql) is None:
+                continue
+            cursor.execute(f'EXPLAIN {sql}')
+            piano = cursor.fetchall()
+            durate = []
+            for _ in range(ripetizioni):
+                inizio = time.perf_counter()
+                cursor.execute(sql)
+                cursor.fetchall()
+                durate.append((time.perf_counter() - inizio) * 1000)
+            risultati.append({
+                'query': f"{os.path.relpath(percorso, RADICE)}:{riga} {funzione}",
+                'p50_ms': round(percentile(durate, 50), 3),
+                'p99_ms': round(percentile(durate, 99), 3),
+                'piano': [{k: passo.get(k) for k in ('table', 'type', 'key', 'rows', 'Extra')} for passo in piano],
+            })
+    return risultati
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consigli di indici composti per le query dei modelli")
+    parser.add_argument('file', nargs='*', help="file Python da analizzare (default models.py)")
+    parser.add_argument('--database', help="confronta con gli indici di questo database invece che con le migrazioni")
+    parser.add_argument('--misura', action='store_true', help="misura le query senza parametri (richiede --database)")
+    parser.add_argument('--ripetizioni', type=int, default=20, help="esecuzioni per query con --misura (default 20)")
+    parser.add_argument('--output', help="file JSON delle misure (default stdout)")
+    args = parser.parse_args()
+    file = [os.path.abspath(f) for f in args.file] or [os.path.join(RADICE, 'models.py')]
+    if args.misura and not args.database:
+        parser.error('--misura richiede --database')
+
+    if not args.database:
+        stampa(consigli(file, indici_da_migrazioni()))
+        return
+
+    Config.MYSQL_DB = args.database
+    from database import get_db_connection
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        stampa(consigli(file, indici_da_database(cursor)))
+        if args.misura:
+            risultati = {'commit': commit(), 'database': args.database, 'ripetizioni': args.ripetizioni,
+                         'query': misura(cursor, file, args.ripetizioni)}
+            testo = json.dumps(risultati, indent=2, default=str)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(testo + '\n')
+            else:
+                print(testo)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
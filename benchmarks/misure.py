@@ -0,0 +1,29 @@
+"""
+Funzioni comuni ai benchmark: percentili, memoria del processo, commit misurato.
+"""
+import math
+import os
+import resource
+import subprocess
+import sys
+
+
+def percentile(durate, percentuale):
+    """Percentile (nearest-rank) di una lista non vuota di durate."""
+    ordinate = sorted(durate)
+    return ordinate[max(math.ceil(len(ordinate) * percentuale / 100) - 1, 0)]
+
+
+def rss_massimo_kb():
+    """Picco di memoria residente del processo in KB (ru_maxrss e in bytes su macOS)."""
+    massimo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return massimo // 1024 if sys.platform == 'darwin' else massimo
+
+
+def commit():
+    """Commit corrente del repository, o None se non disponibile."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
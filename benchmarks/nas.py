@@ -0,0 +1,161 @@
+"""
+Benchmark delle operazioni di nas_storage contro un server SFTP locale.
+
+Avvia un ServerSFTP in-process su una cartella temporanea, punta la
+configurazione NAS al server e misura le operazioni principali su alberi e
+file generati: elenco di cartella (senza e con cache), upload, download,
+rinomina ed eliminazione definitiva di alberi (la parte NAS dello svuotamento
+del cestino, che nell'applicazione aggiorna poi il database).
+
+Il risultato e un JSON con, per ogni operazione, ops/s, latenza p50/p99 e picco
+di memoria residente del processo, da confrontare tra commit diversi.
+
+Utilizzo:
+    python -m benchmarks.nas
+    python -m benchmarks.nas --latenza 20 --banda 100 --output risultati.json
+    python -m benchmarks.nas --sessione    # una sola connessione SSH per tutte le operazioni
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from config import Config
+import nas_storage
+from benchmarks.misure import percentile, rss_massimo_kb, commit
+from benchmarks.sftp_locale import ServerSFTP
+
+UTENTE = 'benchmark'
+
+
+def _misura(operazione, ripetizioni, prepara=None):
+    """Esegue operazione(i) ripetizioni volte e ne riassume le durate.
+
+    prepara(i), se presente, viene eseguita prima di ogni ripetizione fuori dalla misura.
+    Un'operazione che restituisce None o False viene considerata fallita.
+    """
+    durate = []
+    for i in range(ripetizioni):
+        if prepara:
+            prepara(i)
+        inizio = time.perf_counter()
+        esito = operazione(i)
+        durate.append(time.perf_counter() - inizio)
+        if esito is None or esito is False:
+            raise RuntimeError(f"Operazione fallita alla ripetizione {i}")
+    return {
+        'ripetizioni': ripetizioni,
+        'ops_s': round(ripetizioni / sum(durate), 2),
+        'p50_ms': round(percentile(durate, 50) * 1000, 3),
+        'p99_ms': round(percentile(durate, 99) * 1000, 3),
+        'media_ms': round(sum(durate) / ripetizioni * 1000, 3),
+        'rss_max_kb': rss_massimo_kb(),
+    }
+
+
+def _crea_file(percorso, dimensione):
+    with open(percorso, 'wb') as f:
+        f.write(os.urandom(dimensione))
+
+
+def _crea_albero(radice, cartelle, file_per_cartella, dimensione):
+    """Albero di prova: cartelle sottocartelle (con una sottocartella ciascuna) piene di file."""
+    for c in range(cartelle):
+        for cartella in (f"{radice}/cartella_{c}", f"{radice}/cartella_{c}/interna"):
+            os.makedirs(cartella, exist_ok=True)
+            for f in range(file_per_cartella):
+                _crea_file(f"{cartella}/file_{f}.wav", dimensione)
+
+
+def esegui(args):
+    radice = tempfile.mkdtemp(prefix='benchmark_nas_')
+    server = ServerSFTP(radice, latenza=args.latenza / 1000,
+                        banda=args.banda * 1000 * 1000 / 8 if args.banda else None)
+    Config.NAS_HOST, Config.NAS_PORT = '127.0.0.1', server.porta
+    Config.NAS_USER, Config.NAS_PASSWORD = 'benchmark', 'benchmark'
+    Config.NAS_BASE_PATH = 'nas'
+    base = os.path.join(radice, Config.NAS_BASE_PATH, UTENTE)
+    ripetizioni = args.ripetizioni
+    contenuto = os.urandom(args.dimensione * 1024)
+    risultati = {}
+
+    try:
+        # Preparazione direttamente sul filesystem, fuori dalle misure
+        os.makedirs(f"{base}/elenco")
+        for i in range(args.voci):
+            _crea_file(f"{base}/elenco/voce_{i}.wav", 1024)
+        os.makedirs(f"{base}/rinomina")
+        for i in range(ripetizioni):
+            _crea_file(f"{base}/rinomina/file_{i}.wav", 1024)
+            _crea_albero(f"{base}/cestino/albero_{i}", args.cartelle, args.file, 1024)
+
+        with nas_storage.sessione() if args.sessione else nullcontext():
+            risultati['list_files'] = _misura(
+                lambda i: nas_storage.list_files(UTENTE, 'elenco'), ripetizioni,
+                prepara=lambda i: nas_storage._invalida_elenchi(UTENTE, 'elenco'))
+            risultati['list_files_cache'] = _misura(
+                lambda i: nas_storage.list_files(UTENTE, 'elenco'), ripetizioni)
+            risultati['upload_file'] = _misura(
+                lambda i: nas_storage.upload_file(UTENTE, 'upload', io.BytesIO(contenuto), f"file_{i}.wav"),
+                ripetizioni)
+            risultati['download_file'] = _misura(
+                lambda i: nas_storage.download_file(UTENTE, 'upload', f"file_{i}.wav"), ripetizioni)
+            risultati['rename_item'] = _misura(
+                lambda i: nas_storage.rename_item(UTENTE, 'rinomina', f"file_{i}.wav", f"rinominato_{i}.wav"),
+                ripetizioni)
+            risultati['delete_trees'] = _misura(
+                lambda i: nas_storage.delete_trees(UTENTE, [f"cestino/albero_{i}"]) or None, ripetizioni)
+    finally:
+        server.chiudi()
+        shutil.rmtree(radice, ignore_errors=True)
+
+    return {
+        'commit': commit(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'parametri': {
+            'ripetizioni': ripetizioni,
+            'latenza_ms': args.latenza,
+            'banda_mbit': args.banda,
+            'sessione': args.sessione,
+            'voci_elenco': args.voci,
+            'dimensione_kb': args.dimensione,
+            'albero': {'cartelle': args.cartelle, 'file_per_cartella': args.file},
+        },
+        'risultati': risultati,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di nas_storage su un server SFTP locale")
+    parser.add_argument('--ripetizioni', type=int, default=20, help="ripetizioni di ogni operazione (default 20)")
+    parser.add_argument('--latenza', type=float, default=0, help="round trip simulato in ms (default 0)")
+    parser.add_argument('--banda', type=float, default=0, help="banda simulata in Mbit/s (default illimitata)")
+    parser.add_argument('--sessione', action='store_true', help="riusa una sola connessione SSH")
+    parser.add_argument('--voci', type=int, default=500, help="voci della cartella elencata (default 500)")
+    parser.add_argument('--dimensione', type=int, default=4096, help="KB dei file caricati e scaricati (default 4096)")
+    parser.add_argument('--cartelle', type=int, default=5, help="cartelle per albero eliminato (default 5)")
+    parser.add_argument('--file', type=int, default=20, help="file per cartella degli alberi (default 20)")
+    parser.add_argument('--output', help="file JSON dei risultati (default stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Le disconnessioni dei client chiusi vengono registrate come errori dal lato server
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    risultato = esegui(args)
+    testo = json.dumps(risultato, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(testo + '\n')
+    else:
+        print(testo)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Server SFTP in-process su una cartella locale, sostituto del NAS nei benchmark.
+
+Il server accetta qualsiasi utente e password e mappa i percorsi remoti
+(assoluti o relativi) sotto la cartella radice. Latenza e banda della rete
+sono simulate da un proxy TCP tra client e server che ritarda ogni blocco di
+bytes di meta del round trip per direzione e ne limita la velocita di invio:
+a differenza di un ritardo per richiesta nel server, le richieste SFTP in
+pipeline (readv, scritture pipelined) si sovrappongono come su una rete reale.
+"""
+import os
+import queue
+import socket
+import threading
+import time
+import paramiko
+from paramiko import SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK, SFTP_FAILURE
+
+
+class _ServerSSH(paramiko.ServerInterface):
+    """Autenticazione senza verifiche e solo canali di sessione (per il sottosistema sftp)."""
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _HandleLocale(SFTPHandle):
+    """Handle di un file aperto: letture e scritture posizionali sul descrittore."""
+
+    def __init__(self, fd, percorso, flags=0):
+        super().__init__(flags)
+        self._fd = fd
+        self.filename = percorso
+
+    def read(self, offset, length):
+        try:
+            return os.pread(self._fd, length, offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def write(self, offset, data):
+        try:
+            os.pwrite(self._fd, data, offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self._fd))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            if attr._flags & attr.FLAG_SIZE:
+                os.ftruncate(self._fd, attr.st_size)
+                attr._flags &= ~attr.FLAG_SIZE
+            SFTPServer.set_file_attr(self.filename, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _InterfacciaSFTP(paramiko.SFTPServerInterface):
+    """Operazioni SFTP eseguite sul filesystem locale sotto radice."""
+
+    def __init__(self, server, radice, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self._radice = radice
+
+    def _locale(self, path):
+        return os.path.join(self._radice, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        path = self._locale(path)
+        try:
+            voci = []
+            for nome in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, nome)))
+                attr.filename = nome
+                voci.append(attr)
+            return voci
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._locale(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._locale(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._locale(path)
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return _HandleLocale(fd, path, flags)
+
+    def remove(self, path):
+        try:
+            os.remove(self._locale(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        # Semantica SFTPv3: rename non sovrascrive una destinazione esistente
+        newpath = self._locale(newpath)
+        if os.path.exists(newpath):
+            return SFTP_FAILURE
+        try:
+            os.rename(self._locale(oldpath), newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._locale(oldpath), self._locale(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._locale(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._locale(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        path = self._locale(path)
+        try:
+            if attr._flags & attr.FLAG_SIZE:
+                os.truncate(path, attr.st_size)
+                attr._flags &= ~attr.FLAG_SIZE
+            SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class _Linea(threading.Thread):
+    """Una direzione del proxy: consegna ogni blocco dopo ritardo secondi, a banda bytes/s."""
+
+    def __init__(self, sorgente, destinazione, ritardo, banda):
+        super().__init__(daemon=True)
+        self._sorgente = sorgente
+        self._destinazione = destinazione
+        self._ritardo = ritardo
+        self._banda = banda
+        self._coda = queue.Queue()
+
+    def run(self):
+        threading.Thread(target=self._ricevi, daemon=True).start()
+        try:
+            while True:
+                scadenza, data = self._coda.get()
+                attesa = scadenza - time.monotonic()
+                if attesa > 0:
+                    time.sleep(attesa)
+                if data is None:
+                    self._destinazione.shutdown(socket.SHUT_WR)
+                    return
+                self._destinazione.sendall(data)
+                if self._banda:
+                    time.sleep(len(data) / self._banda)
+        except OSError:
+            pass
+
+    def _ricevi(self):
+        try:
+            while True:
+                data = self._sorgente.recv(65536)
+                self._coda.put((time.monotonic() + self._ritardo, data or None))
+                if not data:
+                    return
+        except OSError:
+            self._coda.put((0, None))
+
+
+class _ReteSimulata:
+    """Proxy TCP verso porta_server con latenza (round trip, secondi) e banda (bytes/s) simulate."""
+
+    def __init__(self, porta_server, latenza, banda):
+        self._porta_server = porta_server
+        self._latenza = latenza
+        self._banda = banda
+        self._socket = _socket_in_ascolto()
+        self.porta = self._socket.getsockname()[1]
+        self._connessioni = []
+        threading.Thread(target=self._accetta, daemon=True).start()
+
+    def _accetta(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            server = socket.create_connection(('127.0.0.1', self._porta_server))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connessioni += [client, server]
+            _Linea(client, server, self._latenza / 2, self._banda).start()
+            _Linea(server, client, self._latenza / 2, self._banda).start()
+
+    def chiudi(self):
+        self._socket.close()
+        for sock in self._connessioni:
+            sock.close()
+
+
+def _socket_in_ascolto():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(64)
+    return sock
+
+
+class ServerSFTP:
+    """Server SFTP su 127.0.0.1 con radice in una cartella locale.
+
+    Args:
+        radice: cartella servita come radice del server
+        latenza: round trip simulato in secondi (0 = nessuno)
+        banda: bytes/s per direzione (None = illimitata)
+
+    La porta a cui connettersi e in .porta (quella del proxy se la rete e simulata).
+    """
+
+    def __init__(self, radice, latenza=0.0, banda=None):
+        self.radice = radice
+        self._chiave = paramiko.RSAKey.generate(2048)
+        self._socket = _socket_in_ascolto()
+        self._trasporti = []
+        threading.Thread(target=self._accetta, daemon=True).start()
+        self.porta = self._socket.getsockname()[1]
+        self._rete = None
+        if latenza or banda:
+            self._rete = _ReteSimulata(self.porta, latenza, banda)
+            self.porta = self._rete.porta
+
+    def _accetta(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            trasporto = paramiko.Transport(sock)
+            trasporto.add_server_key(self._chiave)
+            trasporto.set_subsystem_handler('sftp', SFTPServer, _InterfacciaSFTP, self.radice)
+            self._trasporti.append(trasporto)
+            threading.Thread(target=trasporto.start_server, kwargs={'server': _ServerSSH()}, daemon=True).start()
+
+    def chiudi(self):
+        self._socket.close()
+        if self._rete:
+            self._rete.chiudi()
+        for trasporto in self._trasporti:
+            trasporto.close()
@@ -0,0 +1,216 @@
+"""
+Cestino dei file NAS.
+
+I file eliminati dal file manager restano sul NAS e vengono registrati in
+file_cestino; dopo GIORNI_CONSERVAZIONE giorni vengono eliminati
+definitivamente. Ripristino ed eliminazione lavorano su insiemi di righe
+(una query per blocco di id o percorsi, non una per file) e le eliminazioni
+sul NAS sono raggruppate per utente su un'unica connessione.
+"""
+import logging
+import time
+from datetime import datetime
+from database import get_db_connection
+import nas_storage
+import nas_indice
+import nas_quote
+import metriche
+
+logger = logging.getLogger(__name__)
+
+GIORNI_CONSERVAZIONE = 30
+ELEMENTI_PER_PAGINA = 50
+# Id o percorsi per singola query
+BATCH_SIZE = 500
+
+
+def _codifica_cursore(riga):
+    return f"{riga['data_eliminazione']:%Y%m%d%H%M%S}-{riga['id']}"
+
+
+def _decodifica_cursore(cursore):
+    try:
+        data, id_ = cursore.split('-', 1)
+        return datetime.strptime(data, '%Y%m%d%H%M%S'), int(id_)
+    except (ValueError, AttributeError):
+        return None
+
+
+def elenco(username=None, cursore=None, escludi_nascosti=False, limite=ELEMENTI_PER_PAGINA):
+    """Una pagina del cestino, dalla eliminazione piu recente.
+
+    La paginazione e keyset su (data_eliminazione, id): ogni pagina e una
+    lettura di intervallo su idx_cestino_username_data (o idx_cestino_data
+    per tutti gli utenti), senza OFFSET.
+
+    Args:
+        username: solo gli elementi di un utente (None = tutti gli utenti)
+        cursore: valore restituito dalla pagina precedente
+        escludi_nascosti: non mostrare i file nascosti all'artista
+
+    Returns:
+        tupla (righe, cursore della pagina successiva o None)
+    """
+    condizioni = []
+    params = []
+    if username:
+        condizioni.append('c.username = %s')
+        params.append(username)
+    posizione = _decodifica_cursore(cursore) if cursore else None
+    if posizione:
+        condizioni.append('(c.data_eliminazione < %s OR (c.data_eliminazione = %s AND c.id < %s))')
+        params.extend([posizione[0], posizione[0], posizione[1]])
+    if escludi_nascosti:
+        condizioni.append('NOT EXISTS (SELECT 1 FROM file_nascosti n '
+                          'WHERE n.username = c.username AND n.percorso = c.percorso)')
+    where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ''
+    params.append(limite + 1)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT c.id, c.username, c.percorso, c.data_eliminazione,
+               c.data_eliminazione + INTERVAL {GIORNI_CONSERVAZIONE} DAY AS data_scadenza,
+               u.nome AS eliminato_da_nome, u.cognome AS eliminato_da_cognome,
+               i.is_dir, i.dimensione
+        FROM file_cestino c
+        LEFT JOIN utenti u ON u.id = c.eliminato_da
+        LEFT JOIN nas_indice i ON i.username = c.username AND i.percorso = c.percorso
+        {where}
+        ORDER BY c.data_eliminazione DESC, c.id DESC
+        LIMIT %s
+    ''', params)
+    righe = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    prossimo = None
+    if len(righe) > limite:
+        righe = righe[:limite]
+        prossimo = _codifica_cursore(righe[-1])
+    return righe, prossimo
+
+
+def ripristina(ids, username=None):
+    """Ripristina elementi del cestino: i file sono ancora sul NAS, basta eliminare le righe.
+
+    Args:
+        username: se indicato, ripristina solo gli elementi di quell'utente
+
+    Returns:
+        numero di elementi ripristinati
+    """
+    ids = [int(i) for i in ids]
+    ripristinati = 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            sql = f'DELETE FROM file_cestino WHERE id IN ({placeholders})'
+            params = list(batch)
+            if username is not None:
+                sql += ' AND username = %s'
+                params.append(username)
+            ripristinati += cursor.execute(sql, params)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return ripristinati
+
+
+def _pulisci_percorsi(cursor, username, percorsi):
+    """Elimina le righe di cestino, file nascosti e checksum dei percorsi eliminati e del loro contenuto."""
+    # Le condizioni LIKE sono per percorso: batch piu piccoli
+    for i in range(0, len(percorsi), 100):
+        batch = percorsi[i:i + 100]
+        placeholders = ', '.join(['%s'] * len(batch))
+        condizioni = ' OR '.join(['percorso LIKE %s'] * len(batch))
+        params = [username] + batch + [nas_indice._like_prefisso(p) for p in batch]
+        for tabella in ('file_cestino', 'file_nascosti', 'nas_checksum'):
+            cursor.execute(
+                f'DELETE FROM {tabella} WHERE username = %s AND (percorso IN ({placeholders}) OR {condizioni})',
+                params
+            )
+
+
+def elimina_definitivamente(ids=None, username=None, scaduti=False):
+    """Elimina definitivamente dal NAS elementi del cestino.
+
+    Le eliminazioni sul NAS sono raggruppate per utente su un'unica connessione;
+    le righe degli elementi che non e stato possibile eliminare restano nel
+    cestino e vengono ritentate alla prossima eliminazione.
+
+    Args:
+        ids: id delle righe del cestino (None = tutte quelle che rispettano gli altri filtri)
+        username: solo gli elementi di un utente
+        scaduti: solo gli elementi nel cestino da piu di GIORNI_CONSERVAZIONE giorni
+
+    Returns:
+        numero di elementi eliminati
+    """
+    condizioni = []
+    params = []
+    if username is not None:
+        condizioni.append('username = %s')
+        params.append(username)
+    if scaduti:
+        condizioni.append(f'data_eliminazione < NOW() - INTERVAL {GIORNI_CONSERVAZIONE} DAY')
+
+    inizio = time.perf_counter()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        righe = []
+        if ids is None:
+            where = f"WHERE {' AND '.join(condizioni)}" if condizioni else ''
+            cursor.execute(f'SELECT username, percorso FROM file_cestino {where}', params)
+            righe = cursor.fetchall()
+        else:
+            ids = [int(i) for i in ids]
+            for i in range(0, len(ids), BATCH_SIZE):
+                batch = ids[i:i + BATCH_SIZE]
+                placeholders = ', '.join(['%s'] * len(batch))
+                where = ' AND '.join([f'id IN ({placeholders})'] + condizioni)
+                cursor.execute(f'SELECT username, percorso FROM file_cestino WHERE {where}', batch + params)
+                righe.extend(cursor.fetchall())
+        if not righe:
+            return 0
+
+        per_utente = {}
+        for riga in righe:
+            per_utente.setdefault(riga['username'], []).append(riga['percorso'])
+
+        totale = 0
+        for utente, percorsi in per_utente.items():
+            try:
+                eliminati = nas_storage.delete_trees(utente, percorsi)
+            except Exception as e:
+                logger.error(f"Errore eliminazione dal cestino di {utente}: {type(e).__name__}: {e}")
+                continue
+            if not eliminati:
+                continue
+            try:
+                liberati = nas_indice.rimuovi(utente, eliminati)
+                nas_quote.registra_variazione(utente, -liberati)
+            except Exception as e:
+                # Indice e contatore vengono riallineati dal crawler
+                logger.error(f"Errore aggiornamento indice dopo eliminazione per {utente}: {e}")
+            _pulisci_percorsi(cursor, utente, eliminati)
+            conn.commit()
+            totale += len(eliminati)
+            metriche.CESTINO_ELEMENTI.inc(len(eliminati))
+            logger.info(f"Cestino {utente}: {len(eliminati)} elementi eliminati definitivamente")
+        return totale
+    finally:
+        cursor.close()
+        conn.close()
+        metriche.CESTINO_ELIMINAZIONI.inc(1, 'scaduti' if scaduti else 'manuale')
+        metriche.CESTINO_DURATA.osserva(time.perf_counter() - inizio)
+
+
+def elimina_scaduti():
+    """Elimina definitivamente gli elementi nel cestino da piu di GIORNI_CONSERVAZIONE giorni."""
+    return elimina_definitivamente(scaduti=True)
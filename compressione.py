@@ -0,0 +1,127 @@
+"""
+Compressione delle risposte HTTP.
+
+- Risposte dinamiche (HTML, JSON, CSS, ...) compresse con brotli o gzip in base
+  all'header Accept-Encoding del client, solo sopra una soglia minima.
+- Asset statici serviti dalle copie precompresse .br/.gz generate all'avvio,
+  senza costo di CPU per richiesta.
+
+Non vengono toccate le risposte gia compresse, quelle in streaming e quelle
+servite con send_file (download dal NAS, immagini, ...).
+"""
+import gzip
+import logging
+import mimetypes
+import os
+from flask import request, send_file
+from config import Config
+
+try:
+    import brotli
+except ImportError:  # Brotli opzionale: senza il modulo si usa solo gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MIMETYPE_COMPRIMIBILI = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml',
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+}
+
+# Estensione del file precompresso per ogni Content-Encoding
+ESTENSIONI = {'br': '.br', 'gzip': '.gz'}
+
+# filename (relativo a static/) -> codifiche con copia precompressa disponibile
+_precompressi = {}
+
+
+def _codifiche_supportate():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def _comprimi(data, codifica, statico=False):
+    if codifica == 'br':
+        livello = 11 if statico else Config.COMPRESSIONE_LIVELLO_BROTLI
+        return brotli.compress(data, quality=livello)
+    livello = 9 if statico else Config.COMPRESSIONE_LIVELLO_GZIP
+    return gzip.compress(data, compresslevel=livello, mtime=0)
+
+
+def _is_comprimibile(filename):
+    # guess_type('style.css.gz') e ('text/css', 'gzip'): le copie precompresse non vanno ricompresse
+    mimetype, codifica = mimetypes.guess_type(filename)
+    if codifica is not None or filename.endswith(tuple(ESTENSIONI.values())):
+        return False
+    return mimetype in MIMETYPE_COMPRIMIBILI
+
+
+def precomprimi_statici(static_folder):
+    """Genera le copie .gz/.br degli asset statici comprimibili, se mancanti o vecchie."""
+    _precompressi.clear()
+    for root, dirs, files in os.walk(static_folder):
+        # Gli upload sono immagini: gia compresse
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != Config.UPLOAD_FOLDER]
+        for name in files:
+            if not _is_comprimibile(name):
+                continue
+            path = os.path.join(root, name)
+            if os.path.getsize(path) < Config.COMPRESSIONE_SOGLIA_MINIMA:
+                continue
+            rel_path = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            data = None
+            for codifica in _codifiche_supportate():
+                dest = path + ESTENSIONI[codifica]
+                try:
+                    if not os.path.exists(dest) or os.path.getmtime(dest) < os.path.getmtime(path):
+                        if data is None:
+                            with open(path, 'rb') as f:
+                                data = f.read()
+                        with open(dest, 'wb') as f:
+                            f.write(_comprimi(data, codifica, statico=True))
+                    _precompressi.setdefault(rel_path, []).append(codifica)
+                except OSError as e:
+                    logger.warning(f"Impossibile precomprimere {rel_path} ({codifica}): {e}")
+    logger.info(f"Asset statici precompressi: {len(_precompressi)} file")
+
+
+def init_app(app):
+    """Registra la compressione delle risposte e il servizio degli asset precompressi."""
+    precomprimi_statici(app.static_folder)
+
+    @app.before_request
+    def _servi_precompresso():
+        if request.endpoint != 'static':
+            return None
+        filename = (request.view_args or {}).get('filename', '')
+        disponibili = _precompressi.get(filename)
+        if not disponibili:
+            return None
+        codifica = request.accept_encodings.best_match(disponibili)
+        if not codifica:
+            return None
+        path = os.path.join(app.static_folder, filename + ESTENSIONI[codifica])
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+        response.headers['Content-Encoding'] = codifica
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @app.after_request
+    def _comprimi_risposta(response):
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        if response.status_code < 200 or response.status_code >= 300 or response.status_code == 204:
+            return response
+        if 'Content-Encoding' in response.headers or response.mimetype not in MIMETYPE_COMPRIMIBILI:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        codifica = request.accept_encodings.best_match(_codifiche_supportate())
+        if not codifica:
+            return response
+        data = response.get_data()
+        if len(data) < Config.COMPRESSIONE_SOGLIA_MINIMA:
+            return response
+
+        response.set_data(_comprimi(data, codifica))
+        response.headers['Content-Encoding'] = codifica
+        return response
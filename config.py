@@ -9,10 +9,64 @@ class Config:
     MYSQL_PASSWORD = os.environ.get('MYSQL_PASSWORD') or 'tuapassword'
     MYSQL_DB = os.environ.get('MYSQL_DB') or 'maquetaweb'
 
+    # Strumentazione SQL per richiesta (disattivata di default: ogni query paga la ricerca del
+    # chiamante): header Server-Timing per gli admin e segnalazione nel log delle query con
+    # la stessa forma ripetute almeno SQL_N_PIU_1_SOGLIA volte (candidate N+1)
+    SQL_STRUMENTAZIONE = os.environ.get('SQL_STRUMENTAZIONE') == '1'
+    # Server-Timing anche per visitatori e utenti non admin (solo per i load test)
+    SQL_SERVER_TIMING_TUTTI = os.environ.get('SQL_SERVER_TIMING_TUTTI') == '1'
+    SQL_N_PIU_1_SOGLIA = int(os.environ.get('SQL_N_PIU_1_SOGLIA') or 5)
+    # Ripetizioni oltre cui la richiesta fallisce con QueryRipetute (0 = mai; per i test)
+    SQL_N_PIU_1_LIMITE = int(os.environ.get('SQL_N_PIU_1_LIMITE') or 0)
+    # Pannello con le query della richiesta in fondo alle pagine HTML, visibile agli admin
+    SQL_PANNELLO = os.environ.get('SQL_PANNELLO') == '1'
+    # Query lente: durata in ms oltre cui una query viene registrata con il suo EXPLAIN (0 = disattivato)
+    SQL_LENTE_SOGLIA_MS = int(os.environ.get('SQL_LENTE_SOGLIA_MS') or 200)
+    SQL_LENTE_EXPLAIN_SECONDI = 3600  # intervallo minimo tra due EXPLAIN della stessa query per processo
+
+    # Metriche Prometheus su /metrics (per processo). L'endpoint e attivo solo se e impostato
+    # METRICHE_TOKEN e la lettura richiede l'header "Authorization: Bearer <token>"
+    METRICHE = (os.environ.get('METRICHE') or '1') == '1'
+    METRICHE_TOKEN = os.environ.get('METRICHE_TOKEN') or ''
+
+    # Profiler a campionamento: gli admin profilano una richiesta con l'header "X-Profilo: 1"
+    # o "?_profilo=1"; gli endpoint in PROFILER_ENDPOINT (separati da virgole) sono profilati
+    # sempre, o solo in una frazione PROFILER_FRAZIONE delle richieste
+    PROFILER = (os.environ.get('PROFILER') or '1') == '1'
+    PROFILER_ENDPOINT = {e.strip() for e in (os.environ.get('PROFILER_ENDPOINT') or '').split(',') if e.strip()}
+    PROFILER_FRAZIONE = float(os.environ.get('PROFILER_FRAZIONE') or 1)
+    PROFILER_INTERVALLO_MS = float(os.environ.get('PROFILER_INTERVALLO_MS') or 5)
+    PROFILER_MAX = int(os.environ.get('PROFILER_MAX') or 20)  # profili tenuti in memoria per processo
+    PROFILER_CAMPIONI_MAX = 20000  # campioni per profilo (richieste molto lunghe o in streaming)
+
+    # Importazione massiva del catalogo: righe scritte per transazione
+    IMPORTAZIONE_BLOCCO = int(os.environ.get('IMPORTAZIONE_BLOCCO') or 2000)
+
+    # Esportazione del catalogo in streaming: righe lette dal cursore per volta e secondi
+    # concessi al server MySQL per inviare le righe a un client lento (net_write_timeout)
+    ESPORTAZIONE_BLOCCO = int(os.environ.get('ESPORTAZIONE_BLOCCO') or 1000)
+    ESPORTAZIONE_TIMEOUT = int(os.environ.get('ESPORTAZIONE_TIMEOUT') or 600)
+
     # Configurazione Upload
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    # Secondi in cui un upload appena salvato non viene eliminato anche se non ancora referenziato
+    UPLOAD_GC_GRAZIA = int(os.environ.get('UPLOAD_GC_GRAZIA') or 3600)
+
+    # Configurazione varianti immagini (ridimensionate per le landing page)
+    # Larghezza massima in pixel per ogni variante
+    IMMAGINI_VARIANTI = {'thumb': 320, 'card': 640, 'hero': 1600}
+    # Formati generati: il primo e quello usato nei srcset (aggiungere 'avif' se supportato da Pillow)
+    IMMAGINI_FORMATI = ['webp']
+    IMMAGINI_QUALITA = int(os.environ.get('IMMAGINI_QUALITA') or 80)
+    IMMAGINI_WORKERS = int(os.environ.get('IMMAGINI_WORKERS') or 2)
+    IMMAGINI_VARIANTI_FOLDER = os.path.join(UPLOAD_FOLDER, 'varianti')
+
+    # Configurazione compressione risposte (gzip/brotli)
+    COMPRESSIONE_LIVELLO_GZIP = int(os.environ.get('COMPRESSIONE_LIVELLO_GZIP') or 6)
+    COMPRESSIONE_LIVELLO_BROTLI = int(os.environ.get('COMPRESSIONE_LIVELLO_BROTLI') or 5)
+    COMPRESSIONE_SOGLIA_MINIMA = int(os.environ.get('COMPRESSIONE_SOGLIA_MINIMA') or 1024)  # bytes
 
     # Configurazione NAS (SFTP)
     NAS_HOST = os.environ.get('NAS_HOST') or '93.49.81.244'
@@ -20,3 +74,47 @@ class Config:
     NAS_USER = os.environ.get('NAS_USER') or 'Blackdog'
     NAS_PASSWORD = os.environ.get('NAS_PASSWORD') or '$MqtServ2025'
     NAS_BASE_PATH = os.environ.get('NAS_BASE_PATH') or 'applicazione/MaquetaFiles'
+
+    # Intervallo in secondi tra due passate del crawler dell'indice NAS (0 = disattivato)
+    NAS_INDICE_INTERVALLO = int(os.environ.get('NAS_INDICE_INTERVALLO') or 900)
+    # Ogni quante passate il crawler rilegge tutte le cartelle, anche quelle con mtime invariato
+    NAS_INDICE_COMPLETA_OGNI = int(os.environ.get('NAS_INDICE_COMPLETA_OGNI') or 24)
+
+    # Elenchi di cartella: voci per pagina e cache in memoria (per processo) degli elenchi letti dal NAS
+    NAS_ELENCO_PAGINA = int(os.environ.get('NAS_ELENCO_PAGINA') or 100)
+    NAS_ELENCO_CACHE_SECONDI = int(os.environ.get('NAS_ELENCO_CACHE_SECONDI') or 60)
+    NAS_ELENCO_CACHE_MAX = 64  # cartelle tenute in cache
+
+    # Download cartelle come ZIP: canali SFTP paralleli e dimensione delle letture
+    NAS_ZIP_CANALI = int(os.environ.get('NAS_ZIP_CANALI') or 4)
+    NAS_ZIP_CHUNK = 256 * 1024  # bytes per blocco letto
+    NAS_ZIP_FINESTRA = 8  # blocchi richiesti in pipeline per ogni lettura
+
+    # Copia/eliminazione ricorsiva di cartelle: canali SFTP paralleli sulla stessa connessione
+    NAS_ALBERO_CANALI = int(os.environ.get('NAS_ALBERO_CANALI') or 4)
+
+    # Upload delta: i file da almeno NAS_DELTA_MINIMO bytes gia presenti sul NAS vengono
+    # aggiornati inviando solo i blocchi di NAS_DELTA_BLOCCO bytes modificati
+    NAS_DELTA_BLOCCO = 1024 * 1024
+    NAS_DELTA_MINIMO = int(os.environ.get('NAS_DELTA_MINIMO') or 16 * 1024 * 1024)
+
+    # Coda delle operazioni NAS: worker per processo (0 = nessun worker in questo processo),
+    # secondi tra due controlli della coda, secondi senza battito dopo cui un'operazione e interrotta
+    NAS_OPERAZIONI_WORKERS = int(os.environ.get('NAS_OPERAZIONI_WORKERS') or 2)
+    NAS_OPERAZIONI_INTERVALLO = 2
+    NAS_OPERAZIONI_TIMEOUT = 120
+    # File ricevuti in attesa di essere caricati sul NAS
+    NAS_OPERAZIONI_FOLDER = os.environ.get('NAS_OPERAZIONI_FOLDER') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'cache', 'operazioni')
+
+    # Anteprime dei file NAS (miniature, forme d'onda, proxy audio) in cache locale
+    ANTEPRIME_FOLDER = os.environ.get('ANTEPRIME_FOLDER') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'cache', 'anteprime')
+    ANTEPRIME_WORKERS = int(os.environ.get('ANTEPRIME_WORKERS') or 2)
+    ANTEPRIME_ATTESA = 5  # secondi di attesa della generazione prima di rispondere 202
+    ANTEPRIME_CACHE_GIORNI = int(os.environ.get('ANTEPRIME_CACHE_GIORNI') or 30)  # anteprime non usate da piu giorni vengono eliminate
+    ANTEPRIME_MINIATURA = 320  # lato massimo in pixel
+    ANTEPRIME_PICCHI = 800  # numero di coppie min/max della forma d'onda
+    ANTEPRIME_PROXY_BITRATE = os.environ.get('ANTEPRIME_PROXY_BITRATE') or '96k'
+    # Eseguibile ffmpeg per flac/mp3 e proxy audio (senza, solo miniature e forme d'onda wav)
+    FFMPEG = os.environ.get('FFMPEG') or 'ffmpeg'
@@ -1,321 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
 import pymysql
 from config import Config
+import metriche
+
+logger = logging.getLogger(__name__)
+
+# Query registrate nel thread corrente (strumentazione SQL per richiesta)
+_registrazione = threading.local()
+
+# Query lente: impronta -> istante dell'ultimo EXPLAIN eseguito da questo processo
+_lente_explain = {}
+_lente_lock = threading.Lock()
+
+_CARTELLA_PYMYSQL = os.path.dirname(pymysql.__file__)
+
+_RE_STRINGHE = re.compile(r"'(?:[^'\\]|\\.)*'")
+_RE_NUMERI = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_LISTE = re.compile(r"\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)")
+_RE_SPAZI = re.compile(r"\s+")
+_RE_SPIEGABILE = re.compile(r"\s*\(?\s*(SELECT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+_RE_ISTRUZIONE = re.compile(r"\s*\(?\s*([A-Za-z]+)")
+
+
+class CursoreStrumentato(pymysql.cursors.DictCursor):
+    """DictCursor che registra le query eseguite mentre una registrazione e attiva nel thread."""
+
+    def execute(self, query, args=None):
+        registrate = getattr(_registrazione, 'query', None)
+        soglia = Config.SQL_LENTE_SOGLIA_MS
+        if registrate is None and not soglia and not Config.METRICHE:
+            return super().execute(query, args)
+        inizio = time.perf_counter()
+        chiamante = None
+        try:
+            risultato = super().execute(query, args)
+        finally:
+            durata = time.perf_counter() - inizio
+            if registrate is not None:
+                chiamante = _chiamante()
+                registrate.append({'sql': query, 'durata': durata, 'righe': self.rowcount, 'chiamante': chiamante})
+            istruzione = _RE_ISTRUZIONE.match(query)
+            metriche.DB_QUERY_DURATA.osserva(durata, istruzione.group(1).upper() if istruzione else 'ALTRO')
+        if soglia and durata * 1000 >= soglia and not getattr(_registrazione, 'lenta', False):
+            _registra_query_lenta(self.connection, query, args, durata, chiamante or _chiamante())
+        return risultato
+
+
+class ConnessioneMisurata(pymysql.connections.Connection):
+    """Connessione che tiene aggiornato l'indicatore delle connessioni aperte."""
+
+    def close(self):
+        aperta = self.open
+        try:
+            super().close()
+        finally:
+            if aperta:
+                metriche.DB_CONNESSIONI_APERTE.dec()
+
+
+def _chiamante():
+    """File, riga e funzione del codice applicativo che ha eseguito la query."""
+    frame = sys._getframe(2)
+    while frame and (frame.f_code.co_filename == __file__ or frame.f_code.co_filename.startswith(_CARTELLA_PYMYSQL)):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def _forma_parametri(args):
+    """Tipi dei parametri di una query, con le ripetizioni consecutive compresse (es. "(str, int x120)")."""
+    if args is None:
+        return ''
+    if isinstance(args, dict):
+        return '{' + ', '.join(f"{k}: {type(v).__name__}" for k, v in args.items()) + '}'
+    if not isinstance(args, (list, tuple)):
+        return type(args).__name__
+    gruppi = []
+    for valore in args:
+        tipo = type(valore).__name__
+        if gruppi and gruppi[-1][0] == tipo:
+            gruppi[-1][1] += 1
+        else:
+            gruppi.append([tipo, 1])
+    return '(' + ', '.join(tipo if n == 1 else f"{tipo} x{n}" for tipo, n in gruppi) + ')'
+
+
+def _explain_scaduto(impronta):
+    """True se per questa impronta va eseguito un nuovo EXPLAIN (al massimo uno ogni SQL_LENTE_EXPLAIN_SECONDI)."""
+    adesso = time.monotonic()
+    with _lente_lock:
+        ultimo = _lente_explain.get(impronta)
+        if ultimo is not None and adesso - ultimo < Config.SQL_LENTE_EXPLAIN_SECONDI:
+            return False
+        _lente_explain[impronta] = adesso
+        return True
+
+
+def _registra_query_lenta(connessione, query, args, durata, chiamante):
+    """Registra una query oltre SQL_LENTE_SOGLIA_MS nel log e, aggregata per forma, in query_lente.
+
+    Per SELECT/UPDATE/DELETE viene salvato anche il piano di esecuzione (EXPLAIN
+    non esegue la query), ottenuto sulla stessa connessione con gli stessi parametri.
+    Errori qui non fanno mai fallire la query originale.
+    """
+    forma = forma_query(query)
+    impronta = hashlib.sha1(forma.encode('utf-8')).hexdigest()
+    parametri = _forma_parametri(args)
+    logger.warning(f"Query lenta ({durata * 1000:.0f} ms) da {chiamante}: {forma[:500]} {parametri}")
+    _registrazione.lenta = True
+    try:
+        piano = None
+        if _RE_SPIEGABILE.match(query) and _explain_scaduto(impronta):
+            cursor = connessione.cursor(pymysql.cursors.DictCursor)
+            try:
+                cursor.execute('EXPLAIN ' + query, args)
+                piano = json.dumps(cursor.fetchall(), default=str)
+            finally:
+                cursor.close()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO query_lente (impronta, forma, parametri, chiamante, esecuzioni,
+                                     durata_totale_ms, durata_max_ms, piano)
+            VALUES (%s, %s, %s, %s, 1, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE esecuzioni = esecuzioni + 1,
+                durata_totale_ms = durata_totale_ms + VALUES(durata_totale_ms),
+                durata_max_ms = GREATEST(durata_max_ms, VALUES(durata_max_ms)),
+                parametri = VALUES(parametri), chiamante = VALUES(chiamante),
+                piano = COALESCE(VALUES(piano), piano), data_ultima = CURRENT_TIMESTAMP
+        ''', (impronta, forma, parametri[:500], (chiamante or '')[:255], durata * 1000, durata * 1000, piano))
+        conn.commit()
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Errore registrazione query lenta: {type(e).__name__}: {e}")
+    finally:
+        _registrazione.lenta = False
+
+
+def inizia_registrazione():
+    """Inizia a registrare le query eseguite dal thread corrente."""
+    _registrazione.query = []
+
+
+def termina_registrazione():
+    """Smette di registrare e restituisce le query registrate (None se non era attiva).
+
+    Ogni query e un dict con sql, durata (secondi), righe e chiamante.
+    """
+    registrate = getattr(_registrazione, 'query', None)
+    _registrazione.query = None
+    return registrate
+
+
+def forma_query(sql):
+    """Forma di una query: valori letterali e liste di parametri sostituiti, spazi normalizzati."""
+    forma = _RE_STRINGHE.sub('?', sql)
+    forma = _RE_NUMERI.sub('?', forma)
+    forma = _RE_LISTE.sub('(...)', forma)
+    return _RE_SPAZI.sub(' ', forma).strip()
+
+
+def query_ripetute(registrate, soglia):
+    """Forme di query eseguite almeno soglia volte nella stessa registrazione (candidate N+1).
+
+    Returns:
+        lista di dict (forma, volte, durata, chiamanti), dalla piu ripetuta
+    """
+    gruppi = {}
+    for query in registrate:
+        forma = forma_query(query['sql'])
+        gruppo = gruppi.setdefault(forma, {'forma': forma, 'volte': 0, 'durata': 0.0, 'chiamanti': set()})
+        gruppo['volte'] += 1
+        gruppo['durata'] += query['durata']
+        if query['chiamante']:
+            gruppo['chiamanti'].add(query['chiamante'])
+    ripetute = [dict(g, chiamanti=sorted(g['chiamanti'])) for g in gruppi.values() if g['volte'] >= soglia]
+    return sorted(ripetute, key=lambda g: g['volte'], reverse=True)
+
 
 def get_db_connection():
     """Crea e restituisce una connessione al database MySQL."""
-    return pymysql.connect(
+    strumentata = Config.SQL_STRUMENTAZIONE or Config.SQL_LENTE_SOGLIA_MS or Config.METRICHE
+    inizio = time.perf_counter()
+    conn = (ConnessioneMisurata if Config.METRICHE else pymysql.connections.Connection)(
         host=Config.MYSQL_HOST,
         user=Config.MYSQL_USER,
         password=Config.MYSQL_PASSWORD,
         database=Config.MYSQL_DB,
         charset='utf8mb4',
-        cursorclass=pymysql.cursors.DictCursor
+        cursorclass=CursoreStrumentato if strumentata else pymysql.cursors.DictCursor
     )
-
-def init_database():
-    """Inizializza il database creando le tabelle necessarie."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Tabella utenti
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS utenti (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            username VARCHAR(50) NOT NULL UNIQUE,
-            password_hash VARCHAR(255) NOT NULL,
-            nome VARCHAR(100) NOT NULL,
-            cognome VARCHAR(100) NOT NULL,
-            email VARCHAR(100) UNIQUE,
-            is_admin BOOLEAN DEFAULT FALSE,
-            attivo BOOLEAN DEFAULT TRUE,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            ultimo_accesso DATETIME NULL,
-            artista_id INT NULL
-        )
-    ''')
-
-    # Tabella menu
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS menu (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            nome VARCHAR(100) NOT NULL,
-            icona VARCHAR(50) DEFAULT 'bi-circle',
-            url VARCHAR(200) NOT NULL,
-            ordine INT DEFAULT 0,
-            parent_id INT NULL,
-            attivo BOOLEAN DEFAULT TRUE,
-            FOREIGN KEY (parent_id) REFERENCES menu(id) ON DELETE SET NULL
-        )
-    ''')
-
-    # Tabella permessi (semplificata: se esiste il record, l'utente può vedere il menu)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS permessi (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            utente_id INT NOT NULL,
-            menu_id INT NOT NULL,
-            FOREIGN KEY (utente_id) REFERENCES utenti(id) ON DELETE CASCADE,
-            FOREIGN KEY (menu_id) REFERENCES menu(id) ON DELETE CASCADE,
-            UNIQUE KEY unique_permesso (utente_id, menu_id)
-        )
-    ''')
-
-    # Tabella categorie servizi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categorie_servizi (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            nome VARCHAR(150) NOT NULL,
-            descrizione VARCHAR(300),
-            icona VARCHAR(50) DEFAULT 'bi-folder',
-            ordine INT DEFAULT 0,
-            attivo BOOLEAN DEFAULT TRUE,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella servizi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS servizi (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            nome VARCHAR(150) NOT NULL,
-            descrizione TEXT,
-            descrizione_breve VARCHAR(300),
-            foto VARCHAR(500),
-            icona VARCHAR(50) DEFAULT 'bi-gear',
-            prezzo DECIMAL(10,2) NULL,
-            durata VARCHAR(50) NULL,
-            attivo BOOLEAN DEFAULT TRUE,
-            in_evidenza BOOLEAN DEFAULT FALSE,
-            ordine INT DEFAULT 0,
-            categoria_id INT NULL,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (categoria_id) REFERENCES categorie_servizi(id) ON DELETE SET NULL
-        )
-    ''')
-
-    # Tabella news
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS news (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            titolo VARCHAR(255) NOT NULL,
-            slug VARCHAR(255) UNIQUE,
-            contenuto TEXT,
-            estratto VARCHAR(500),
-            immagine VARCHAR(500),
-            autore_id INT,
-            categoria VARCHAR(100),
-            tags VARCHAR(255),
-            pubblicato BOOLEAN DEFAULT FALSE,
-            in_evidenza BOOLEAN DEFAULT FALSE,
-            data_pubblicazione DATETIME NULL,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            visualizzazioni INT DEFAULT 0,
-            FOREIGN KEY (autore_id) REFERENCES utenti(id) ON DELETE SET NULL
-        )
-    ''')
-
-    # Tabella artisti
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS artisti (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            nome VARCHAR(150) NOT NULL,
-            nome_arte VARCHAR(150),
-            slug VARCHAR(200) UNIQUE,
-            bio TEXT,
-            foto VARCHAR(500),
-            foto_copertina VARCHAR(500),
-            is_band BOOLEAN DEFAULT FALSE,
-            instagram VARCHAR(255),
-            facebook VARCHAR(255),
-            twitter VARCHAR(255),
-            spotify VARCHAR(255),
-            youtube VARCHAR(255),
-            apple_music VARCHAR(255),
-            website VARCHAR(255),
-            email VARCHAR(255),
-            genere VARCHAR(100),
-            anno_fondazione INT,
-            paese VARCHAR(100),
-            citta VARCHAR(100),
-            attivo BOOLEAN DEFAULT TRUE,
-            in_evidenza BOOLEAN DEFAULT FALSE,
-            ordine INT DEFAULT 0,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            INDEX idx_artisti_slug (slug),
-            INDEX idx_artisti_attivo (attivo),
-            INDEX idx_artisti_genere (genere)
-        )
-    ''')
-
-    # Tabella membri band
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS membri_band (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            artista_id INT NOT NULL,
-            nome VARCHAR(100) NOT NULL,
-            cognome VARCHAR(100),
-            nome_arte VARCHAR(150),
-            ruolo VARCHAR(100) NOT NULL,
-            foto VARCHAR(500),
-            bio_breve TEXT,
-            attivo BOOLEAN DEFAULT TRUE,
-            data_ingresso DATE,
-            data_uscita DATE,
-            ordine INT DEFAULT 0,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
-            INDEX idx_membri_artista (artista_id),
-            INDEX idx_membri_attivo (attivo)
-        )
-    ''')
-
-    # Tabella dischi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS dischi (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            artista_id INT NOT NULL,
-            titolo VARCHAR(255) NOT NULL,
-            slug VARCHAR(255),
-            tipo ENUM('album', 'ep', 'singolo', 'compilation', 'live', 'remix') DEFAULT 'album',
-            copertina VARCHAR(500),
-            anno_uscita INT,
-            data_uscita DATE,
-            etichetta VARCHAR(150),
-            formato VARCHAR(100),
-            descrizione TEXT,
-            link_spotify VARCHAR(500),
-            link_apple_music VARCHAR(500),
-            link_youtube_music VARCHAR(500),
-            link_amazon_music VARCHAR(500),
-            link_deezer VARCHAR(500),
-            link_tidal VARCHAR(500),
-            link_acquisto VARCHAR(500),
-            pubblicato BOOLEAN DEFAULT FALSE,
-            in_evidenza BOOLEAN DEFAULT FALSE,
-            ordine INT DEFAULT 0,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
-            INDEX idx_dischi_artista (artista_id),
-            INDEX idx_dischi_slug (slug),
-            INDEX idx_dischi_tipo (tipo),
-            INDEX idx_dischi_anno (anno_uscita),
-            INDEX idx_dischi_pubblicato (pubblicato)
-        )
-    ''')
-
-    # Tabella brani
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS brani (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            disco_id INT,
-            artista_id INT NOT NULL,
-            titolo VARCHAR(255) NOT NULL,
-            slug VARCHAR(255),
-            durata VARCHAR(10),
-            numero_traccia INT,
-            featuring VARCHAR(255),
-            produttore VARCHAR(255),
-            autori VARCHAR(500),
-            genere VARCHAR(100),
-            anno INT,
-            isrc VARCHAR(20),
-            link_spotify VARCHAR(500),
-            link_apple_music VARCHAR(500),
-            link_youtube VARCHAR(500),
-            link_youtube_music VARCHAR(500),
-            link_soundcloud VARCHAR(500),
-            link_altro VARCHAR(500),
-            testo TEXT,
-            video_ufficiale VARCHAR(500),
-            pubblicato BOOLEAN DEFAULT FALSE,
-            is_singolo BOOLEAN DEFAULT FALSE,
-            data_uscita DATE,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            FOREIGN KEY (disco_id) REFERENCES dischi(id) ON DELETE SET NULL,
-            FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
-            INDEX idx_brani_disco (disco_id),
-            INDEX idx_brani_artista (artista_id),
-            INDEX idx_brani_pubblicato (pubblicato),
-            INDEX idx_brani_numero (numero_traccia)
-        )
-    ''')
-
-    # Tabella eventi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS eventi (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            artista_id INT NOT NULL,
-            titolo VARCHAR(255) NOT NULL,
-            slug VARCHAR(255),
-            tipo ENUM('concerto', 'festival', 'showcase', 'dj_set', 'live_session', 'altro') DEFAULT 'concerto',
-            descrizione TEXT,
-            immagine VARCHAR(500),
-            data_evento DATE NOT NULL,
-            ora_inizio TIME,
-            ora_fine TIME,
-            venue VARCHAR(200),
-            citta VARCHAR(100) NOT NULL,
-            paese VARCHAR(100) DEFAULT 'Italia',
-            indirizzo VARCHAR(300),
-            coordinate_gps VARCHAR(50),
-            link_biglietti VARCHAR(500),
-            prezzo_da DECIMAL(10,2),
-            prezzo_a DECIMAL(10,2),
-            sold_out BOOLEAN DEFAULT FALSE,
-            stato ENUM('programmato', 'confermato', 'annullato', 'posticipato', 'concluso') DEFAULT 'programmato',
-            pubblicato BOOLEAN DEFAULT FALSE,
-            in_evidenza BOOLEAN DEFAULT FALSE,
-            data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
-            INDEX idx_eventi_artista (artista_id),
-            INDEX idx_eventi_data (data_evento),
-            INDEX idx_eventi_stato (stato),
-            INDEX idx_eventi_citta (citta),
-            INDEX idx_eventi_pubblicato (pubblicato)
-        )
-    ''')
-
-    # Tabella file nascosti (per nascondere file agli artisti)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS file_nascosti (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            username VARCHAR(255) NOT NULL,
-            percorso VARCHAR(1000) NOT NULL,
-            nascosto_da INT NOT NULL,
-            data_nascosto DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE KEY unique_file (username, percorso(255))
-        )
-    ''')
-
-    # Tabella cestino file (eliminazione logica, auto-purge dopo 30 giorni)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS file_cestino (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            username VARCHAR(255) NOT NULL,
-            percorso VARCHAR(1000) NOT NULL,
-            eliminato_da INT NOT NULL,
-            data_eliminazione DATETIME DEFAULT CURRENT_TIMESTAMP,
-            INDEX idx_cestino_username (username),
-            INDEX idx_cestino_data (data_eliminazione)
-        )
-    ''')
-
-    # Migrazioni per database esistenti
-    migrations = [
-        "ALTER TABLE utenti ADD COLUMN artista_id INT NULL",
-        "ALTER TABLE artisti ADD COLUMN email VARCHAR(255) AFTER website",
-    ]
-    for sql in migrations:
-        try:
-            cursor.execute(sql)
-        except Exception:
-            pass  # Colonna gia esistente
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    metriche.DB_CONNESSIONE_DURATA.osserva(time.perf_counter() - inizio)
+    metriche.DB_CONNESSIONI.inc()
+    metriche.DB_CONNESSIONI_APERTE.inc()
+    return conn
@@ -0,0 +1,169 @@
+"""
+Esportazione del catalogo (artisti, dischi, brani, eventi, news) in CSV, JSON o NDJSON.
+
+Le righe vengono lette con un cursore lato server (SSCursor, non
+bufferizzato, con righe come tuple) a blocchi di ESPORTAZIONE_BLOCCO e scritte direttamente nella
+risposta in streaming, eventualmente compressa con gzip: la memoria usata
+non dipende dalla dimensione della tabella.
+
+Le colonne esportabili sono elencate per ogni entita: oltre a quelle della
+tabella ci sono il nome dell'artista e il titolo del disco, cosi un export
+dei brani in CSV si puo reimportare con importazione.py.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import pymysql
+from config import Config
+from database import get_db_connection
+
+FORMATI = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+_LINK_DISCO = ['link_spotify', 'link_apple_music', 'link_youtube_music', 'link_amazon_music',
+               'link_deezer', 'link_tidal', 'link_acquisto']
+_LINK_BRANO = ['link_spotify', 'link_apple_music', 'link_youtube', 'link_youtube_music',
+               'link_soundcloud', 'link_altro']
+_DATE = ['data_creazione', 'data_modifica']
+
+
+def _colonne(alias, nomi, **calcolate):
+    """Colonne esportabili: nome -> espressione SQL, nell'ordine di esportazione."""
+    colonne = {nome: f'{alias}.{nome}' for nome in nomi}
+    colonne.update(calcolate)
+    return colonne
+
+
+# entita -> (FROM con eventuali JOIN, colonne esportabili, chiave di ordinamento)
+ENTITA = {
+    'artisti': ('artisti a', _colonne('a', [
+        'id', 'nome', 'nome_arte', 'slug', 'bio', 'foto', 'foto_copertina', 'is_band', 'genere',
+        'anno_fondazione', 'paese', 'citta', 'email', 'instagram', 'facebook', 'twitter', 'spotify',
+        'youtube', 'apple_music', 'website', 'attivo', 'in_evidenza', 'ordine'] + _DATE), 'a.id'),
+    'dischi': ('dischi d JOIN artisti a ON a.id = d.artista_id', _colonne('d', [
+        'id', 'artista_id', 'titolo', 'slug', 'tipo', 'copertina', 'anno_uscita', 'data_uscita',
+        'etichetta', 'formato', 'descrizione'] + _LINK_DISCO + ['pubblicato', 'in_evidenza', 'ordine'] + _DATE,
+        artista='COALESCE(a.nome_arte, a.nome)'), 'd.id'),
+    'brani': ('brani b JOIN artisti a ON a.id = b.artista_id LEFT JOIN dischi d ON d.id = b.disco_id', _colonne('b', [
+        'id', 'artista_id', 'disco_id', 'titolo', 'slug', 'durata', 'numero_traccia', 'featuring',
+        'produttore', 'autori', 'genere', 'anno', 'isrc'] + _LINK_BRANO + [
+        'testo', 'video_ufficiale', 'pubblicato', 'is_singolo', 'data_uscita'] + _DATE,
+        artista='COALESCE(a.nome_arte, a.nome)', disco='d.titolo'), 'b.id'),
+    'eventi': ('eventi e JOIN artisti a ON a.id = e.artista_id', _colonne('e', [
+        'id', 'artista_id', 'titolo', 'slug', 'tipo', 'descrizione', 'immagine', 'data_evento',
+        'ora_inizio', 'ora_fine', 'venue', 'citta', 'paese', 'indirizzo', 'coordinate_gps',
+        'link_biglietti', 'prezzo_da', 'prezzo_a', 'sold_out', 'stato', 'pubblicato', 'in_evidenza'] + _DATE,
+        artista='COALESCE(a.nome_arte, a.nome)'), 'e.id'),
+    'news': ('news n LEFT JOIN utenti u ON u.id = n.autore_id', _colonne('n', [
+        'id', 'titolo', 'slug', 'contenuto', 'estratto', 'immagine', 'autore_id', 'categoria', 'tags',
+        'pubblicato', 'in_evidenza', 'data_pubblicazione', 'visualizzazioni'] + _DATE,
+        autore='u.username'), 'n.id'),
+}
+
+
+def colonne_disponibili(entita):
+    return list(ENTITA[entita][1])
+
+
+def scegli_colonne(entita, richieste):
+    """Colonne da esportare: tutte se richieste e vuoto.
+
+    Raises:
+        ValueError: se una colonna richiesta non e esportabile per l'entita
+    """
+    disponibili = ENTITA[entita][1]
+    if not richieste:
+        return list(disponibili)
+    sconosciute = [c for c in richieste if c not in disponibili]
+    if sconosciute:
+        raise ValueError(f"Colonne non esportabili per {entita}: {', '.join(sconosciute)}")
+    return list(dict.fromkeys(richieste))
+
+
+def _valore(valore):
+    """Valore di una colonna MySQL in forma serializzabile (date ISO, TIME come H:MM:SS, DECIMAL come testo)."""
+    if isinstance(valore, (datetime, date)):
+        return valore.isoformat()
+    if isinstance(valore, timedelta):
+        secondi = int(valore.total_seconds())
+        return f"{secondi // 3600}:{secondi % 3600 // 60:02d}:{secondi % 60:02d}"
+    if isinstance(valore, Decimal):
+        return str(valore)
+    return valore
+
+
+def _righe(entita, colonne):
+    """Blocchi di righe (liste di valori) letti con un cursore non bufferizzato."""
+    tabelle, disponibili, ordine = ENTITA[entita]
+    sql = (f"SELECT {', '.join(f'{disponibili[c]} AS `{c}`' for c in colonne)} "
+           f"FROM {tabelle} ORDER BY {ordine}")
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        # Con un client lento il server resta in attesa di poter inviare le righe
+        cursor.execute('SET SESSION net_write_timeout = %s', (Config.ESPORTAZIONE_TIMEOUT,))
+        cursor.execute(sql)
+        while True:
+            blocco = cursor.fetchmany(Config.ESPORTAZIONE_BLOCCO)
+            if not blocco:
+                break
+            yield [[_valore(v) for v in riga] for riga in blocco]
+        cursor.close()
+    finally:
+        # Se il client si disconnette a meta chiudere la connessione evita di leggere le righe rimaste
+        conn.close()
+
+
+def _csv(colonne, blocchi):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(colonne)
+    for blocco in blocchi:
+        writer.writerows(blocco)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ndjson(colonne, blocchi):
+    for blocco in blocchi:
+        yield ''.join(json.dumps(dict(zip(colonne, riga)), ensure_ascii=False) + '\n' for riga in blocco)
+
+
+def _json(colonne, blocchi):
+    separatore = '['
+    for blocco in blocchi:
+        yield separatore + ','.join(json.dumps(dict(zip(colonne, riga)), ensure_ascii=False) for riga in blocco)
+        separatore = ','
+    yield ']' if separatore == ',' else '[]'
+
+
+def _gzip(parti):
+    compressore = zlib.compressobj(Config.COMPRESSIONE_LIVELLO_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for parte in parti:
+        dati = compressore.compress(parte)
+        if dati:
+            yield dati
+    yield compressore.flush()
+
+
+def esporta(entita, formato, colonne, comprimi=False):
+    """Contenuto dell'export come generatore di bytes, da restituire in una risposta in streaming.
+
+    La query parte alla prima iterazione, la connessione viene chiusa alla fine
+    o quando il generatore viene chiuso (client disconnesso).
+    """
+    serializza = {'csv': _csv, 'json': _json, 'ndjson': _ndjson}[formato]
+    parti = (testo.encode('utf-8') for testo in serializza(colonne, _righe(entita, colonne)))
+    return _gzip(parti) if comprimi else parti
+
+
+def nome_file(entita, formato, comprimi=False):
+    return f"{entita}-{date.today().isoformat()}.{formato}" + ('.gz' if comprimi else '')
@@ -0,0 +1,149 @@
+"""
+Pipeline immagini: genera le varianti ridimensionate (thumb, card, hero)
+delle immagini caricate in static/uploads, le salva su disco e le serve
+alle landing page tramite srcset.
+
+Le varianti vengono generate in background subito dopo l'upload oppure
+al primo accesso (lazy) se non ancora presenti.
+"""
+import os
+import glob
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow non installato: si servono sempre gli originali
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Mime type per i formati di output supportati
+MIMETYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_formati_cache = None
+
+
+def _get_executor():
+    """Restituisce il pool di worker per la generazione in background."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=Config.IMMAGINI_WORKERS,
+                    thread_name_prefix='immagini'
+                )
+    return _executor
+
+
+def pipeline_attiva():
+    """True se Pillow e disponibile e almeno un formato di output e supportato."""
+    return bool(formati_disponibili())
+
+
+def formati_disponibili():
+    """Restituisce i formati configurati che Pillow e in grado di scrivere."""
+    global _formati_cache
+    if _formati_cache is None:
+        if Image is None:
+            _formati_cache = []
+        else:
+            estensioni = Image.registered_extensions()
+            _formati_cache = [f for f in Config.IMMAGINI_FORMATI
+                              if f in MIMETYPES and f'.{f}' in estensioni]
+    return _formati_cache
+
+
+def nome_variante(filename, variante, formato):
+    """Nome del file di una variante, es. 'abc123-640.webp'.
+
+    La larghezza e parte del nome, quindi se cambia la configurazione
+    le nuove varianti non collidono con quelle gia in cache.
+    """
+    stem = filename.rsplit('.', 1)[0]
+    larghezza = Config.IMMAGINI_VARIANTI[variante]
+    return f"{stem}-{larghezza}.{formato}"
+
+
+def _percorso_originale(filename):
+    return os.path.join(Config.UPLOAD_FOLDER, filename)
+
+
+def _percorso_variante(filename, variante, formato):
+    return os.path.join(Config.IMMAGINI_VARIANTI_FOLDER, nome_variante(filename, variante, formato))
+
+
+def genera_variante(filename, variante, formato):
+    """Genera (se necessario) una variante e ne restituisce il percorso.
+
+    Returns:
+        percorso assoluto del file generato, o None se non e possibile generarlo
+    """
+    if variante not in Config.IMMAGINI_VARIANTI or formato not in formati_disponibili():
+        return None
+
+    destinazione = _percorso_variante(filename, variante, formato)
+    if os.path.exists(destinazione):
+        return destinazione
+
+    originale = _percorso_originale(filename)
+    if not os.path.exists(originale):
+        return None
+
+    larghezza = Config.IMMAGINI_VARIANTI[variante]
+    os.makedirs(Config.IMMAGINI_VARIANTI_FOLDER, exist_ok=True)
+    # Scrittura su file temporaneo + rename atomico: due richieste concorrenti
+    # per la stessa variante non lasciano mai un file scritto a meta
+    tmp = f"{destinazione}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(originale) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+            # Non ingrandisce mai: se l'originale e piu piccolo resta com'e
+            if img.width > larghezza:
+                altezza = round(img.height * larghezza / img.width)
+                img = img.resize((larghezza, altezza), Image.LANCZOS)
+            img.save(tmp, format=formato.upper(), quality=Config.IMMAGINI_QUALITA)
+        os.replace(tmp, destinazione)
+        return destinazione
+    except Exception as e:
+        logger.warning(f"Impossibile generare la variante {variante}/{formato} di {filename}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+
+
+def genera_varianti(filename):
+    """Genera tutte le varianti configurate per un'immagine."""
+    for variante in Config.IMMAGINI_VARIANTI:
+        for formato in formati_disponibili():
+            genera_variante(filename, variante, formato)
+
+
+def genera_varianti_async(filename):
+    """Accoda la generazione delle varianti al pool di worker."""
+    if filename and pipeline_attiva():
+        _get_executor().submit(genera_varianti, filename)
+
+
+def elimina_varianti(filename):
+    """Elimina dalla cache tutte le varianti di un'immagine."""
+    if not filename:
+        return
+    stem = filename.rsplit('.', 1)[0]
+    for path in glob.glob(os.path.join(Config.IMMAGINI_VARIANTI_FOLDER, f"{glob.escape(stem)}-*")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
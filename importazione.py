@@ -0,0 +1,473 @@
+"""
+Importazione massiva del catalogo: artisti, dischi e brani.
+
+Formati accettati:
+
+- CSV o NDJSON con una riga per brano: le colonne "artista" e "disco" sono
+  il nome dell'artista e il titolo del disco (vuoto per i brani senza
+  disco), le colonne "artista_<campo>" e "disco_<campo>" i loro altri campi
+  (usati quando l'artista o il disco vengono creati), tutte le altre i
+  campi del brano (titolo, numero_traccia, durata, isrc, ...);
+- JSON come manifest annidato sul modello DDEX:
+  {"artisti": [{"nome": ..., "dischi": [{"titolo": ..., "brani": [...]}], "brani": [...]}]}
+  oppure come lista di righe come quelle del CSV.
+
+Le righe sono validate mentre vengono lette: quelle non valide sono
+scartate e riportate, senza fermare l'importazione. Le righe valide sono
+scritte a blocchi di IMPORTAZIONE_BLOCCO, ognuno in una transazione:
+artisti e dischi mancanti e slug liberi sono risolti con una query per
+blocco, i nuovi record sono inseriti con executemany (INSERT multi-riga).
+Artisti e dischi esistenti sono riconosciuti per nome/titolo, i brani gia
+presenti per ISRC o per titolo nello stesso disco: reimportare lo stesso
+file non crea duplicati.
+
+Utilizzo da riga di comando:
+    python importazione.py catalogo.csv
+    python importazione.py catalogo.json --verifica   # solo validazione, nessuna scrittura
+"""
+import argparse
+import codecs
+import csv
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from datetime import date
+from config import Config
+from database import get_db_connection
+from models import Disco, genera_slug
+
+MESSAGGI_MAX = 200  # errori di validazione riportati (il conteggio include tutti)
+
+# Campi importabili: nome -> (tipo, lunghezza massima o valori ammessi)
+CAMPI_ARTISTA = {
+    'nome': ('testo', 150), 'nome_arte': ('testo', 150), 'bio': ('testo', None),
+    'is_band': ('booleano', None), 'genere': ('testo', 100), 'anno_fondazione': ('intero', None),
+    'paese': ('testo', 100), 'citta': ('testo', 100), 'email': ('testo', 255),
+    'instagram': ('testo', 255), 'facebook': ('testo', 255), 'twitter': ('testo', 255),
+    'spotify': ('testo', 255), 'youtube': ('testo', 255), 'apple_music': ('testo', 255),
+    'website': ('testo', 255), 'attivo': ('booleano', None),
+}
+CAMPI_DISCO = {
+    'titolo': ('testo', 255), 'tipo': ('scelta', set(Disco.TIPI)), 'anno_uscita': ('intero', None),
+    'data_uscita': ('data', None), 'etichetta': ('testo', 150), 'formato': ('testo', 100),
+    'descrizione': ('testo', None), 'link_spotify': ('testo', 500), 'link_apple_music': ('testo', 500),
+    'link_youtube_music': ('testo', 500), 'link_amazon_music': ('testo', 500), 'link_deezer': ('testo', 500),
+    'link_tidal': ('testo', 500), 'link_acquisto': ('testo', 500), 'pubblicato': ('booleano', None),
+}
+CAMPI_BRANO = {
+    'titolo': ('testo', 255), 'durata': ('durata', None), 'numero_traccia': ('intero', None),
+    'featuring': ('testo', 255), 'produttore': ('testo', 255), 'autori': ('testo', 500),
+    'genere': ('testo', 100), 'anno': ('intero', None), 'isrc': ('isrc', None),
+    'link_spotify': ('testo', 500), 'link_apple_music': ('testo', 500), 'link_youtube': ('testo', 500),
+    'link_youtube_music': ('testo', 500), 'link_soundcloud': ('testo', 500), 'link_altro': ('testo', 500),
+    'testo': ('testo', None), 'video_ufficiale': ('testo', 500), 'pubblicato': ('booleano', None),
+    'is_singolo': ('booleano', None), 'data_uscita': ('data', None),
+}
+# Valori di default dei campi non indicati (come nei form di creazione)
+DEFAULT_ARTISTA = {'is_band': False, 'attivo': True}
+DEFAULT_DISCO = {'tipo': 'album', 'pubblicato': False}
+DEFAULT_BRANO = {'pubblicato': False, 'is_singolo': False}
+
+_VERI = {'1', 'true', 'si', 'sì', 'yes', 'on', 'x'}
+_FALSI = {'0', 'false', 'no', 'off', ''}
+_RE_ISRC = re.compile(r"^[A-Z]{2}[A-Z0-9]{3}\d{7}$")
+_RE_DURATA = re.compile(r"^(?:(\d{1,2}):)?(\d{1,3}):([0-5]\d)$")
+
+
+class ErroreValidazione(ValueError):
+    """Valore non valido in una riga del catalogo."""
+
+
+# ============ LETTURA ============
+
+def _righe_piatte(righe):
+    """Da righe {colonna: valore} a record (artista, disco, brano)."""
+    for riga in righe:
+        artista, disco, brano = {}, {}, {}
+        for colonna, valore in riga.items():
+            colonna = (colonna or '').strip().lower()
+            if colonna == 'artista':
+                artista['nome'] = valore
+            elif colonna.startswith('artista_'):
+                artista[colonna[len('artista_'):]] = valore
+            elif colonna == 'disco':
+                disco['titolo'] = valore
+            elif colonna.startswith('disco_'):
+                disco[colonna[len('disco_'):]] = valore
+            elif colonna:
+                brano[colonna] = valore
+        yield artista, disco if _valorizzato(disco.get('titolo')) else None, brano
+
+
+def _manifest(dati):
+    """Da un manifest annidato a record (artista, disco, brano); brano None per dischi o artisti vuoti."""
+    for artista in dati.get('artisti', []):
+        campi = {k: v for k, v in artista.items() if k not in ('dischi', 'brani')}
+        vuoto = True
+        for disco in artista.get('dischi', []):
+            campi_disco = {k: v for k, v in disco.items() if k != 'brani'}
+            for brano in disco.get('brani', []):
+                vuoto = False
+                yield campi, campi_disco, brano
+            if not disco.get('brani'):
+                vuoto = False
+                yield campi, campi_disco, None
+        for brano in artista.get('brani', []):
+            vuoto = False
+            yield campi, None, brano
+        if vuoto:
+            yield campi, None, None
+
+
+def leggi(file_obj, formato):
+    """Record (artista, disco, brano) da un file binario nel formato indicato (csv, json, ndjson)."""
+    testo = codecs.getreader('utf-8-sig')(file_obj)
+    if formato == 'csv':
+        campione = testo.read(4096)
+        dialetto = csv.Sniffer().sniff(campione, delimiters=',;\t') if campione else csv.excel
+        yield from _righe_piatte(csv.DictReader(_concatena(campione, testo), dialect=dialetto))
+    elif formato == 'ndjson':
+        yield from _righe_piatte(json.loads(riga) for riga in testo if riga.strip())
+    elif formato == 'json':
+        dati = json.load(testo)
+        yield from _righe_piatte(dati) if isinstance(dati, list) else _manifest(dati)
+    else:
+        raise ValueError(f"Formato non supportato: {formato}")
+
+
+def _concatena(inizio, resto):
+    """Righe di testo di inizio (gia letto) seguito da resto, senza rileggere il file."""
+    righe = inizio.splitlines(keepends=True)
+    if righe and not righe[-1].endswith(('\n', '\r')):
+        righe[-1] += resto.readline()
+    yield from righe
+    yield from resto
+
+
+def formato_da_nome(nome):
+    estensione = os.path.splitext(nome or '')[1].lower().lstrip('.')
+    return {'jsonl': 'ndjson', 'tsv': 'csv', 'txt': 'csv'}.get(estensione, estensione)
+
+
+# ============ VALIDAZIONE ============
+
+def _valorizzato(valore):
+    return valore is not None and (not isinstance(valore, str) or valore.strip() != '')
+
+
+def _converti(valore, tipo, vincolo):
+    if isinstance(valore, str):
+        valore = valore.strip()
+    if tipo == 'testo':
+        valore = str(valore)
+        if vincolo and len(valore) > vincolo:
+            raise ErroreValidazione(f"piu lungo di {vincolo} caratteri")
+        return valore
+    if tipo == 'intero':
+        try:
+            return int(valore)
+        except (TypeError, ValueError):
+            raise ErroreValidazione(f"'{valore}' non e un numero intero")
+    if tipo == 'booleano':
+        if isinstance(valore, bool):
+            return valore
+        if str(valore).lower() in _VERI:
+            return True
+        if str(valore).lower() in _FALSI:
+            return False
+        raise ErroreValidazione(f"'{valore}' non e un valore si/no")
+    if tipo == 'data':
+        try:
+            return date.fromisoformat(str(valore))
+        except ValueError:
+            raise ErroreValidazione(f"'{valore}' non e una data AAAA-MM-GG")
+    if tipo == 'scelta':
+        valore = str(valore).lower()
+        if valore not in vincolo:
+            raise ErroreValidazione(f"'{valore}' non e tra {', '.join(sorted(vincolo))}")
+        return valore
+    if tipo == 'isrc':
+        valore = str(valore).replace('-', '').upper()
+        if not _RE_ISRC.match(valore):
+            raise ErroreValidazione(f"'{valore}' non e un ISRC valido")
+        return valore
+    if tipo == 'durata':
+        if isinstance(valore, int) or str(valore).isdigit():
+            secondi = int(valore)
+            ore, minuti = divmod(secondi // 60, 60)
+            return f"{ore}:{minuti:02d}:{secondi % 60:02d}" if ore else f"{minuti}:{secondi % 60:02d}"
+        if not _RE_DURATA.match(str(valore)):
+            raise ErroreValidazione(f"'{valore}' non e una durata m:ss")
+        return str(valore)
+    raise ValueError(tipo)
+
+
+def _valida(grezzi, campi, default, entita, obbligatorio):
+    valori = dict(default)
+    for campo, valore in grezzi.items():
+        if campo not in campi or not _valorizzato(valore):
+            continue
+        try:
+            valori[campo] = _converti(valore, *campi[campo])
+        except ErroreValidazione as e:
+            raise ErroreValidazione(f"{entita}.{campo}: {e}")
+    if not valori.get(obbligatorio):
+        raise ErroreValidazione(f"{entita}.{obbligatorio} mancante")
+    return valori
+
+
+def valida(artista, disco, brano):
+    """Record validato (artista, disco, brano) con i valori convertiti.
+
+    Raises:
+        ErroreValidazione: se un campo non e valido o manca un campo obbligatorio
+    """
+    if not _valorizzato(artista.get('nome')) and _valorizzato(artista.get('nome_arte')):
+        artista = dict(artista, nome=artista['nome_arte'])
+    return (
+        _valida(artista, CAMPI_ARTISTA, DEFAULT_ARTISTA, 'artista', 'nome'),
+        _valida(disco, CAMPI_DISCO, DEFAULT_DISCO, 'disco', 'titolo') if disco is not None else None,
+        _valida(brano, CAMPI_BRANO, DEFAULT_BRANO, 'brano', 'titolo') if brano is not None else None,
+    )
+
+
+def _chiave_artista(artista):
+    return (artista.get('nome_arte') or artista['nome']).strip().lower()
+
+
+# ============ SCRITTURA ============
+
+class _Importatore:
+    """Stato di un'importazione: id di artisti e dischi gia risolti, slug usati, brani esistenti."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.artisti = {}      # chiave artista -> id
+        self.dischi = {}       # (artista_id, titolo minuscolo) -> id
+        self.brani = {}        # artista_id -> set di chiavi dei brani esistenti
+        self.slug_usati = {'artisti': set(), 'dischi': set(), 'brani': set()}
+        self.creati = {'artisti': 0, 'dischi': 0, 'brani': 0}
+        self.esistenti = 0
+
+    def _seleziona(self, sql, valori):
+        """SELECT con una clausola IN (%s) ripetuta a blocchi di 1000 valori."""
+        valori = list(valori)
+        righe = []
+        for i in range(0, len(valori), 1000):
+            blocco = valori[i:i + 1000]
+            self.cursor.execute(sql.replace('%s', ', '.join(['%s'] * len(blocco))), blocco)
+            righe.extend(self.cursor.fetchall())
+        return righe
+
+    def _slug(self, tabella, testi):
+        """Slug liberi per i testi, come nei form: in caso di conflitto viene aggiunto un suffisso casuale."""
+        candidati = [genera_slug(t) or uuid.uuid4().hex[:6] for t in testi]
+        occupati = {r['slug'] for r in self._seleziona(f'SELECT slug FROM {tabella} WHERE slug IN (%s)',
+                                                        set(candidati))}
+        usati = self.slug_usati[tabella]
+        risultato = []
+        for slug in candidati:
+            if slug in occupati or slug in usati:
+                slug = f"{slug}-{uuid.uuid4().hex[:6]}"
+            usati.add(slug)
+            risultato.append(slug)
+        return risultato
+
+    def _inserisci(self, tabella, colonne, righe):
+        self.cursor.executemany(
+            f"INSERT INTO {tabella} ({', '.join(colonne)}) VALUES ({', '.join(['%s'] * len(colonne))})",
+            [[riga.get(c) for c in colonne] for riga in righe]
+        )
+        self.creati[tabella] += len(righe)
+
+    def _risolvi_artisti(self, record):
+        mancanti = {}
+        for artista, _disco, _brano in record:
+            chiave = _chiave_artista(artista)
+            if chiave not in self.artisti:
+                mancanti.setdefault(chiave, artista)
+        if not mancanti:
+            return
+        nomi = {a['nome'] for a in mancanti.values()} | {a['nome_arte'] for a in mancanti.values() if a.get('nome_arte')}
+        righe = self._seleziona('SELECT id, nome, nome_arte FROM artisti WHERE nome_arte IN (%s)', nomi)
+        righe += self._seleziona('SELECT id, nome, nome_arte FROM artisti WHERE nome IN (%s)', nomi)
+        for riga in righe:
+            chiave = _chiave_artista(riga)
+            if chiave in mancanti and chiave not in self.artisti:
+                self.artisti[chiave] = riga['id']
+                del mancanti[chiave]
+        if not mancanti:
+            return
+        nuovi = list(mancanti.values())
+        for artista, slug in zip(nuovi, self._slug('artisti', (a.get('nome_arte') or a['nome'] for a in nuovi))):
+            artista['slug'] = slug
+        self._inserisci('artisti', ['slug'] + list(CAMPI_ARTISTA), nuovi)
+        id_per_slug = {r['slug']: r['id'] for r in self._seleziona('SELECT id, slug FROM artisti WHERE slug IN (%s)',
+                                                                     [a['slug'] for a in nuovi])}
+        for chiave, artista in mancanti.items():
+            self.artisti[chiave] = id_per_slug[artista['slug']]
+
+    def _carica_artisti(self, artisti_id):
+        """Dischi e brani esistenti degli artisti non ancora visti in questa importazione."""
+        nuovi = [a for a in artisti_id if a not in self.brani]
+        if not nuovi:
+            return
+        for a in nuovi:
+            self.brani[a] = set()
+        for riga in self._seleziona('SELECT id, artista_id, titolo FROM dischi WHERE artista_id IN (%s)', nuovi):
+            self.dischi.setdefault((riga['artista_id'], riga['titolo'].strip().lower()), riga['id'])
+        for riga in self._seleziona('SELECT artista_id, disco_id, titolo, isrc FROM brani WHERE artista_id IN (%s)',
+                                    nuovi):
+            self.brani[riga['artista_id']].update(self._chiavi_brano(riga['disco_id'], riga))
+
+    @staticmethod
+    def _chiavi_brano(disco_id, brano):
+        chiavi = [('titolo', disco_id, brano['titolo'].strip().lower())]
+        if brano.get('isrc'):
+            chiavi.append(('isrc', brano['isrc']))
+        return chiavi
+
+    def _risolvi_dischi(self, record):
+        mancanti = {}
+        for artista, disco, _brano in record:
+            if disco is None:
+                continue
+            chiave = (self.artisti[_chiave_artista(artista)], disco['titolo'].strip().lower())
+            if chiave not in self.dischi:
+                mancanti.setdefault(chiave, disco)
+        if not mancanti:
+            return
+        nuovi = []
+        for (artista_id, _titolo), disco in mancanti.items():
+            nuovi.append(dict(disco, artista_id=artista_id))
+        for disco, slug in zip(nuovi, self._slug('dischi', (d['titolo'] for d in nuovi))):
+            disco['slug'] = slug
+        self._inserisci('dischi', ['artista_id', 'slug'] + list(CAMPI_DISCO), nuovi)
+        id_per_slug = {r['slug']: r['id'] for r in self._seleziona('SELECT id, slug FROM dischi WHERE slug IN (%s)',
+                                                                     [d['slug'] for d in nuovi])}
+        for chiave, disco in zip(mancanti, nuovi):
+            self.dischi[chiave] = id_per_slug[disco['slug']]
+
+    def scrivi(self, record):
+        """Scrive un blocco di record validati (il commit e del chiamante)."""
+        self._risolvi_artisti(record)
+        self._carica_artisti({self.artisti[_chiave_artista(a)] for a, _d, _b in record})
+        self._risolvi_dischi(record)
+
+        nuovi = []
+        for artista, disco, brano in record:
+            if brano is None:
+                continue
+            artista_id = self.artisti[_chiave_artista(artista)]
+            disco_id = self.dischi[(artista_id, disco['titolo'].strip().lower())] if disco else None
+            chiavi = self._chiavi_brano(disco_id, brano)
+            esistenti = self.brani[artista_id]
+            if any(c in esistenti for c in chiavi):
+                self.esistenti += 1
+                continue
+            esistenti.update(chiavi)
+            nuovi.append(dict(brano, artista_id=artista_id, disco_id=disco_id))
+        if nuovi:
+            for brano, slug in zip(nuovi, self._slug('brani', (b['titolo'] for b in nuovi))):
+                brano['slug'] = slug
+            self._inserisci('brani', ['artista_id', 'disco_id', 'slug'] + list(CAMPI_BRANO), nuovi)
+
+
+def importa(file_obj, formato, verifica=False, blocco=None):
+    """Importa un catalogo.
+
+    Args:
+        file_obj: file binario
+        formato: 'csv', 'json' o 'ndjson'
+        verifica: valida soltanto, senza scrivere nel database
+        blocco: righe per transazione (default Config.IMPORTAZIONE_BLOCCO)
+
+    Returns:
+        dict con righe lette, valide, scartate, messaggi di errore, artisti/dischi/brani
+        creati, brani gia presenti, durata in secondi e righe al secondo. Se la scrittura
+        fallisce 'interrotta' riporta l'errore: i blocchi precedenti restano importati e
+        reimportare il file completa l'importazione senza duplicati
+    """
+    blocco = blocco or Config.IMPORTAZIONE_BLOCCO
+    inizio = time.perf_counter()
+    rapporto = {'righe': 0, 'valide': 0, 'scartate': 0, 'messaggi': [], 'interrotta': None}
+    conn = cursor = importatore = None
+    if not verifica:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        importatore = _Importatore(cursor)
+
+    def _scrivi(record):
+        try:
+            importatore.scrivi(record)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    try:
+        record = []
+        for numero, (artista, disco, brano) in enumerate(leggi(file_obj, formato), 1):
+            rapporto['righe'] += 1
+            try:
+                record.append(valida(artista, disco, brano))
+            except ErroreValidazione as e:
+                rapporto['scartate'] += 1
+                if len(rapporto['messaggi']) < MESSAGGI_MAX:
+                    rapporto['messaggi'].append(f"Riga {numero}: {e}")
+                continue
+            rapporto['valide'] += 1
+            if importatore and len(record) >= blocco:
+                _scrivi(record)
+                record = []
+        if importatore and record:
+            _scrivi(record)
+    except (ValueError, csv.Error) as e:
+        # File illeggibile (JSON o CSV malformato, codifica non UTF-8)
+        rapporto['interrotta'] = f"File non leggibile dopo {rapporto['righe']} righe: {e}"
+    except Exception as e:
+        rapporto['interrotta'] = f"Errore dopo {rapporto['righe']} righe: {type(e).__name__}: {e}"
+    finally:
+        if cursor:
+            cursor.close()
+            conn.close()
+
+    if importatore:
+        rapporto.update({f'{t}_creati': n for t, n in importatore.creati.items()})
+        rapporto['brani_esistenti'] = importatore.esistenti
+    rapporto['durata'] = time.perf_counter() - inizio
+    rapporto['righe_al_secondo'] = rapporto['righe'] / rapporto['durata'] if rapporto['durata'] else 0
+    return rapporto
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importazione massiva di artisti, dischi e brani")
+    parser.add_argument('file', help="catalogo CSV, JSON o NDJSON")
+    parser.add_argument('--formato', choices=['csv', 'json', 'ndjson'], help="default: dall'estensione del file")
+    parser.add_argument('--verifica', action='store_true', help="valida soltanto, senza scrivere nel database")
+    parser.add_argument('--blocco', type=int, help=f"righe per transazione (default {Config.IMPORTAZIONE_BLOCCO})")
+    args = parser.parse_args()
+    formato = args.formato or formato_da_nome(args.file)
+    if formato not in ('csv', 'json', 'ndjson'):
+        parser.error("formato non riconosciuto: indicare --formato")
+
+    with open(args.file, 'rb') as f:
+        rapporto = importa(f, formato, verifica=args.verifica, blocco=args.blocco)
+    for messaggio in rapporto['messaggi']:
+        print(messaggio)
+    print(f"{rapporto['righe']} righe lette, {rapporto['valide']} valide, {rapporto['scartate']} scartate "
+          f"in {rapporto['durata']:.1f} s ({rapporto['righe_al_secondo']:.0f} righe/s)")
+    if not args.verifica:
+        print(f"Creati {rapporto['artisti_creati']} artisti, {rapporto['dischi_creati']} dischi, "
+              f"{rapporto['brani_creati']} brani; {rapporto['brani_esistenti']} brani gia presenti")
+    if rapporto['interrotta']:
+        print(rapporto['interrotta'])
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
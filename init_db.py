@@ -3,7 +3,8 @@ Script per inizializzare il database MySQL.
 Esegui questo script per creare le tabelle e l'utente admin di default.
 
 Utilizzo:
-    python init_db.py
+    python init_db.py             # applica le migrazioni mancanti e crea i dati di default
+    python init_db.py --dry-run   # mostra le migrazioni mancanti senza modificare il database
 
 Prerequisiti:
     1. MySQL deve essere in esecuzione
@@ -11,10 +12,25 @@ Prerequisiti:
        CREATE DATABASE gestionale CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
     3. Configura le credenziali in config.py se necessario
 """
+import sys
 
 from app import init_db
+import migrazioni
 
 if __name__ == '__main__':
+    if '--dry-run' in sys.argv[1:]:
+        print(f"Versione dello schema: {migrazioni.versione_corrente()}")
+        mancanti = migrazioni.esegui(dry_run=True)
+        if not mancanti:
+            print("Nessuna migrazione da applicare.")
+        for migrazione in mancanti:
+            print(f"\n-- Migrazione {migrazione['versione']}: {migrazione['descrizione']}")
+            for sql in migrazione['sql']:
+                print(f"{sql};")
+            if not migrazione['sql']:
+                print("-- (nessuna istruzione necessaria, verra solo registrata)")
+        sys.exit(0)
+
     print("Inizializzazione database...")
     init_db()
     print("Database inizializzato con successo!")
@@ -0,0 +1,224 @@
+"""
+Metriche di runtime esposte in formato testo Prometheus (endpoint /metrics).
+
+Contatori, indicatori e istogrammi sono aggregati per thread: ogni thread
+aggiorna solo il proprio dizionario, senza lock (con il GIL l'aggiornamento di
+una voce e atomico rispetto agli altri thread), e l'esposizione somma i
+dizionari di tutti i thread. Il lock serve solo a registrare il dizionario di
+un thread la prima volta che scrive. I dizionari dei thread terminati (una
+richiesta nel server threaded, un worker di un ThreadPoolExecutor) vengono
+sommati in un dizionario globale ed eliminati, cosi il loro numero non cresce
+con le richieste servite. Le metriche sono del processo: con piu processi
+ognuno espone le proprie.
+
+Le metriche sono definite qui come costanti di modulo e aggiornate dai moduli
+che le misurano (database, nas_storage, cestino, nas_operazioni, anteprime).
+"""
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+from config import Config
+
+# Limiti (secondi) degli istogrammi di durata
+LIMITI_RAPIDI = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LIMITI_RICHIESTE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LIMITI_TRASFERIMENTI = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+_locale = threading.local()
+_frammenti = {}  # thread -> dict (nome, valori etichette) -> valore
+_terminati = {}  # valori sommati dei thread terminati, stesso formato
+_frammenti_lock = threading.Lock()
+_metriche = {}  # nome -> metrica, nell'ordine di definizione
+
+
+def _frammento():
+    frammento = getattr(_locale, 'frammento', None)
+    if frammento is None:
+        frammento = _locale.frammento = {}
+        with _frammenti_lock:
+            _raccogli_terminati()
+            _frammenti[threading.current_thread()] = frammento
+    return frammento
+
+
+def _somma(totali, frammento):
+    for chiave, valore in frammento.items():
+        if isinstance(valore, list):
+            somma = totali.get(chiave)
+            totali[chiave] = [a + b for a, b in zip(somma, valore)] if somma else list(valore)
+        else:
+            totali[chiave] = totali.get(chiave, 0) + valore
+
+
+def _raccogli_terminati():
+    """Somma in _terminati i dizionari dei thread terminati e li elimina (con _frammenti_lock)."""
+    for thread in [t for t in _frammenti if not t.is_alive()]:
+        _somma(_terminati, _frammenti.pop(thread))
+
+
+def _escape(valore):
+    return str(valore).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etichette(nomi, valori, extra=''):
+    coppie = [f'{n}="{_escape(v)}"' for n, v in zip(nomi, valori)]
+    if extra:
+        coppie.append(extra)
+    return '{' + ','.join(coppie) + '}' if coppie else ''
+
+
+class Contatore:
+    """Valore che puo solo crescere, per combinazione di etichette."""
+
+    tipo = 'counter'
+
+    def __init__(self, nome, descrizione, etichette=()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        _metriche[nome] = self
+
+    def inc(self, valore=1, *etichette):
+        if not Config.METRICHE:
+            return
+        frammento = _frammento()
+        chiave = (self.nome, etichette)
+        frammento[chiave] = frammento.get(chiave, 0) + valore
+
+    def _righe(self, valori):
+        for etichette, valore in sorted(valori.items()):
+            yield f'{self.nome}{_etichette(self.etichette, etichette)} {valore}'
+
+
+class Indicatore(Contatore):
+    """Valore che puo crescere e diminuire (es. connessioni aperte)."""
+
+    tipo = 'gauge'
+
+    def dec(self, valore=1, *etichette):
+        self.inc(-valore, *etichette)
+
+
+class IndicatoreCalcolato:
+    """Valore letto da una funzione al momento dell'esposizione (es. voci in una cache)."""
+
+    tipo = 'gauge'
+
+    def __init__(self, nome, descrizione, funzione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.funzione = funzione
+        _metriche[nome] = self
+
+    def _righe(self, valori):
+        yield f'{self.nome} {self.funzione()}'
+
+
+class Istogramma:
+    """Distribuzione di valori (durate, dimensioni) in bucket cumulativi, con somma e conteggio."""
+
+    tipo = 'histogram'
+
+    def __init__(self, nome, descrizione, etichette=(), limiti=LIMITI_RAPIDI):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self.limiti = tuple(limiti)
+        _metriche[nome] = self
+
+    def osserva(self, valore, *etichette):
+        if not Config.METRICHE:
+            return
+        frammento = _frammento()
+        chiave = (self.nome, etichette)
+        dati = frammento.get(chiave)
+        if dati is None:
+            # Un contatore per bucket (l'ultimo e +Inf) e la somma dei valori
+            dati = frammento[chiave] = [0] * (len(self.limiti) + 2)
+        dati[bisect_left(self.limiti, valore)] += 1
+        dati[-1] += valore
+
+    def _righe(self, valori):
+        for etichette, dati in sorted(valori.items()):
+            cumulato = 0
+            for limite, conteggio in zip(self.limiti + ('+Inf',), dati):
+                cumulato += conteggio
+                le = 'le="%s"' % limite
+                yield f'{self.nome}_bucket{_etichette(self.etichette, etichette, le)} {cumulato}'
+            yield f'{self.nome}_sum{_etichette(self.etichette, etichette)} {dati[-1]}'
+            yield f'{self.nome}_count{_etichette(self.etichette, etichette)} {cumulato}'
+
+
+def esporta():
+    """Testo delle metriche nel formato di esposizione Prometheus."""
+    with _frammenti_lock:
+        _raccogli_terminati()
+        complessivi = dict(_terminati)
+        frammenti = list(_frammenti.values())
+    for frammento in frammenti:
+        # copy() e atomica rispetto ai thread che scrivono nel frammento
+        _somma(complessivi, frammento.copy())
+    totali = {}
+    for (nome, etichette), valore in complessivi.items():
+        totali.setdefault(nome, {})[etichette] = valore
+    righe = []
+    for metrica in list(_metriche.values()):
+        righe.append(f'# HELP {metrica.nome} {metrica.descrizione}')
+        righe.append(f'# TYPE {metrica.nome} {metrica.tipo}')
+        righe.extend(metrica._righe(totali.get(metrica.nome, {})))
+    return '\n'.join(righe) + '\n'
+
+
+# ============ METRICHE ============
+
+HTTP_DURATA = Istogramma('http_richiesta_durata_secondi', 'Durata delle richieste HTTP per endpoint',
+                         ('endpoint', 'metodo'), LIMITI_RICHIESTE)
+HTTP_RICHIESTE = Contatore('http_richieste_totale', 'Richieste HTTP per endpoint e classe di stato',
+                           ('endpoint', 'stato'))
+
+DB_CONNESSIONI = Contatore('db_connessioni_totale', 'Connessioni MySQL aperte dall\'avvio del processo')
+DB_CONNESSIONI_APERTE = Indicatore('db_connessioni_aperte', 'Connessioni MySQL attualmente aperte')
+DB_CONNESSIONE_DURATA = Istogramma('db_connessione_durata_secondi', 'Tempo di apertura di una connessione MySQL')
+DB_QUERY_DURATA = Istogramma('db_query_durata_secondi', 'Durata delle query SQL per tipo di istruzione', ('tipo',))
+
+NAS_CONNESSIONE_DURATA = Istogramma('nas_connessione_durata_secondi', 'Tempo di apertura di una connessione SFTP',
+                                    limiti=LIMITI_RICHIESTE)
+NAS_CONNESSIONI_ERRORI = Contatore('nas_connessioni_errori_totale', 'Connessioni SFTP non riuscite')
+NAS_TRASFERIMENTO_DURATA = Istogramma('nas_trasferimento_durata_secondi', 'Durata dei trasferimenti di file NAS',
+                                      ('operazione',), LIMITI_TRASFERIMENTI)
+NAS_TRASFERIMENTO_BYTES = Contatore('nas_trasferimento_bytes_totale', 'Bytes trasferiti da e verso il NAS',
+                                    ('operazione',))
+
+CACHE_RICHIESTE = Contatore('cache_richieste_totale', 'Letture dalle cache per esito (hit/miss)', ('cache', 'esito'))
+
+CESTINO_ELIMINAZIONI = Contatore('cestino_eliminazioni_totale', 'Esecuzioni dello svuotamento del cestino',
+                                 ('origine',))
+CESTINO_ELEMENTI = Contatore('cestino_elementi_eliminati_totale', 'Elementi eliminati definitivamente dal cestino')
+CESTINO_DURATA = Istogramma('cestino_eliminazione_durata_secondi', 'Durata dello svuotamento del cestino',
+                            limiti=LIMITI_TRASFERIMENTI)
+
+NAS_OPERAZIONI = Contatore('nas_operazioni_totale', 'Operazioni NAS in coda eseguite, per tipo ed esito',
+                           ('tipo', 'esito'))
+NAS_OPERAZIONI_DURATA = Istogramma('nas_operazioni_durata_secondi', 'Durata delle operazioni NAS in coda',
+                                   ('tipo',), LIMITI_TRASFERIMENTI)
+
+
+def init_app(app):
+    """Registra la misura della durata delle richieste HTTP."""
+    if not Config.METRICHE:
+        return
+
+    @app.before_request
+    def _inizio_metriche():
+        g.inizio_metriche = time.perf_counter()
+
+    @app.after_request
+    def _misura_richiesta(response):
+        inizio = g.pop('inizio_metriche', None)
+        if inizio is None or request.endpoint == 'metriche_prometheus':
+            return response
+        endpoint = request.endpoint or 'nessuno'
+        HTTP_DURATA.osserva(time.perf_counter() - inizio, endpoint, request.method)
+        HTTP_RICHIESTE.inc(1, endpoint, f'{response.status_code // 100}xx')
+        return response
@@ -0,0 +1,636 @@
+"""
+Migrazioni versionate dello schema del database.
+
+Ogni migrazione ha un numero di versione, una descrizione e una lista di
+passi eseguiti in ordine: istruzioni SQL idempotenti (CREATE TABLE IF NOT
+EXISTS) oppure Colonna e Indice, che vengono aggiunti solo se mancano. Le
+migrazioni applicate sono registrate in schema_version con il checksum dei
+loro passi: all'avvio basta una query per sapere se lo schema e aggiornato,
+e una migrazione gia applicata e poi modificata nel codice viene segnalata
+con MigrazioneModificata invece di essere ignorata.
+
+Le migrazioni non vanno mai modificate una volta rilasciate: ogni modifica
+dello schema e una nuova migrazione in fondo a MIGRAZIONI. MySQL non ha DDL
+transazionale: se una migrazione si interrompe a meta non viene registrata e
+alla prossima esecuzione ripartono da capo solo i passi ancora necessari.
+
+Utilizzo da riga di comando (stampa i passi senza eseguirli):
+    python init_db.py --dry-run
+"""
+import hashlib
+import logging
+import re
+import time
+import pymysql
+from database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Lock MySQL che serializza le migrazioni tra processi avviati insieme
+LOCK_MIGRAZIONI = 'maqueta_migrazioni'
+
+_RE_CREA_TABELLA = re.compile(r"CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+_RE_SPAZI = re.compile(r"\s+")
+
+
+class MigrazioneModificata(Exception):
+    """Il checksum di una migrazione applicata non corrisponde piu al codice."""
+
+
+def _tabella_esiste(cursor, tabella):
+    cursor.execute('''
+        SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    ''', (tabella,))
+    return cursor.fetchone() is not None
+
+
+class Colonna:
+    """Aggiunge una colonna a una tabella esistente, se manca."""
+
+    def __init__(self, tabella, nome, definizione):
+        self.tabella = tabella
+        self.nome = nome
+        self.sql = f"ALTER TABLE {tabella} ADD COLUMN {nome} {definizione}"
+
+    def _presente(self, cursor):
+        cursor.execute('''
+            SELECT 1 FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        ''', (self.tabella, self.nome))
+        return cursor.fetchone() is not None
+
+    def necessario(self, cursor, pianificate):
+        """True se il passo va eseguito.
+
+        pianificate: {tabella: CREATE TABLE} delle tabelle che una prova a vuoto
+        creerebbe prima di questo passo (non esistono ancora nel database)
+        """
+        if _tabella_esiste(cursor, self.tabella):
+            return not self._presente(cursor)
+        creazione = pianificate.get(self.tabella)
+        return creazione is None or not re.search(rf"\b{self.nome}\b", creazione)
+
+
+class Indice(Colonna):
+    """Aggiunge un indice a una tabella esistente, se non c'e gia un indice con lo stesso nome."""
+
+    def __init__(self, tabella, nome, colonne, unico=False):
+        self.tabella = tabella
+        self.nome = nome
+        self.sql = f"ALTER TABLE {tabella} ADD {'UNIQUE ' if unico else ''}INDEX {nome} ({colonne})"
+
+    def _presente(self, cursor):
+        cursor.execute('''
+            SELECT 1 FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        ''', (self.tabella, self.nome))
+        return cursor.fetchone() is not None
+
+
+class RimuoviIndice(Indice):
+    """Elimina un indice, se esiste (es. sostituito da un indice composto che lo estende)."""
+
+    def __init__(self, tabella, nome):
+        self.tabella = tabella
+        self.nome = nome
+        self.sql = f"ALTER TABLE {tabella} DROP INDEX {nome}"
+
+    def necessario(self, cursor, pianificate):
+        # Tabella ancora da creare (solo in una prova a vuoto): l'indice ci sara
+        return not _tabella_esiste(cursor, self.tabella) or self._presente(cursor)
+
+
+MIGRAZIONI = [
+    (1, 'Schema iniziale', [
+        # Tabella utenti
+        '''
+            CREATE TABLE IF NOT EXISTS utenti (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(50) NOT NULL UNIQUE,
+                password_hash VARCHAR(255) NOT NULL,
+                nome VARCHAR(100) NOT NULL,
+                cognome VARCHAR(100) NOT NULL,
+                email VARCHAR(100) UNIQUE,
+                is_admin BOOLEAN DEFAULT FALSE,
+                attivo BOOLEAN DEFAULT TRUE,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                ultimo_accesso DATETIME NULL,
+                artista_id INT NULL,
+                quota_nas BIGINT NULL
+            )
+        ''',
+        # Tabella menu
+        '''
+            CREATE TABLE IF NOT EXISTS menu (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                nome VARCHAR(100) NOT NULL,
+                icona VARCHAR(50) DEFAULT 'bi-circle',
+                url VARCHAR(200) NOT NULL,
+                ordine INT DEFAULT 0,
+                parent_id INT NULL,
+                attivo BOOLEAN DEFAULT TRUE,
+                FOREIGN KEY (parent_id) REFERENCES menu(id) ON DELETE SET NULL
+            )
+        ''',
+        # Tabella permessi (semplificata: se esiste il record, l'utente può vedere il menu)
+        '''
+            CREATE TABLE IF NOT EXISTS permessi (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                utente_id INT NOT NULL,
+                menu_id INT NOT NULL,
+                FOREIGN KEY (utente_id) REFERENCES utenti(id) ON DELETE CASCADE,
+                FOREIGN KEY (menu_id) REFERENCES menu(id) ON DELETE CASCADE,
+                UNIQUE KEY unique_permesso (utente_id, menu_id)
+            )
+        ''',
+        # Tabella categorie servizi
+        '''
+            CREATE TABLE IF NOT EXISTS categorie_servizi (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                nome VARCHAR(150) NOT NULL,
+                descrizione VARCHAR(300),
+                icona VARCHAR(50) DEFAULT 'bi-folder',
+                ordine INT DEFAULT 0,
+                attivo BOOLEAN DEFAULT TRUE,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        # Tabella servizi
+        '''
+            CREATE TABLE IF NOT EXISTS servizi (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                nome VARCHAR(150) NOT NULL,
+                descrizione TEXT,
+                descrizione_breve VARCHAR(300),
+                foto VARCHAR(500),
+                icona VARCHAR(50) DEFAULT 'bi-gear',
+                prezzo DECIMAL(10,2) NULL,
+                durata VARCHAR(50) NULL,
+                attivo BOOLEAN DEFAULT TRUE,
+                in_evidenza BOOLEAN DEFAULT FALSE,
+                ordine INT DEFAULT 0,
+                categoria_id INT NULL,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (categoria_id) REFERENCES categorie_servizi(id) ON DELETE SET NULL
+            )
+        ''',
+        # Tabella news
+        '''
+            CREATE TABLE IF NOT EXISTS news (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                titolo VARCHAR(255) NOT NULL,
+                slug VARCHAR(255) UNIQUE,
+                contenuto TEXT,
+                estratto VARCHAR(500),
+                immagine VARCHAR(500),
+                autore_id INT,
+                categoria VARCHAR(100),
+                tags VARCHAR(255),
+                pubblicato BOOLEAN DEFAULT FALSE,
+                in_evidenza BOOLEAN DEFAULT FALSE,
+                data_pubblicazione DATETIME NULL,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                visualizzazioni INT DEFAULT 0,
+                FOREIGN KEY (autore_id) REFERENCES utenti(id) ON DELETE SET NULL
+            )
+        ''',
+        # Tabella artisti
+        '''
+            CREATE TABLE IF NOT EXISTS artisti (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                nome VARCHAR(150) NOT NULL,
+                nome_arte VARCHAR(150),
+                slug VARCHAR(200) UNIQUE,
+                bio TEXT,
+                foto VARCHAR(500),
+                foto_copertina VARCHAR(500),
+                is_band BOOLEAN DEFAULT FALSE,
+                instagram VARCHAR(255),
+                facebook VARCHAR(255),
+                twitter VARCHAR(255),
+                spotify VARCHAR(255),
+                youtube VARCHAR(255),
+                apple_music VARCHAR(255),
+                website VARCHAR(255),
+                email VARCHAR(255),
+                genere VARCHAR(100),
+                anno_fondazione INT,
+                paese VARCHAR(100),
+                citta VARCHAR(100),
+                attivo BOOLEAN DEFAULT TRUE,
+                in_evidenza BOOLEAN DEFAULT FALSE,
+                ordine INT DEFAULT 0,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_artisti_slug (slug),
+                INDEX idx_artisti_attivo (attivo),
+                INDEX idx_artisti_genere (genere)
+            )
+        ''',
+        # Tabella membri band
+        '''
+            CREATE TABLE IF NOT EXISTS membri_band (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                artista_id INT NOT NULL,
+                nome VARCHAR(100) NOT NULL,
+                cognome VARCHAR(100),
+                nome_arte VARCHAR(150),
+                ruolo VARCHAR(100) NOT NULL,
+                foto VARCHAR(500),
+                bio_breve TEXT,
+                attivo BOOLEAN DEFAULT TRUE,
+                data_ingresso DATE,
+                data_uscita DATE,
+                ordine INT DEFAULT 0,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
+                INDEX idx_membri_artista (artista_id),
+                INDEX idx_membri_attivo (attivo)
+            )
+        ''',
+        # Tabella dischi
+        '''
+            CREATE TABLE IF NOT EXISTS dischi (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                artista_id INT NOT NULL,
+                titolo VARCHAR(255) NOT NULL,
+                slug VARCHAR(255),
+                tipo ENUM('album', 'ep', 'singolo', 'compilation', 'live', 'remix') DEFAULT 'album',
+                copertina VARCHAR(500),
+                anno_uscita INT,
+                data_uscita DATE,
+                etichetta VARCHAR(150),
+                formato VARCHAR(100),
+                descrizione TEXT,
+                link_spotify VARCHAR(500),
+                link_apple_music VARCHAR(500),
+                link_youtube_music VARCHAR(500),
+                link_amazon_music VARCHAR(500),
+                link_deezer VARCHAR(500),
+                link_tidal VARCHAR(500),
+                link_acquisto VARCHAR(500),
+                pubblicato BOOLEAN DEFAULT FALSE,
+                in_evidenza BOOLEAN DEFAULT FALSE,
+                ordine INT DEFAULT 0,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
+                INDEX idx_dischi_artista (artista_id),
+                INDEX idx_dischi_slug (slug),
+                INDEX idx_dischi_tipo (tipo),
+                INDEX idx_dischi_anno (anno_uscita),
+                INDEX idx_dischi_pubblicato (pubblicato)
+            )
+        ''',
+        # Tabella brani
+        '''
+            CREATE TABLE IF NOT EXISTS brani (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                disco_id INT,
+                artista_id INT NOT NULL,
+                titolo VARCHAR(255) NOT NULL,
+                slug VARCHAR(255),
+                durata VARCHAR(10),
+                numero_traccia INT,
+                featuring VARCHAR(255),
+                produttore VARCHAR(255),
+                autori VARCHAR(500),
+                genere VARCHAR(100),
+                anno INT,
+                isrc VARCHAR(20),
+                link_spotify VARCHAR(500),
+                link_apple_music VARCHAR(500),
+                link_youtube VARCHAR(500),
+                link_youtube_music VARCHAR(500),
+                link_soundcloud VARCHAR(500),
+                link_altro VARCHAR(500),
+                testo TEXT,
+                video_ufficiale VARCHAR(500),
+                pubblicato BOOLEAN DEFAULT FALSE,
+                is_singolo BOOLEAN DEFAULT FALSE,
+                data_uscita DATE,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (disco_id) REFERENCES dischi(id) ON DELETE SET NULL,
+                FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
+                INDEX idx_brani_disco (disco_id),
+                INDEX idx_brani_artista (artista_id),
+                INDEX idx_brani_pubblicato (pubblicato),
+                INDEX idx_brani_numero (numero_traccia)
+            )
+        ''',
+        # Tabella eventi
+        '''
+            CREATE TABLE IF NOT EXISTS eventi (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                artista_id INT NOT NULL,
+                titolo VARCHAR(255) NOT NULL,
+                slug VARCHAR(255),
+                tipo ENUM('concerto', 'festival', 'showcase', 'dj_set', 'live_session', 'altro') DEFAULT 'concerto',
+                descrizione TEXT,
+                immagine VARCHAR(500),
+                data_evento DATE NOT NULL,
+                ora_inizio TIME,
+                ora_fine TIME,
+                venue VARCHAR(200),
+                citta VARCHAR(100) NOT NULL,
+                paese VARCHAR(100) DEFAULT 'Italia',
+                indirizzo VARCHAR(300),
+                coordinate_gps VARCHAR(50),
+                link_biglietti VARCHAR(500),
+                prezzo_da DECIMAL(10,2),
+                prezzo_a DECIMAL(10,2),
+                sold_out BOOLEAN DEFAULT FALSE,
+                stato ENUM('programmato', 'confermato', 'annullato', 'posticipato', 'concluso') DEFAULT 'programmato',
+                pubblicato BOOLEAN DEFAULT FALSE,
+                in_evidenza BOOLEAN DEFAULT FALSE,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_modifica DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (artista_id) REFERENCES artisti(id) ON DELETE CASCADE,
+                INDEX idx_eventi_artista (artista_id),
+                INDEX idx_eventi_data (data_evento),
+                INDEX idx_eventi_stato (stato),
+                INDEX idx_eventi_citta (citta),
+                INDEX idx_eventi_pubblicato (pubblicato)
+            )
+        ''',
+        # Tabella file nascosti (per nascondere file agli artisti)
+        '''
+            CREATE TABLE IF NOT EXISTS file_nascosti (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                percorso VARCHAR(1000) NOT NULL,
+                nascosto_da INT NOT NULL,
+                data_nascosto DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY unique_file (username, percorso(255))
+            )
+        ''',
+        # Tabella cestino file (eliminazione logica, auto-purge dopo 30 giorni)
+        '''
+            CREATE TABLE IF NOT EXISTS file_cestino (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                percorso VARCHAR(1000) NOT NULL,
+                eliminato_da INT NOT NULL,
+                data_eliminazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_cestino_username (username),
+                INDEX idx_cestino_data (data_eliminazione),
+                INDEX idx_cestino_username_data (username, data_eliminazione)
+            )
+        ''',
+        # Tabella indice NAS (metadati dei file per utente, aggiornata dal crawler)
+        # percorso e relativo alla cartella utente; la radice ha percorso ''
+        # Per le cartelle dimensione e la somma ricorsiva del contenuto
+        '''
+            CREATE TABLE IF NOT EXISTS nas_indice (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                percorso VARCHAR(1000) NOT NULL,
+                parent VARCHAR(1000) NOT NULL,
+                nome VARCHAR(255) NOT NULL,
+                estensione VARCHAR(20) NOT NULL DEFAULT '',
+                is_dir BOOLEAN DEFAULT FALSE,
+                dimensione BIGINT DEFAULT 0,
+                mtime BIGINT DEFAULT 0,
+                data_aggiornamento DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                UNIQUE KEY unique_indice (username, percorso(255)),
+                INDEX idx_indice_parent (username, parent(255)),
+                INDEX idx_indice_estensione (username, estensione),
+                INDEX idx_indice_mtime (username, mtime),
+                INDEX idx_indice_dimensione (username, dimensione)
+            )
+        ''',
+        # Tabella spazio NAS usato per utente (contatore incrementale, riallineato dal crawler)
+        '''
+            CREATE TABLE IF NOT EXISTS nas_utilizzo (
+                username VARCHAR(255) PRIMARY KEY,
+                byte_usati BIGINT DEFAULT 0,
+                data_aggiornamento DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        ''',
+        # Tabella coda delle operazioni NAS (eseguite in background dai worker)
+        # parametri e JSON; fatti/totale sono l'avanzamento nell'unita dell'operazione
+        '''
+            CREATE TABLE IF NOT EXISTS nas_operazioni (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                tipo VARCHAR(30) NOT NULL,
+                username VARCHAR(255) NOT NULL,
+                parametri TEXT NOT NULL,
+                stato ENUM('in_coda', 'in_corso', 'completata', 'errore', 'annullata') DEFAULT 'in_coda',
+                fatti BIGINT DEFAULT 0,
+                totale BIGINT DEFAULT 0,
+                messaggio VARCHAR(500) NULL,
+                annulla BOOLEAN DEFAULT FALSE,
+                worker VARCHAR(64) NULL,
+                creato_da INT NULL,
+                data_creazione DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_aggiornamento DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                data_fine DATETIME NULL,
+                INDEX idx_operazioni_stato (stato, id),
+                INDEX idx_operazioni_utente (creato_da, id),
+                INDEX idx_operazioni_username (username, data_fine),
+                FOREIGN KEY (creato_da) REFERENCES utenti(id) ON DELETE SET NULL
+            )
+        ''',
+        # Tabella checksum SHA-256 dei file NAS, calcolati durante upload e download
+        # dimensione/mtime sono quelli del file remoto quando il checksum e stato calcolato;
+        # blocchi e la firma a blocchi usata dagli upload delta
+        '''
+            CREATE TABLE IF NOT EXISTS nas_checksum (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                percorso VARCHAR(1000) NOT NULL,
+                sha256 CHAR(64) NOT NULL,
+                dimensione BIGINT DEFAULT 0,
+                mtime BIGINT DEFAULT 0,
+                blocchi MEDIUMBLOB NULL,
+                data_calcolo DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY unique_checksum (username, percorso(255)),
+                INDEX idx_checksum_sha256 (sha256)
+            )
+        ''',
+        # Tabella query lente, aggregate per impronta della forma (database._registra_query_lenta)
+        # piano e l'output JSON dell'ultimo EXPLAIN
+        '''
+            CREATE TABLE IF NOT EXISTS query_lente (
+                impronta CHAR(40) PRIMARY KEY,
+                forma TEXT NOT NULL,
+                parametri VARCHAR(500),
+                chiamante VARCHAR(255),
+                esecuzioni INT DEFAULT 0,
+                durata_totale_ms DOUBLE DEFAULT 0,
+                durata_max_ms DOUBLE DEFAULT 0,
+                piano MEDIUMTEXT NULL,
+                data_prima DATETIME DEFAULT CURRENT_TIMESTAMP,
+                data_ultima DATETIME DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_query_lente_totale (durata_totale_ms)
+            )
+        ''',
+        # Colonne e indici aggiunti dopo la creazione delle tabelle (database creati da versioni precedenti)
+        Colonna('utenti', 'artista_id', 'INT NULL'),
+        Colonna('artisti', 'email', 'VARCHAR(255) AFTER website'),
+        Colonna('utenti', 'quota_nas', 'BIGINT NULL'),
+        Colonna('nas_indice', 'estensione', "VARCHAR(20) NOT NULL DEFAULT '' AFTER nome"),
+        Indice('nas_indice', 'idx_indice_estensione', 'username, estensione'),
+        Indice('nas_indice', 'idx_indice_mtime', 'username, mtime'),
+        Indice('nas_indice', 'idx_indice_dimensione', 'username, dimensione'),
+        Indice('file_cestino', 'idx_cestino_username_data', 'username, data_eliminazione'),
+        Colonna('nas_checksum', 'blocchi', 'MEDIUMBLOB NULL AFTER mtime'),
+    ]),
+    (2, 'Indici news da add_news_table.sql', [
+        # Elenco pubblico: WHERE pubblicato = TRUE ORDER BY data_pubblicazione DESC.
+        # idx_news_slug non serve: slug e UNIQUE e ha gia il suo indice
+        Indice('news', 'idx_news_pubblicato', 'pubblicato, data_pubblicazione'),
+        Indice('news', 'idx_news_categoria', 'categoria'),
+    ]),
+    (3, 'Indici composti per le query delle landing page', [
+        # Proposti da benchmarks/indici.py: uguaglianze, poi le colonne dell'ORDER BY, poi
+        # l'intervallo; gli indici a colonna singola estesi dai nuovi vengono eliminati
+        Indice('news', 'idx_news_pubblicato_data', 'pubblicato, data_pubblicazione, data_creazione'),
+        Indice('news', 'idx_news_evidenza', 'pubblicato, in_evidenza, data_pubblicazione, data_creazione'),
+        Indice('news', 'idx_news_categoria_data', 'categoria, pubblicato, data_pubblicazione'),
+        RimuoviIndice('news', 'idx_news_pubblicato'),
+        RimuoviIndice('news', 'idx_news_categoria'),
+        Indice('eventi', 'idx_eventi_futuri', 'pubblicato, data_evento, stato'),
+        Indice('eventi', 'idx_eventi_artista_futuri', 'artista_id, pubblicato, data_evento, stato'),
+        RimuoviIndice('eventi', 'idx_eventi_pubblicato'),
+        Indice('brani', 'idx_brani_singoli', 'pubblicato, is_singolo, data_uscita, anno'),
+        RimuoviIndice('brani', 'idx_brani_pubblicato'),
+        Indice('artisti', 'idx_artisti_attivi', 'attivo, ordine, nome'),
+        Indice('artisti', 'idx_artisti_evidenza', 'attivo, in_evidenza, ordine, nome'),
+        RimuoviIndice('artisti', 'idx_artisti_attivo'),
+        Indice('dischi', 'idx_dischi_pubblicati', 'pubblicato, anno_uscita, data_uscita'),
+        RimuoviIndice('dischi', 'idx_dischi_pubblicato'),
+    ]),
+    (4, 'Indice del cestino per cartella', [
+        # Elenco di una cartella: file nel cestino con percorso LIKE 'cartella/%'
+        Indice('file_cestino', 'idx_cestino_username_percorso', 'username, percorso(255)'),
+    ]),
+]
+
+
+def _sql(passo):
+    return passo if isinstance(passo, str) else passo.sql
+
+
+def checksum(passi):
+    """SHA-256 dei passi di una migrazione, indipendente da spazi e indentazione."""
+    testo = '\n'.join(_RE_SPAZI.sub(' ', _sql(p)).strip() for p in passi)
+    return hashlib.sha256(testo.encode('utf-8')).hexdigest()
+
+
+def _applicate(cursor):
+    """{versione: checksum} delle migrazioni registrate (vuoto se schema_version non esiste)."""
+    try:
+        cursor.execute('SELECT versione, checksum FROM schema_version')
+    except pymysql.err.ProgrammingError as e:
+        if e.args[0] != 1146:  # tabella inesistente
+            raise
+        return {}
+    return {r['versione']: r['checksum'] for r in cursor.fetchall()}
+
+
+def _da_applicare(applicate):
+    """Migrazioni non ancora applicate, dopo aver verificato i checksum di quelle applicate."""
+    for versione, descrizione, passi in MIGRAZIONI:
+        registrato = applicate.get(versione)
+        if registrato is not None and registrato != checksum(passi):
+            raise MigrazioneModificata(
+                f"La migrazione {versione} ({descrizione}) e stata modificata dopo essere stata applicata"
+            )
+    return [m for m in MIGRAZIONI if m[0] not in applicate]
+
+
+def _crea_schema_version(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versione INT PRIMARY KEY,
+            descrizione VARCHAR(255) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            durata_ms INT DEFAULT 0,
+            data_applicazione DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _applica(cursor, versione, descrizione, passi, dry_run, pianificate):
+    """Esegue (o con dry_run elenca) i passi necessari di una migrazione; restituisce le SQL."""
+    inizio = time.perf_counter()
+    eseguite = []
+    for passo in passi:
+        if isinstance(passo, str):
+            crea = _RE_CREA_TABELLA.match(passo.strip())
+            if dry_run and crea and _tabella_esiste(cursor, crea.group(1)):
+                continue
+            if crea:
+                pianificate[crea.group(1)] = passo
+        elif not passo.necessario(cursor, pianificate if dry_run else {}):
+            continue
+        if not dry_run:
+            cursor.execute(passo if isinstance(passo, str) else passo.sql)
+        eseguite.append(_RE_SPAZI.sub(' ', _sql(passo)).strip())
+    if not dry_run:
+        cursor.execute('''
+            INSERT INTO schema_version (versione, descrizione, checksum, durata_ms) VALUES (%s, %s, %s, %s)
+        ''', (versione, descrizione, checksum(passi), int((time.perf_counter() - inizio) * 1000)))
+        logger.info(f"Migrazione {versione} applicata: {descrizione} ({len(eseguite)} istruzioni)")
+    return eseguite
+
+
+def esegui(dry_run=False):
+    """Porta lo schema all'ultima versione.
+
+    Con lo schema aggiornato costa una query. Le migrazioni mancanti sono
+    applicate in ordine sotto un lock MySQL, cosi piu processi avviati
+    insieme non le eseguono due volte.
+
+    Args:
+        dry_run: non modifica il database, restituisce solo cosa verrebbe eseguito
+
+    Returns:
+        lista di {'versione', 'descrizione', 'sql'} delle migrazioni applicate
+        (o da applicare con dry_run), con le istruzioni necessarie
+
+    Raises:
+        MigrazioneModificata: se una migrazione applicata non corrisponde piu al codice
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        mancanti = _da_applicare(_applicate(cursor))
+        if not mancanti:
+            return []
+
+        if dry_run:
+            pianificate = {}
+            return [{'versione': v, 'descrizione': d, 'sql': _applica(cursor, v, d, passi, True, pianificate)}
+                    for v, d, passi in mancanti]
+
+        cursor.execute('SELECT GET_LOCK(%s, 300) AS preso', (LOCK_MIGRAZIONI,))
+        if not cursor.fetchone()['preso']:
+            raise RuntimeError('Impossibile ottenere il lock delle migrazioni')
+        try:
+            _crea_schema_version(cursor)
+            # Un altro processo puo averle applicate mentre si attendeva il lock
+            applicate = []
+            for v, d, passi in _da_applicare(_applicate(cursor)):
+                applicate.append({'versione': v, 'descrizione': d, 'sql': _applica(cursor, v, d, passi, False, {})})
+                conn.commit()
+            return applicate
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (LOCK_MIGRAZIONI,))
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def versione_corrente():
+    """Ultima versione applicata (0 se nessuna)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        return max(_applicate(cursor), default=0)
+    finally:
+        cursor.close()
+        conn.close()
@@ -1,10 +1,26 @@
+import re
+import unicodedata
 from werkzeug.security import generate_password_hash, check_password_hash
 from database import get_db_connection
 
+
+def genera_slug(titolo):
+    """Genera uno slug URL-friendly dal titolo."""
+    # Normalizza unicode e converti in ASCII
+    slug = unicodedata.normalize('NFKD', titolo).encode('ascii', 'ignore').decode('ascii')
+    # Converti in minuscolo
+    slug = slug.lower()
+    # Sostituisci spazi e caratteri non alfanumerici con trattini
+    slug = re.sub(r'[^a-z0-9]+', '-', slug)
+    # Rimuovi trattini iniziali e finali
+    slug = slug.strip('-')
+    return slug
+
+
 class Utente:
     def __init__(self, id=None, username=None, password_hash=None, nome=None,
                  cognome=None, email=None, is_admin=False, attivo=True,
-                 data_creazione=None, ultimo_accesso=None, artista_id=None):
+                 data_creazione=None, ultimo_accesso=None, artista_id=None, quota_nas=None):
         self.id = id
         self.username = username
         self.password_hash = password_hash
@@ -16,6 +32,7 @@ class Utente:
         self.data_creazione = data_creazione
         self.ultimo_accesso = ultimo_accesso
         self.artista_id = artista_id
+        self.quota_nas = quota_nas
 
     @property
     def is_authenticated(self):
@@ -117,15 +134,16 @@ class Utente:
         if self.id:
             cursor.execute('''
                 UPDATE utenti SET username=%s, password_hash=%s, nome=%s, cognome=%s,
-                email=%s, is_admin=%s, attivo=%s, ultimo_accesso=%s, artista_id=%s WHERE id=%s
+                email=%s, is_admin=%s, attivo=%s, ultimo_accesso=%s, artista_id=%s, quota_nas=%s WHERE id=%s
             ''', (self.username, self.password_hash, self.nome, self.cognome,
-                  self.email, self.is_admin, self.attivo, self.ultimo_accesso, self.artista_id, self.id))
+                  self.email, self.is_admin, self.attivo, self.ultimo_accesso, self.artista_id,
+                  self.quota_nas, self.id))
         else:
             cursor.execute('''
-                INSERT INTO utenti (username, password_hash, nome, cognome, email, is_admin, attivo, artista_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO utenti (username, password_hash, nome, cognome, email, is_admin, attivo, artista_id, quota_nas)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             ''', (self.username, self.password_hash, self.nome, self.cognome,
-                  self.email, self.is_admin, self.attivo, self.artista_id))
+                  self.email, self.is_admin, self.attivo, self.artista_id, self.quota_nas))
             self.id = cursor.lastrowid
         conn.commit()
         cursor.close()
@@ -0,0 +1,142 @@
+"""
+Checksum SHA-256 dei file caricati sul NAS.
+
+Lo SHA-256 e calcolato mentre il file viene ricevuto e inviato al NAS (mai con
+una seconda lettura) e registrato in nas_checksum insieme a dimensione e mtime
+del file remoto. Al download il contenuto letto viene confrontato con il
+checksum registrato finche dimensione e mtime non cambiano: un file modificato
+fuori dall'applicazione non e un errore di integrita, e il suo checksum viene
+semplicemente ricalcolato.
+"""
+import logging
+from database import get_db_connection
+import nas_indice
+import nas_storage
+
+logger = logging.getLogger(__name__)
+
+
+def get(username, percorso):
+    """Checksum registrato per un file: dict (sha256, dimensione, mtime) o None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT sha256, dimensione, mtime FROM nas_checksum WHERE username = %s AND percorso = %s',
+        (username, percorso)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return row
+
+
+def firma_blocchi(username, percorso):
+    """Firma a blocchi registrata per un file: dict (blocchi, dimensione, mtime) o None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT blocchi, dimensione, mtime FROM nas_checksum '
+        'WHERE username = %s AND percorso = %s AND blocchi IS NOT NULL',
+        (username, percorso)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return row
+
+
+def registra(username, percorso, dimensione, mtime, sha256, blocchi=None):
+    """Registra (o sostituisce) il checksum e la firma a blocchi di un file."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO nas_checksum (username, percorso, sha256, dimensione, mtime, blocchi)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE sha256 = VALUES(sha256), dimensione = VALUES(dimensione),
+            mtime = VALUES(mtime), blocchi = VALUES(blocchi), data_calcolo = CURRENT_TIMESTAMP
+    ''', (username, percorso, sha256, dimensione, mtime, blocchi))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def verificatore(username, percorso):
+    """Callback checksum per nas_storage.download_file.
+
+    Se il file ha ancora dimensione e mtime registrati il contenuto letto deve
+    avere lo stesso SHA-256, altrimenti il checksum viene (ri)registrato.
+    Gli errori del database non bloccano il download.
+    """
+    def verifica(dimensione, mtime, sha256, blocchi):
+        try:
+            registrato = get(username, percorso)
+            if registrato and registrato['dimensione'] == dimensione and registrato['mtime'] == mtime:
+                if registrato['sha256'] != sha256:
+                    logger.error(f"Checksum non corrispondente per {username}/{percorso}: "
+                                 f"registrato {registrato['sha256']}, letto {sha256}")
+                    raise nas_storage.IntegritaNonVerificata(percorso)
+                return
+            registra(username, percorso, dimensione, mtime, sha256, blocchi)
+        except nas_storage.IntegritaNonVerificata:
+            raise
+        except Exception as e:
+            logger.error(f"Errore checksum {username}/{percorso}: {type(e).__name__}: {e}")
+
+    return verifica
+
+
+def rinomina(username, vecchio, nuovo):
+    """Aggiorna i checksum dopo la rinomina o lo spostamento di un file o di una cartella."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            'UPDATE nas_checksum SET percorso = %s WHERE username = %s AND percorso = %s',
+            (nuovo, username, vecchio)
+        )
+        cursor.execute('''
+            UPDATE nas_checksum SET percorso = CONCAT(%s, SUBSTRING(percorso, %s))
+            WHERE username = %s AND percorso LIKE %s
+        ''', (nuovo, len(vecchio) + 1, username, nas_indice._like_prefisso(vecchio)))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def duplicati(username=None, limite=50):
+    """File con lo stesso contenuto, anche tra utenti diversi.
+
+    Args:
+        username: solo i gruppi che contengono almeno un file di questo utente
+        limite: numero massimo di gruppi, dai piu grandi
+
+    Returns:
+        lista di dict (sha256, dimensione, file: lista di dict username/percorso)
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    filtro = ''
+    params = []
+    if username:
+        filtro = 'WHERE sha256 IN (SELECT sha256 FROM nas_checksum WHERE username = %s)'
+        params.append(username)
+    cursor.execute(f'''
+        SELECT sha256, MAX(dimensione) AS dimensione FROM nas_checksum {filtro}
+        GROUP BY sha256 HAVING COUNT(*) > 1
+        ORDER BY dimensione DESC LIMIT %s
+    ''', params + [limite])
+    gruppi = {row['sha256']: {'sha256': row['sha256'], 'dimensione': row['dimensione'], 'file': []}
+              for row in cursor.fetchall()}
+    if gruppi:
+        placeholders = ', '.join(['%s'] * len(gruppi))
+        cursor.execute(
+            f'SELECT sha256, username, percorso FROM nas_checksum WHERE sha256 IN ({placeholders}) '
+            f'ORDER BY username, percorso',
+            list(gruppi)
+        )
+        for row in cursor.fetchall():
+            gruppi[row['sha256']]['file'].append({'username': row['username'], 'percorso': row['percorso']})
+    cursor.close()
+    conn.close()
+    return list(gruppi.values())
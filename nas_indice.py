@@ -0,0 +1,560 @@
+"""
+Indice dei metadati dei file sul NAS.
+
+Un crawler in background percorre periodicamente la cartella di ogni utente
+e mantiene la tabella nas_indice (percorso, dimensione, mtime, cartelle con
+dimensione aggregata). Ad ogni passata vengono rilette dal NAS solo le
+cartelle il cui mtime e cambiato e scritte solo le righe il cui mtime o
+dimensione e cambiato, quindi il file manager puo mostrare dimensioni
+delle cartelle e cercare nell'intero albero di un utente senza interrogare il
+NAS; il totale di ogni utente riallinea il contatore delle quote (nas_quote).
+
+Upload, rinomina, spostamenti, copie, nuove cartelle ed eliminazioni
+definitive aggiornano subito l'indice (registra_file, rinomina, copia,
+registra_cartella, rimuovi): il crawler corregge eventuali differenze alla
+passata successiva.
+"""
+import itertools
+import logging
+import stat
+import threading
+import time
+from config import Config
+from database import get_db_connection
+import nas_storage
+import nas_quote
+
+logger = logging.getLogger(__name__)
+
+# Righe scritte/eliminate per singola query
+BATCH_SIZE = 500
+
+# Risultati massimi restituiti da una ricerca
+LIMITE_RICERCA = 200
+
+_crawler = None
+_crawler_lock = threading.Lock()
+
+
+def _estensione(nome, is_dir=False):
+    if is_dir or '.' not in nome:
+        return ''
+    return nome.rsplit('.', 1)[1].lower()[:20]
+
+
+def _parent(percorso):
+    return percorso.rsplit('/', 1)[0] if '/' in percorso else ''
+
+
+def _antenati(percorso):
+    """Percorsi delle cartelle che contengono percorso, radice ('') compresa."""
+    antenati = ['']
+    parti = percorso.split('/')[:-1]
+    for i in range(len(parti)):
+        antenati.append('/'.join(parti[:i + 1]))
+    return antenati
+
+
+def _escape_like(testo):
+    return testo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _like_prefisso(percorso):
+    """Pattern LIKE per i discendenti di percorso."""
+    return _escape_like(percorso) + '/%'
+
+
+def _righe_per_parent(cursor, username, parents):
+    """Righe indicizzate figlie dirette delle cartelle indicate: {percorso: riga}."""
+    righe = {}
+    parents = list(parents)
+    for i in range(0, len(parents), BATCH_SIZE):
+        batch = parents[i:i + BATCH_SIZE]
+        placeholders = ', '.join(['%s'] * len(batch))
+        cursor.execute(f'''
+            SELECT id, percorso, parent, is_dir, dimensione, mtime FROM nas_indice
+            WHERE username = %s AND parent IN ({placeholders}) AND percorso <> ''
+        ''', [username] + batch)
+        righe.update((row['percorso'], row) for row in cursor.fetchall())
+    return righe
+
+
+class _Scansione:
+    """Visita dell'albero di un utente che rilegge solo le cartelle cambiate.
+
+    Il mtime di una cartella cambia quando vengono aggiunti, rimossi o rinominati
+    i suoi elementi diretti: se coincide con quello indicizzato la cartella non
+    viene elencata, i suoi file restano quelli dell'indice e per le sottocartelle
+    basta uno stat per controllare a loro volta il mtime.
+    """
+
+    def __init__(self, sftp, cartelle, somme_file, completa):
+        self.sftp = sftp
+        self.cartelle = cartelle          # percorso -> riga indicizzata (solo cartelle)
+        self.somme_file = somme_file      # parent -> somma delle dimensioni dei file indicizzati
+        self.completa = completa
+        self.sottocartelle = {}           # parent -> nomi delle sottocartelle indicizzate
+        for percorso in cartelle:
+            if percorso:
+                self.sottocartelle.setdefault(_parent(percorso), []).append(percorso.rsplit('/', 1)[-1])
+        self.visitate = {}                # cartella -> (dimensione, mtime)
+        self.elencate = {}                # cartella elencata -> {percorso: (parent, nome, is_dir, dimensione, mtime)}
+
+    def visita(self, remote_dir, rel_dir, mtime):
+        """Visita una cartella e restituisce la dimensione totale del suo contenuto."""
+        indicizzata = self.cartelle.get(rel_dir)
+        if not self.completa and indicizzata and indicizzata['mtime'] == mtime:
+            totale = self._riusa(remote_dir, rel_dir)
+            if totale is not None:
+                self.visitate[rel_dir] = (totale, mtime)
+                return totale
+        totale = 0
+        elementi = self.elencate[rel_dir] = {}
+        for entry in self.sftp.listdir_attr(remote_dir):
+            name = entry.filename
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            is_dir = stat.S_ISDIR(entry.st_mode)
+            entry_mtime = int(entry.st_mtime or 0)
+            if is_dir:
+                size = self.visita(f"{remote_dir}/{name}", rel_path, entry_mtime)
+            else:
+                size = entry.st_size or 0
+            elementi[rel_path] = (rel_dir, name, is_dir, size, entry_mtime)
+            totale += size
+        self.visitate[rel_dir] = (totale, mtime)
+        return totale
+
+    def _riusa(self, remote_dir, rel_dir):
+        """Totale di una cartella non cambiata; None se una sottocartella indicizzata non esiste piu."""
+        mtimes = {}
+        for nome in self.sottocartelle.get(rel_dir, []):
+            try:
+                mtimes[nome] = int(self.sftp.stat(f"{remote_dir}/{nome}").st_mtime or 0)
+            except FileNotFoundError:
+                # Cartella modificata nello stesso secondo dell'ultima passata: va elencata
+                return None
+        totale = self.somme_file.get(rel_dir, 0)
+        for nome, mtime in mtimes.items():
+            rel_path = f"{rel_dir}/{nome}" if rel_dir else nome
+            totale += self.visita(f"{remote_dir}/{nome}", rel_path, mtime)
+        return totale
+
+
+def aggiorna_indice(username, sftp, completa=False):
+    """Aggiorna l'indice di un utente confrontandolo con il contenuto del NAS.
+
+    Vengono elencate solo le cartelle il cui mtime e cambiato dall'ultima
+    passata (tutte con completa=True): le altre e i loro file sono ripresi
+    dall'indice.
+
+    Returns:
+        spazio totale occupato dall'utente in bytes
+    """
+    base = nas_storage._user_base_path(username)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            'SELECT id, percorso, parent, is_dir, dimensione, mtime FROM nas_indice '
+            'WHERE username = %s AND is_dir = TRUE',
+            (username,)
+        )
+        cartelle = {row['percorso']: row for row in cursor.fetchall()}
+        cursor.execute(
+            'SELECT parent, SUM(dimensione) AS totale FROM nas_indice '
+            'WHERE username = %s AND is_dir = FALSE GROUP BY parent',
+            (username,)
+        )
+        somme_file = {row['parent']: int(row['totale'] or 0) for row in cursor.fetchall()}
+
+        scansione = _Scansione(sftp, cartelle, somme_file, completa)
+        try:
+            root_attr = sftp.stat(base)
+            totale = scansione.visita(base, '', int(root_attr.st_mtime or 0))
+        except FileNotFoundError:
+            totale = 0
+
+        # Confronto: le cartelle visitate (dimensione aggregata, mtime) e gli elementi
+        # delle cartelle elencate con le righe gia indicizzate
+        nuovo = {}
+        for cartella, (dimensione, mtime) in scansione.visitate.items():
+            nome = cartella.rsplit('/', 1)[-1] if cartella else ''
+            nuovo[cartella] = (_parent(cartella) if cartella else '', nome, True, dimensione, mtime)
+        for elementi in scansione.elencate.values():
+            for percorso, elemento in elementi.items():
+                nuovo.setdefault(percorso, elemento)
+        esistenti = _righe_per_parent(cursor, username, scansione.elencate)
+        for percorso in scansione.visitate:
+            if percorso in cartelle:
+                esistenti[percorso] = cartelle[percorso]
+
+        da_scrivere = []
+        for percorso, (parent, nome, is_dir, dimensione, mtime) in nuovo.items():
+            row = esistenti.get(percorso)
+            if row and bool(row['is_dir']) == is_dir and row['dimensione'] == dimensione and row['mtime'] == mtime:
+                continue
+            da_scrivere.append((username, percorso, parent, nome, _estensione(nome, is_dir),
+                                is_dir, dimensione, mtime))
+        # Elementi spariti dalle cartelle elencate (le cartelle con tutto il contenuto)
+        spariti = [row for percorso, row in esistenti.items()
+                   if row['parent'] in scansione.elencate and percorso not in nuovo]
+        if '' not in scansione.visitate and '' in cartelle:
+            spariti = [cartelle['']]  # cartella dell'utente eliminata
+
+        for i in range(0, len(da_scrivere), BATCH_SIZE):
+            cursor.executemany('''
+                INSERT INTO nas_indice (username, percorso, parent, nome, estensione, is_dir, dimensione, mtime)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE parent=VALUES(parent), nome=VALUES(nome), estensione=VALUES(estensione),
+                    is_dir=VALUES(is_dir), dimensione=VALUES(dimensione), mtime=VALUES(mtime)
+            ''', da_scrivere[i:i + BATCH_SIZE])
+        da_eliminare = [row['id'] for row in spariti]
+        for i in range(0, len(da_eliminare), BATCH_SIZE):
+            batch = da_eliminare[i:i + BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(f'DELETE FROM nas_indice WHERE id IN ({placeholders})', batch)
+        cartelle_sparite = [row['percorso'] for row in spariti if row['is_dir']]
+        for i in range(0, len(cartelle_sparite), 100):
+            batch = cartelle_sparite[i:i + 100]
+            if '' in batch:
+                cursor.execute('DELETE FROM nas_indice WHERE username = %s', (username,))
+                break
+            condizioni = ' OR '.join(['percorso LIKE %s'] * len(batch))
+            cursor.execute(f'DELETE FROM nas_indice WHERE username = %s AND ({condizioni})',
+                           [username] + [_like_prefisso(p) for p in batch])
+        conn.commit()
+        if da_scrivere or da_eliminare:
+            logger.info(f"Indice NAS {username}: {len(da_scrivere)} aggiornati, {len(da_eliminare)} rimossi, "
+                        f"{len(scansione.elencate)}/{len(scansione.visitate)} cartelle rilette")
+    finally:
+        cursor.close()
+        conn.close()
+    return totale
+
+
+def _utenti_da_indicizzare():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT username FROM utenti WHERE attivo = TRUE ORDER BY id')
+    usernames = [row['username'] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return usernames + ['__condivisi__']
+
+
+def aggiorna_tutti(completa=False):
+    """Aggiorna l'indice di tutti gli utenti attivi usando una sola connessione SFTP."""
+    usernames = _utenti_da_indicizzare()
+    ssh, sftp = nas_storage._get_sftp()
+    try:
+        for username in usernames:
+            try:
+                totale = aggiorna_indice(username, sftp, completa)
+                # Riallinea il contatore delle quote al valore esatto
+                nas_quote.imposta_utilizzo(username, totale)
+            except Exception as e:
+                logger.error(f"Errore indicizzazione NAS per {username}: {type(e).__name__}: {e}")
+    finally:
+        sftp.close()
+        ssh.close()
+
+
+def _loop_crawler():
+    # La prima passata del processo e ogni NAS_INDICE_COMPLETA_OGNI rileggono tutte le
+    # cartelle: recuperano i file riscritti sul posto, che non cambiano il mtime della cartella
+    for passata in itertools.count():
+        try:
+            aggiorna_tutti(completa=passata % Config.NAS_INDICE_COMPLETA_OGNI == 0)
+        except Exception as e:
+            logger.error(f"Errore crawler indice NAS: {type(e).__name__}: {e}")
+        time.sleep(Config.NAS_INDICE_INTERVALLO)
+
+
+def avvia_crawler():
+    """Avvia il crawler in background (una sola volta per processo)."""
+    global _crawler
+    if Config.NAS_INDICE_INTERVALLO <= 0:
+        return
+    with _crawler_lock:
+        if _crawler is None or not _crawler.is_alive():
+            _crawler = threading.Thread(target=_loop_crawler, name='nas-indice', daemon=True)
+            _crawler.start()
+
+
+def metadati(username, percorso):
+    """Dimensione e mtime di un file secondo l'indice.
+
+    Returns:
+        tupla (dimensione, mtime) o None se il file non e indicizzato
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT dimensione, mtime FROM nas_indice WHERE username = %s AND percorso = %s AND is_dir = FALSE',
+        (username, percorso)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return (row['dimensione'], row['mtime']) if row else None
+
+
+def cartelle(username):
+    """Percorsi di tutte le cartelle di un utente, dall'indice (radice esclusa)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT percorso FROM nas_indice WHERE username = %s AND is_dir = TRUE AND percorso <> '' ORDER BY percorso",
+        (username,)
+    )
+    result = [row['percorso'] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return result
+
+
+def dimensioni_cartelle(username, subpath=''):
+    """Dimensioni aggregate delle sottocartelle di una cartella, dall'indice.
+
+    Returns:
+        dict {nome cartella: dimensione in bytes}
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT nome, dimensione FROM nas_indice
+        WHERE username = %s AND parent = %s AND is_dir = TRUE AND percorso <> ''
+    ''', (username, nas_storage._safe_subpath(subpath)))
+    result = {row['nome']: row['dimensione'] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return result
+
+
+def _aggiorna_antenati(cursor, username, percorso, variazione):
+    antenati = _antenati(percorso)
+    placeholders = ', '.join(['%s'] * len(antenati))
+    cursor.execute(f'''
+        UPDATE nas_indice SET dimensione = GREATEST(CAST(dimensione AS SIGNED) + %s, 0)
+        WHERE username = %s AND percorso IN ({placeholders})
+    ''', [variazione, username] + antenati)
+
+
+def registra_file(username, percorso, variazione):
+    """Registra nell'indice un file appena caricato.
+
+    Args:
+        variazione: differenza di dimensione rispetto al file sovrascritto
+            (la dimensione intera per un file nuovo), propagata alle cartelle superiori
+    """
+    nome = percorso.rsplit('/', 1)[-1]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT INTO nas_indice (username, percorso, parent, nome, estensione, is_dir, dimensione, mtime)
+            VALUES (%s, %s, %s, %s, %s, FALSE, GREATEST(%s, 0), %s)
+            ON DUPLICATE KEY UPDATE dimensione = GREATEST(CAST(dimensione AS SIGNED) + %s, 0), mtime = VALUES(mtime)
+        ''', (username, percorso, _parent(percorso), nome, _estensione(nome), variazione,
+              int(time.time()), variazione))
+        if variazione:
+            _aggiorna_antenati(cursor, username, percorso, variazione)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def registra_cartella(username, percorso):
+    """Registra nell'indice una cartella appena creata."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT IGNORE INTO nas_indice (username, percorso, parent, nome, is_dir, dimensione, mtime)
+            VALUES (%s, %s, %s, %s, TRUE, 0, %s)
+        ''', (username, percorso, _parent(percorso), percorso.rsplit('/', 1)[-1], int(time.time())))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rinomina(username, vecchio, nuovo):
+    """Aggiorna l'indice dopo la rinomina o lo spostamento di un file o di una cartella
+    (con tutto il contenuto)."""
+    nome = nuovo.rsplit('/', 1)[-1]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        if _parent(vecchio) != _parent(nuovo):
+            # Spostamento: la dimensione passa dalle vecchie cartelle superiori alle nuove
+            cursor.execute(
+                'SELECT dimensione FROM nas_indice WHERE username = %s AND percorso = %s',
+                (username, vecchio)
+            )
+            row = cursor.fetchone()
+            if row and row['dimensione']:
+                _aggiorna_antenati(cursor, username, vecchio, -row['dimensione'])
+                _aggiorna_antenati(cursor, username, nuovo, row['dimensione'])
+        cursor.execute('''
+            UPDATE nas_indice
+            SET percorso = %s, parent = %s, nome = %s, estensione = IF(is_dir, '', %s)
+            WHERE username = %s AND percorso = %s
+        ''', (nuovo, _parent(nuovo), nome, _estensione(nome), username, vecchio))
+        # Discendenti: sostituisce il prefisso di percorso e parent
+        cursor.execute('''
+            UPDATE nas_indice
+            SET percorso = CONCAT(%s, SUBSTRING(percorso, %s)),
+                parent = CONCAT(%s, SUBSTRING(parent, %s))
+            WHERE username = %s AND percorso LIKE %s
+        ''', (nuovo, len(vecchio) + 1, nuovo, len(vecchio) + 1, username, _like_prefisso(vecchio)))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def copia(username, vecchio, nuovo, dimensione):
+    """Registra nell'indice la copia di un file o di una cartella (con tutto il contenuto).
+
+    Args:
+        dimensione: bytes effettivamente copiati, propagati alle cartelle superiori
+    """
+    nome = nuovo.rsplit('/', 1)[-1]
+    inizio = len(vecchio) + 1
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT INTO nas_indice (username, percorso, parent, nome, estensione, is_dir, dimensione, mtime)
+            SELECT username,
+                   CONCAT(%s, SUBSTRING(percorso, %s)),
+                   IF(percorso = %s, %s, CONCAT(%s, SUBSTRING(parent, %s))),
+                   IF(percorso = %s, %s, nome),
+                   estensione, is_dir, dimensione, UNIX_TIMESTAMP()
+            FROM nas_indice
+            WHERE username = %s AND (percorso = %s OR percorso LIKE %s)
+            ON DUPLICATE KEY UPDATE dimensione = VALUES(dimensione), mtime = VALUES(mtime)
+        ''', (nuovo, inizio, vecchio, _parent(nuovo), nuovo, inizio, vecchio, nome,
+              username, vecchio, _like_prefisso(vecchio)))
+        if dimensione:
+            _aggiorna_antenati(cursor, username, nuovo, dimensione)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rimuovi(username, percorsi):
+    """Rimuove dall'indice file e cartelle eliminati definitivamente, con il loro contenuto.
+
+    Le dimensioni delle cartelle superiori vengono aggiornate con una sola
+    query per cartella, sommando le variazioni di tutti i percorsi rimossi.
+
+    Returns:
+        dimensione totale registrata degli elementi rimossi
+    """
+    percorsi = list(dict.fromkeys(percorsi))
+    # Un percorso contenuto in un altro della lista e gia compreso nella sua dimensione
+    insieme = set(percorsi)
+    radici = [p for p in percorsi if not any(a in insieme for a in _antenati(p)[1:])]
+    if not radici:
+        return 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        dimensioni = {}
+        for i in range(0, len(radici), BATCH_SIZE):
+            batch = radici[i:i + BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(
+                f'SELECT percorso, dimensione FROM nas_indice WHERE username = %s AND percorso IN ({placeholders})',
+                [username] + batch
+            )
+            dimensioni.update((row['percorso'], row['dimensione']) for row in cursor.fetchall())
+
+        variazioni = {}
+        for percorso, dimensione in dimensioni.items():
+            for antenato in _antenati(percorso):
+                variazioni[antenato] = variazioni.get(antenato, 0) - dimensione
+
+        # Le condizioni LIKE sono per percorso: batch piu piccoli
+        for i in range(0, len(radici), 100):
+            batch = radici[i:i + 100]
+            condizioni = ' OR '.join(['percorso LIKE %s'] * len(batch))
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(
+                f'DELETE FROM nas_indice WHERE username = %s AND (percorso IN ({placeholders}) OR {condizioni})',
+                [username] + batch + [_like_prefisso(p) for p in batch]
+            )
+        cursor.executemany('''
+            UPDATE nas_indice SET dimensione = GREATEST(CAST(dimensione AS SIGNED) + %s, 0)
+            WHERE username = %s AND percorso = %s
+        ''', [(delta, username, antenato) for antenato, delta in variazioni.items() if delta])
+        conn.commit()
+        return -variazioni.get('', 0)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def cerca(username, nome=None, estensione=None, dimensione_min=None, dimensione_max=None,
+          modificato_dal=None, modificato_al=None, escludi_nascosti=False, limite=LIMITE_RICERCA):
+    """Cerca file e cartelle nell'intero albero di un utente, dall'indice.
+
+    I percorsi nel cestino (e con escludi_nascosti quelli nascosti), insieme a
+    tutto il loro contenuto, sono esclusi nella query, prima del LIMIT.
+
+    Args:
+        nome: sottostringa del nome (senza distinzione maiuscole/minuscole)
+        estensione: estensione esatta dei file, senza punto
+        dimensione_min, dimensione_max: intervallo di dimensione in bytes
+        modificato_dal, modificato_al: intervallo di modifica come timestamp Unix
+        escludi_nascosti: esclude anche i file nascosti all'utente
+
+    Returns:
+        lista di dict (percorso, parent, nome, estensione, is_dir, dimensione, mtime)
+        ordinati per percorso
+    """
+    condizioni = ["username = %s", "percorso <> ''"]
+    params = [username]
+    if nome:
+        condizioni.append("nome LIKE %s")
+        params.append(f"%{_escape_like(nome)}%")
+    if estensione:
+        condizioni.append("estensione = %s AND is_dir = FALSE")
+        params.append(estensione.lower().lstrip('.'))
+    if dimensione_min is not None:
+        condizioni.append("dimensione >= %s")
+        params.append(dimensione_min)
+    if dimensione_max is not None:
+        condizioni.append("dimensione <= %s")
+        params.append(dimensione_max)
+    if modificato_dal is not None:
+        condizioni.append("mtime >= %s")
+        params.append(modificato_dal)
+    if modificato_al is not None:
+        condizioni.append("mtime <= %s")
+        params.append(modificato_al)
+    for tabella in ['file_cestino'] + (['file_nascosti'] if escludi_nascosti else []):
+        # Confronto binario: i percorsi sul NAS distinguono maiuscole e minuscole
+        condizioni.append(f'''NOT EXISTS (
+            SELECT 1 FROM {tabella} e WHERE e.username = i.username
+              AND (BINARY i.percorso = e.percorso
+                   OR BINARY LEFT(i.percorso, CHAR_LENGTH(e.percorso) + 1) = CONCAT(e.percorso, '/'))
+        )''')
+    params.append(limite)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT percorso, parent, nome, estensione, is_dir, dimensione, mtime FROM nas_indice i
+        WHERE {' AND '.join(condizioni)}
+        ORDER BY percorso
+        LIMIT %s
+    ''', params)
+    result = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return result
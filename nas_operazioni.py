@@ -0,0 +1,702 @@
+"""
+Coda delle operazioni sul NAS.
+
+Upload, rinomine, spostamenti, copie, nuove cartelle ed eliminazioni
+definitive non vengono eseguiti nella richiesta HTTP: la route registra
+l'operazione nella tabella nas_operazioni e risponde subito, e i worker in
+background la eseguono. La latenza delle richieste non dipende piu da quella
+del NAS.
+
+- la coda e in MySQL: un'operazione viene presa da un solo worker (UPDATE
+  atomico) anche con piu processi dell'applicazione
+- le operazioni di uno stesso utente sono eseguite una alla volta, in ordine
+  di inserimento, perche le successive possono dipendere dalle precedenti
+- ogni worker esegue le operazioni consecutive su una sola connessione SFTP
+  (nas_storage.sessione), chiusa quando la coda si svuota
+- l'avanzamento e tenuto in memoria e scritto sul database da un unico
+  thread di battito, che legge anche le richieste di annullamento
+- un'operazione in corso senza battito da NAS_OPERAZIONI_TIMEOUT secondi
+  (processo terminato) viene segnata come interrotta
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from config import Config
+from database import get_db_connection
+from models import Utente
+import cestino
+import metriche
+import nas_checksum
+import nas_indice
+import nas_quote
+import nas_storage
+
+logger = logging.getLogger(__name__)
+
+TIPI = {
+    'upload': 'Caricamento',
+    'rinomina': 'Rinomina',
+    'sposta': 'Spostamento',
+    'copia': 'Copia',
+    'nuova_cartella': 'Nuova cartella',
+    'elimina_definitivamente': 'Eliminazione definitiva',
+}
+# Operazioni interrompibili anche in corso (le altre solo finche sono in coda)
+ANNULLABILI_IN_CORSO = {'upload', 'copia'}
+# Operazioni con avanzamento in bytes (le altre in elementi)
+AVANZAMENTO_IN_BYTES = {'upload', 'copia'}
+# Minuti per cui un'operazione terminata resta nell'elenco dell'utente
+MINUTI_RECENTI = 10
+# Giorni dopo cui le operazioni terminate vengono eliminate dalla tabella
+GIORNI_CONSERVAZIONE = 30
+# Lock MySQL che serializza la presa delle operazioni tra i worker di tutti i processi
+LOCK_PRESA = 'maqueta_nas_operazioni_presa'
+
+_worker = []
+_worker_lock = threading.Lock()
+_battito = None
+_nuove = threading.Event()
+_id_processo = f"{socket.gethostname()}:{os.getpid()}"
+
+# Operazioni in esecuzione in questo processo: {id: _Esecuzione}
+_in_esecuzione = {}
+_in_esecuzione_lock = threading.Lock()
+metriche.IndicatoreCalcolato('nas_operazioni_in_esecuzione', 'Operazioni NAS in esecuzione in questo processo',
+                             lambda: len(_in_esecuzione))
+_ultima_manutenzione = 0
+
+
+class ErroreOperazione(Exception):
+    """Errore da mostrare all'utente come esito dell'operazione."""
+
+
+class _Esecuzione:
+    """Stato in memoria di un'operazione in corso, letto e scritto dal thread di battito."""
+
+    def __init__(self, riga):
+        self.id = riga['id']
+        self.fatti = riga['fatti']
+        self.totale = riga['totale']
+        self.annullata = False
+
+    def progresso(self, fatti, totale=None):
+        """Callback di avanzamento per nas_storage: interrompe se l'annullamento e stato richiesto."""
+        self.fatti = fatti
+        if totale is not None:
+            self.totale = totale
+        if self.annullata:
+            raise nas_storage.OperazioneAnnullata()
+
+
+# ============ API ============
+
+def accoda(tipo, username, parametri, creato_da=None, totale=0):
+    """Registra un'operazione da eseguire in background.
+
+    Args:
+        username: spazio NAS su cui opera ('' = piu utenti)
+        parametri: dict serializzabile in JSON, specifico del tipo
+
+    Returns:
+        id dell'operazione
+    """
+    if tipo not in TIPI:
+        raise ValueError(f"Tipo di operazione sconosciuto: {tipo}")
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO nas_operazioni (tipo, username, parametri, creato_da, totale) VALUES (%s, %s, %s, %s, %s)',
+        (tipo, username, json.dumps(parametri), creato_da, totale)
+    )
+    conn.commit()
+    operazione_id = cursor.lastrowid
+    cursor.close()
+    conn.close()
+    avvia_worker()
+    _nuove.set()
+    return operazione_id
+
+
+def salva_upload(file_storage):
+    """Salva in locale un file ricevuto, in attesa che un worker lo carichi sul NAS.
+
+    Lo SHA-256 viene calcolato durante la scrittura, per riconoscere i file
+    identici gia presenti sul NAS senza rileggerli.
+
+    Returns:
+        dict da inserire nei parametri dell'operazione di upload
+    """
+    os.makedirs(Config.NAS_OPERAZIONI_FOLDER, exist_ok=True)
+    percorso = os.path.join(Config.NAS_OPERAZIONI_FOLDER, uuid.uuid4().hex)
+    sha256 = hashlib.sha256()
+    dimensione = 0
+    with open(percorso, 'wb') as f:
+        while True:
+            blocco = file_storage.stream.read(1024 * 1024)
+            if not blocco:
+                break
+            sha256.update(blocco)
+            f.write(blocco)
+            dimensione += len(blocco)
+    return {'nome': file_storage.filename, 'locale': percorso, 'dimensione': dimensione,
+            'sha256': sha256.hexdigest()}
+
+
+def get(operazione_id):
+    """Un'operazione (dict pubblico), o None se non esiste."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM nas_operazioni WHERE id = %s', (operazione_id,))
+    riga = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return _pubblica(riga) if riga else None
+
+
+def elenco(creato_da):
+    """Operazioni attive e terminate da meno di MINUTI_RECENTI minuti di un utente, dalla piu recente."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT * FROM nas_operazioni
+        WHERE creato_da = %s
+          AND (data_fine IS NULL OR data_fine > NOW() - INTERVAL {MINUTI_RECENTI} MINUTE)
+        ORDER BY id DESC
+        LIMIT 20
+    ''', (creato_da,))
+    righe = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return [_pubblica(riga) for riga in righe]
+
+
+def annulla(operazione_id):
+    """Annulla un'operazione in coda, o chiede l'interruzione di una in corso se interrompibile.
+
+    Returns:
+        True se l'annullamento e stato applicato o richiesto
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        annullate = cursor.execute('''
+            UPDATE nas_operazioni SET stato = 'annullata', messaggio = 'Annullata', data_fine = NOW()
+            WHERE id = %s AND stato = 'in_coda'
+        ''', (operazione_id,))
+        if annullate:
+            cursor.execute('SELECT tipo, parametri FROM nas_operazioni WHERE id = %s', (operazione_id,))
+            riga = cursor.fetchone()
+            conn.commit()
+            _rimuovi_file_locali(riga['tipo'], json.loads(riga['parametri']))
+            return True
+        placeholders = ', '.join(['%s'] * len(ANNULLABILI_IN_CORSO))
+        richieste = cursor.execute(f'''
+            UPDATE nas_operazioni SET annulla = TRUE
+            WHERE id = %s AND stato = 'in_corso' AND tipo IN ({placeholders})
+        ''', (operazione_id, *ANNULLABILI_IN_CORSO))
+        conn.commit()
+        return bool(richieste)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def firma_modifiche(username):
+    """Valore che cambia ogni volta che termina un'operazione su uno spazio NAS.
+
+    Le operazioni possono essere eseguite da un altro processo: gli elenchi
+    di cartella in cache letti con una firma diversa vanno riletti.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT COUNT(data_fine) AS n, MAX(data_fine) AS ultima FROM nas_operazioni WHERE username = %s',
+        (username,)
+    )
+    riga = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return f"{riga['n']}-{riga['ultima']}"
+
+
+def _descrizione(tipo, parametri):
+    if tipo == 'upload':
+        if len(parametri['file']) == 1:
+            return f'Caricamento di "{parametri["file"][0]["nome"]}"'
+        return f"Caricamento di {len(parametri['file'])} file"
+    if tipo == 'rinomina':
+        return f'Rinomina di "{parametri["vecchio"]}" in "{parametri["nuovo"]}"'
+    if tipo in ('sposta', 'copia'):
+        nome = parametri['sorgente'].rsplit('/', 1)[-1]
+        return f'{TIPI[tipo]} di "{nome}" in "{parametri["destinazione"] or "Home"}"'
+    if tipo == 'nuova_cartella':
+        return f'Creazione della cartella "{parametri["nome"]}"'
+    if tipo == 'elimina_definitivamente':
+        if parametri.get('ids') is None:
+            return f"Svuotamento del cestino di {parametri['username']}"
+        return f"Eliminazione definitiva di {len(parametri['ids'])} elementi"
+    return TIPI.get(tipo, tipo)
+
+
+def _pubblica(riga):
+    """Dati di un'operazione da mostrare all'utente (senza i parametri interni)."""
+    return {
+        'id': riga['id'],
+        'tipo': riga['tipo'],
+        'descrizione': _descrizione(riga['tipo'], json.loads(riga['parametri'])),
+        'stato': riga['stato'],
+        'fatti': riga['fatti'],
+        'totale': riga['totale'],
+        'in_bytes': riga['tipo'] in AVANZAMENTO_IN_BYTES,
+        'percentuale': min(riga['fatti'] * 100 // riga['totale'], 100) if riga['totale'] else None,
+        'messaggio': riga['messaggio'],
+        'annullabile': riga['stato'] == 'in_coda'
+                       or (riga['stato'] == 'in_corso' and riga['tipo'] in ANNULLABILI_IN_CORSO
+                           and not riga['annulla']),
+        'creato_da': riga['creato_da'],
+    }
+
+
+def _rimuovi_file_locali(tipo, parametri):
+    if tipo != 'upload':
+        return
+    for file in parametri['file']:
+        try:
+            os.remove(file['locale'])
+        except OSError:
+            pass
+
+
+# ============ ESECUZIONE ============
+
+def _quota_nas(username):
+    """Quota NAS in bytes di un utente (None = illimitata, come la cartella condivisa)."""
+    if username == '__condivisi__':
+        return None
+    utente = Utente.get_by_username(username)
+    return utente.quota_nas if utente else None
+
+
+def _aggiorna_indice_nas(operazione, *args):
+    """Applica un aggiornamento all'indice NAS senza far fallire l'operazione sul file.
+
+    Un errore lascia l'indice indietro fino alla prossima passata del crawler.
+    """
+    try:
+        return operazione(*args)
+    except Exception as e:
+        logger.error(f"Errore aggiornamento indice NAS ({operazione.__name__}): {type(e).__name__}: {e}")
+        return None
+
+
+def _identico_sul_nas(username, subpath, nome, sha256):
+    """True se il file di destinazione ha gia il contenuto sha256 e non e cambiato da quando e stato registrato."""
+    if not sha256:
+        return False
+    try:
+        registrato = nas_checksum.get(username, nas_storage._build_path(subpath, nas_storage._safe_name(nome)))
+        if not registrato or registrato['sha256'] != sha256:
+            return False
+        return nas_storage.stat_file(username, subpath, nome) == (registrato['dimensione'], registrato['mtime'])
+    except Exception as e:
+        logger.error(f"Errore verifica checksum di {nome} per {username}: {type(e).__name__}: {e}")
+        return False
+
+
+def _upload_delta(username, subpath, file, percorso, disponibile, progresso, checksum):
+    """Prova ad aggiornare un file gia presente sul NAS inviando solo i blocchi modificati.
+
+    Returns:
+        tupla (variazione, bytes inviati), o None se il file va caricato per intero
+    """
+    if file['dimensione'] < Config.NAS_DELTA_MINIMO:
+        return None
+    try:
+        firma = nas_checksum.firma_blocchi(username, percorso)
+    except Exception as e:
+        logger.error(f"Errore lettura firma a blocchi di {percorso} per {username}: {type(e).__name__}: {e}")
+        return None
+    if not firma:
+        return None
+    with open(file['locale'], 'rb') as f:
+        return nas_storage.upload_delta(username, subpath, f, file['nome'], firma['blocchi'],
+                                        firma['dimensione'], firma['mtime'], limite=disponibile,
+                                        progresso=progresso, checksum=checksum)
+
+
+def _sposta_percorsi_file(username, vecchio, nuovo):
+    """Aggiorna in blocco i percorsi nascosti e nel cestino sotto un prefisso spostato o rinominato."""
+    inizio = len(vecchio) + 1
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for tabella in ('file_nascosti', 'file_cestino'):
+            cursor.execute(f'''
+                UPDATE {tabella} SET percorso = CONCAT(%s, SUBSTRING(percorso, %s))
+                WHERE username = %s AND (percorso = %s OR percorso LIKE %s)
+            ''', (nuovo, inizio, username, vecchio, nas_indice._like_prefisso(vecchio)))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _copia_file_nascosti(username, vecchio, nuovo):
+    """Riporta sulla copia di un albero i file nascosti dell'originale."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT IGNORE INTO file_nascosti (username, percorso, nascosto_da)
+            SELECT username, CONCAT(%s, SUBSTRING(percorso, %s)), nascosto_da FROM file_nascosti
+            WHERE username = %s AND (percorso = %s OR percorso LIKE %s)
+        ''', (nuovo, len(vecchio) + 1, username, vecchio, nas_indice._like_prefisso(vecchio)))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _percorsi_cestino(username):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT percorso FROM file_cestino WHERE username = %s', (username,))
+    result = {row['percorso'] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return result
+
+
+def _esegui_upload(username, parametri, esecuzione):
+    subpath = parametri['subpath']
+    quota = _quota_nas(username)
+    caricati = identici = rifiutati = errori = 0
+    aggiornati = risparmiati = 0
+    base = 0
+
+    def _progresso(letti):
+        esecuzione.progresso(base + letti)
+
+    try:
+        for file in parametri['file']:
+            try:
+                percorso = nas_storage._build_path(subpath, nas_storage._safe_name(file['nome']))
+                if _identico_sul_nas(username, subpath, file['nome'], file.get('sha256')):
+                    identici += 1
+                    base += file['dimensione']
+                    esecuzione.progresso(base)
+                    continue
+
+                def _checksum(dimensione, mtime, sha256, blocchi, percorso=percorso):
+                    _aggiorna_indice_nas(nas_checksum.registra, username, percorso,
+                                         dimensione, mtime, sha256, blocchi)
+
+                # Il limite viene applicato durante il trasferimento contando i bytes
+                disponibile = nas_quote.spazio_disponibile(quota, username)
+                delta = _upload_delta(username, subpath, file, percorso, disponibile, _progresso, _checksum)
+                if delta:
+                    variazione, inviati = delta
+                    aggiornati += 1
+                    risparmiati += file['dimensione'] - inviati
+                else:
+                    with open(file['locale'], 'rb') as f:
+                        variazione = nas_storage.upload_file(username, subpath, f, file['nome'],
+                                                             limite=disponibile, progresso=_progresso,
+                                                             checksum=_checksum)
+                if variazione is not None:
+                    nas_quote.registra_variazione(username, variazione)
+                    _aggiorna_indice_nas(nas_indice.registra_file, username, percorso, variazione)
+                    caricati += 1
+                else:
+                    errori += 1
+            except nas_storage.QuotaSuperata:
+                rifiutati += 1
+            base += file['dimensione']
+            esecuzione.progresso(base)
+    finally:
+        _rimuovi_file_locali('upload', parametri)
+
+    esiti = []
+    if caricati:
+        esiti.append(f'{caricati} file caricato/i con successo.')
+    if aggiornati:
+        esiti.append(f'{aggiornati} file aggiornato/i inviando solo le parti modificate '
+                     f'({nas_storage.format_size(risparmiati)} non ritrasferiti).')
+    if identici:
+        esiti.append(f'{identici} file gia presente/i sul NAS con lo stesso contenuto.')
+    if rifiutati:
+        esiti.append(f'{rifiutati} file non caricato/i: quota di {nas_storage.format_size(quota)} superata.')
+    if errori:
+        esiti.append(f'{errori} file non caricato/i per errori.')
+    if not caricati and not identici:
+        raise ErroreOperazione(' '.join(esiti))
+    return ' '.join(esiti)
+
+
+def _esegui_rinomina(username, parametri, esecuzione):
+    subpath, vecchio_nome, nuovo_nome = parametri['subpath'], parametri['vecchio'], parametri['nuovo']
+    if not nas_storage.rename_item(username, subpath, vecchio_nome, nuovo_nome):
+        raise ErroreOperazione('Errore durante la rinomina. Verifica che il nuovo nome non sia già in uso.')
+    vecchio = nas_storage._build_path(subpath, nas_storage._safe_name(vecchio_nome))
+    nuovo = nas_storage._build_path(subpath, nas_storage._safe_name(nuovo_nome))
+    _sposta_percorsi_file(username, vecchio, nuovo)
+    _aggiorna_indice_nas(nas_indice.rinomina, username, vecchio, nuovo)
+    _aggiorna_indice_nas(nas_checksum.rinomina, username, vecchio, nuovo)
+    return f'"{vecchio_nome}" rinominato in "{nuovo_nome}" con successo.'
+
+
+def _esegui_sposta(username, parametri, esecuzione):
+    sorgente, destinazione = parametri['sorgente'], parametri['destinazione']
+    nome = sorgente.rsplit('/', 1)[-1]
+    nuovo = nas_storage.move_item(username, sorgente, destinazione)
+    if not nuovo:
+        raise ErroreOperazione(f'Errore durante lo spostamento. Verifica che la destinazione non contenga gia "{nome}".')
+    _sposta_percorsi_file(username, sorgente, nuovo)
+    _aggiorna_indice_nas(nas_indice.rinomina, username, sorgente, nuovo)
+    _aggiorna_indice_nas(nas_checksum.rinomina, username, sorgente, nuovo)
+    return f'"{nome}" spostato in "{destinazione or "Home"}".'
+
+
+def _esegui_copia(username, parametri, esecuzione):
+    sorgente, destinazione = parametri['sorgente'], parametri['destinazione']
+    nome = sorgente.rsplit('/', 1)[-1]
+    quota = _quota_nas(username)
+    try:
+        nuovo, copiati = nas_storage.copy_tree(
+            username, sorgente, destinazione,
+            limite=nas_quote.spazio_disponibile(quota, username),
+            esclusi=_percorsi_cestino(username),
+            progresso=esecuzione.progresso,
+        )
+    except nas_storage.QuotaSuperata:
+        raise ErroreOperazione(f'Spazio insufficiente per copiare "{nome}": quota di {nas_storage.format_size(quota)} superata.')
+    except nas_storage.OperazioneAnnullata:
+        raise
+    except Exception as e:
+        logger.error(f"ERRORE copia {sorgente} per {username}: {type(e).__name__}: {e}")
+        raise ErroreOperazione(f'Errore durante la copia. Verifica che la destinazione non contenga gia "{nome}".')
+    nas_quote.registra_variazione(username, copiati)
+    _copia_file_nascosti(username, sorgente, nuovo)
+    _aggiorna_indice_nas(nas_indice.copia, username, sorgente, nuovo, copiati)
+    return f'"{nome}" copiato in "{destinazione or "Home"}".'
+
+
+def _esegui_nuova_cartella(username, parametri, esecuzione):
+    subpath, nome = parametri['subpath'], parametri['nome']
+    if not nas_storage.create_folder(username, subpath, nome):
+        raise ErroreOperazione('Errore durante la creazione della cartella.')
+    _aggiorna_indice_nas(nas_indice.registra_cartella, username,
+                         nas_storage._build_path(subpath, nas_storage._safe_name(nome)))
+    return f'Cartella "{nome}" creata con successo.'
+
+
+def _esegui_elimina_definitivamente(username, parametri, esecuzione):
+    eliminati = cestino.elimina_definitivamente(parametri.get('ids'), parametri.get('username'))
+    return f'{eliminati} elemento/i eliminato/i definitivamente.'
+
+
+_ESECUTORI = {
+    'upload': _esegui_upload,
+    'rinomina': _esegui_rinomina,
+    'sposta': _esegui_sposta,
+    'copia': _esegui_copia,
+    'nuova_cartella': _esegui_nuova_cartella,
+    'elimina_definitivamente': _esegui_elimina_definitivamente,
+}
+
+
+def _prendi(worker):
+    """Assegna a worker la prossima operazione in coda e la restituisce (None se nessuna e eseguibile).
+
+    Le operazioni di uno stesso utente sono eseguite una alla volta e in ordine
+    di inserimento (es. crea cartella X e poi carica in X, rinomina A in B e poi
+    sposta B): viene presa solo la prima in coda di un utente senza operazioni
+    in corso.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Le prese sono serializzate (anche tra processi): senza il lock due worker
+        # potrebbero vedere lo stesso utente libero e prendere due sue operazioni
+        cursor.execute('SELECT GET_LOCK(%s, 10) AS preso', (LOCK_PRESA,))
+        if not cursor.fetchone()['preso']:
+            return None
+        try:
+            conn.commit()  # nuova snapshot: le prese degli altri worker sono visibili
+            # LAST_INSERT_ID(id) restituisce l'id della riga presa senza una seconda ricerca
+            presa = cursor.execute('''
+                UPDATE nas_operazioni
+                SET stato = 'in_corso', worker = %s, data_aggiornamento = NOW(), id = LAST_INSERT_ID(id)
+                WHERE stato = 'in_coda'
+                  AND username NOT IN (
+                      SELECT username FROM (
+                          SELECT username FROM nas_operazioni WHERE stato = 'in_corso'
+                      ) AS occupati
+                  )
+                ORDER BY id
+                LIMIT 1
+            ''', (worker,))
+            # Letto subito: la SELECT di RELEASE_LOCK azzera cursor.lastrowid
+            operazione_id = cursor.lastrowid
+            conn.commit()
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (LOCK_PRESA,))
+        if not presa:
+            return None
+        cursor.execute('SELECT * FROM nas_operazioni WHERE id = %s', (operazione_id,))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _termina(operazione_id, stato, messaggio, esecuzione):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE nas_operazioni SET stato = %s, messaggio = %s, fatti = %s, totale = %s, data_fine = NOW()
+        WHERE id = %s
+    ''', (stato, (messaggio or '')[:500], esecuzione.fatti, esecuzione.totale, operazione_id))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def _esegui(riga):
+    esecuzione = _Esecuzione(riga)
+    with _in_esecuzione_lock:
+        _in_esecuzione[riga['id']] = esecuzione
+    parametri = json.loads(riga['parametri'])
+    inizio = time.perf_counter()
+    try:
+        messaggio = _ESECUTORI[riga['tipo']](riga['username'], parametri, esecuzione)
+        stato = 'completata'
+    except nas_storage.OperazioneAnnullata:
+        stato, messaggio = 'annullata', 'Annullata'
+    except ErroreOperazione as e:
+        stato, messaggio = 'errore', str(e)
+    except Exception as e:
+        logger.error(f"Errore operazione NAS {riga['id']} ({riga['tipo']}): {type(e).__name__}: {e}")
+        stato, messaggio = 'errore', 'Errore durante l\'operazione sul NAS.'
+    finally:
+        with _in_esecuzione_lock:
+            _in_esecuzione.pop(riga['id'], None)
+    metriche.NAS_OPERAZIONI.inc(1, riga['tipo'], stato)
+    metriche.NAS_OPERAZIONI_DURATA.osserva(time.perf_counter() - inizio, riga['tipo'])
+    _termina(riga['id'], stato, messaggio, esecuzione)
+    logger.info(f"Operazione NAS {riga['id']} ({riga['tipo']}) {stato}: {messaggio}")
+
+
+def _manutenzione():
+    """Al piu una volta all'ora: cestino scaduto, operazioni vecchie e file locali abbandonati."""
+    global _ultima_manutenzione
+    with _worker_lock:
+        if time.time() - _ultima_manutenzione < 3600:
+            return
+        _ultima_manutenzione = time.time()
+    try:
+        cestino.elimina_scaduti()
+    except Exception as e:
+        logger.error(f"Errore eliminazione file scaduti dal cestino: {type(e).__name__}: {e}")
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        DELETE FROM nas_operazioni
+        WHERE data_fine IS NOT NULL AND data_fine < NOW() - INTERVAL {GIORNI_CONSERVAZIONE} DAY
+    ''')
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    # File ricevuti di operazioni interrotte da un riavvio
+    cartella = Config.NAS_OPERAZIONI_FOLDER
+    if os.path.isdir(cartella):
+        limite = time.time() - GIORNI_CONSERVAZIONE * 86400
+        for nome in os.listdir(cartella):
+            percorso = os.path.join(cartella, nome)
+            try:
+                if os.path.getmtime(percorso) < limite:
+                    os.remove(percorso)
+            except OSError:
+                pass
+
+
+def _loop_worker(worker):
+    while True:
+        try:
+            riga = _prendi(worker)
+            if riga is None:
+                _manutenzione()
+                _nuove.wait(Config.NAS_OPERAZIONI_INTERVALLO)
+                _nuove.clear()
+                continue
+            # Operazioni consecutive riusano la stessa connessione SFTP
+            with nas_storage.sessione():
+                while riga:
+                    _esegui(riga)
+                    riga = _prendi(worker)
+        except Exception as e:
+            logger.error(f"Errore worker operazioni NAS: {type(e).__name__}: {e}")
+            time.sleep(Config.NAS_OPERAZIONI_INTERVALLO)
+
+
+def _loop_battito():
+    """Scrive l'avanzamento delle operazioni in corso, legge gli annullamenti e chiude le operazioni orfane."""
+    while True:
+        time.sleep(Config.NAS_OPERAZIONI_INTERVALLO)
+        try:
+            with _in_esecuzione_lock:
+                esecuzioni = list(_in_esecuzione.values())
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            try:
+                if esecuzioni:
+                    cursor.executemany('''
+                        UPDATE nas_operazioni SET fatti = %s, totale = %s, data_aggiornamento = NOW()
+                        WHERE id = %s AND stato = 'in_corso'
+                    ''', [(e.fatti, e.totale, e.id) for e in esecuzioni])
+                    placeholders = ', '.join(['%s'] * len(esecuzioni))
+                    cursor.execute(
+                        f'SELECT id FROM nas_operazioni WHERE annulla = TRUE AND id IN ({placeholders})',
+                        [e.id for e in esecuzioni]
+                    )
+                    da_annullare = {row['id'] for row in cursor.fetchall()}
+                    for esecuzione in esecuzioni:
+                        if esecuzione.id in da_annullare:
+                            esecuzione.annullata = True
+                cursor.execute(f'''
+                    UPDATE nas_operazioni
+                    SET stato = 'errore', messaggio = 'Operazione interrotta.', data_fine = NOW()
+                    WHERE stato = 'in_corso'
+                      AND data_aggiornamento < NOW() - INTERVAL {Config.NAS_OPERAZIONI_TIMEOUT} SECOND
+                ''')
+                conn.commit()
+            finally:
+                cursor.close()
+                conn.close()
+        except Exception as e:
+            logger.error(f"Errore battito operazioni NAS: {type(e).__name__}: {e}")
+
+
+def avvia_worker():
+    """Avvia (se non gia attivi) i worker della coda e il thread di battito in questo processo."""
+    global _battito
+    if Config.NAS_OPERAZIONI_WORKERS <= 0:
+        return
+    with _worker_lock:
+        if _battito is None or not _battito.is_alive():
+            _battito = threading.Thread(target=_loop_battito, name='nas-operazioni-battito', daemon=True)
+            _battito.start()
+        _worker[:] = [t for t in _worker if t.is_alive()]
+        while len(_worker) < Config.NAS_OPERAZIONI_WORKERS:
+            nome = f"nas-operazioni-{uuid.uuid4().hex[:8]}"
+            thread = threading.Thread(target=_loop_worker, args=(f"{_id_processo}:{nome}",),
+                                      name=nome, daemon=True)
+            thread.start()
+            _worker.append(thread)
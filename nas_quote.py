@@ -0,0 +1,65 @@
+"""
+Quote di spazio NAS per utente.
+
+Lo spazio usato e un contatore in nas_utilizzo aggiornato ad ogni upload ed
+eliminazione definitiva, e riallineato al valore esatto dal crawler
+dell'indice NAS: verificare una quota non richiede mai di percorrere il NAS.
+"""
+from database import get_db_connection
+
+
+def utilizzo(username):
+    """Bytes usati da un utente sul NAS secondo il contatore."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT byte_usati FROM nas_utilizzo WHERE username = %s', (username,))
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return int(row['byte_usati']) if row else 0
+
+
+def utilizzo_tutti():
+    """Bytes usati da ogni utente: dict {username: bytes}."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT username, byte_usati FROM nas_utilizzo')
+    result = {row['username']: int(row['byte_usati']) for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return result
+
+
+def spazio_disponibile(quota, username):
+    """Bytes ancora scrivibili da un utente, o None se non ha una quota."""
+    if quota is None:
+        return None
+    return max(int(quota) - utilizzo(username), 0)
+
+
+def registra_variazione(username, delta):
+    """Aggiunge (o sottrae, se negativo) bytes al contatore di un utente."""
+    if not delta:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO nas_utilizzo (username, byte_usati) VALUES (%s, GREATEST(%s, 0))
+        ON DUPLICATE KEY UPDATE byte_usati = GREATEST(CAST(byte_usati AS SIGNED) + %s, 0)
+    ''', (username, delta, delta))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def imposta_utilizzo(username, byte_usati):
+    """Riallinea il contatore al valore esatto calcolato dal crawler."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO nas_utilizzo (username, byte_usati) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE byte_usati = VALUES(byte_usati)
+    ''', (username, byte_usati))
+    conn.commit()
+    cursor.close()
+    conn.close()
@@ -2,16 +2,74 @@ import paramiko
 import stat
 import os
 import io
+import hashlib
 import logging
+import queue
+import threading
 import traceback
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from config import Config
+import metriche
 
 logger = logging.getLogger(__name__)
 
+# Sessione SFTP persistente del thread corrente, aperta da sessione()
+_sessione_locale = threading.local()
+
+
+class _ConnessioneCondivisa:
+    """Proxy di una connessione della sessione: close() non la chiude."""
+
+    def __init__(self, connessione):
+        self._connessione = connessione
+
+    def __getattr__(self, nome):
+        return getattr(self._connessione, nome)
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def sessione():
+    """Riusa una sola connessione SFTP per tutte le operazioni del thread corrente nel blocco.
+
+    Le funzioni del modulo aprono e chiudono una connessione per chiamata;
+    dentro una sessione ottengono invece quella del thread, aperta alla prima
+    richiesta e riaperta se cade. Usata dai worker della coda operazioni NAS.
+    """
+    _sessione_locale.attiva = True
+    try:
+        yield
+    finally:
+        _sessione_locale.attiva = False
+        connessione = getattr(_sessione_locale, 'connessione', None)
+        _sessione_locale.connessione = None
+        if connessione:
+            connessione[1].close()
+            connessione[0].close()
+
 
 def _get_sftp():
     """Crea e restituisce una connessione SSH + SFTP al NAS."""
+    if getattr(_sessione_locale, 'attiva', False):
+        connessione = getattr(_sessione_locale, 'connessione', None)
+        transport = connessione[0].get_transport() if connessione else None
+        if transport is None or not transport.is_active() or connessione[1].get_channel().closed:
+            if connessione:
+                connessione[0].close()
+            _sessione_locale.connessione = connessione = _connetti()
+        return _ConnessioneCondivisa(connessione[0]), _ConnessioneCondivisa(connessione[1])
+    return _connetti()
+
+
+def _connetti():
+    inizio = time.perf_counter()
     try:
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -25,12 +83,15 @@ def _get_sftp():
         )
         sftp = ssh.open_sftp()
         logger.info("Connessione SFTP stabilita con successo")
+        metriche.NAS_CONNESSIONE_DURATA.osserva(time.perf_counter() - inizio)
         return ssh, sftp
     except PermissionError as e:
+        metriche.NAS_CONNESSIONI_ERRORI.inc()
         logger.error(f"PermissionError durante connessione SFTP: {e}")
         logger.error(f"Traceback completo:\n{traceback.format_exc()}")
         raise
     except Exception as e:
+        metriche.NAS_CONNESSIONI_ERRORI.inc()
         logger.error(f"Errore connessione SFTP ({type(e).__name__}): {e}")
         logger.error(f"Traceback completo:\n{traceback.format_exc()}")
         raise
@@ -74,6 +135,11 @@ def _safe_subpath(subpath):
     return '/'.join(safe_parts)
 
 
+def _safe_name(name):
+    """Nome di file o cartella senza separatori di percorso."""
+    return name.replace('/', '_').replace('\\', '_')
+
+
 def _user_base_path(username):
     """Restituisce il path base per l'utente sul NAS."""
     return f"{Config.NAS_BASE_PATH}/{username}"
@@ -112,16 +178,29 @@ def ensure_shared_folder():
     ensure_user_folder('__condivisi__')
 
 
-def list_files(username, subpath=''):
-    """Lista file e cartelle nella directory dell'utente.
+# Cache in memoria degli elenchi di cartella, per processo: {(username, subpath): voce}.
+# Le operazioni di questo modulo invalidano le cartelle che modificano; le
+# modifiche fatte da altri processi sono visibili al piu dopo NAS_ELENCO_CACHE_SECONDI.
+_elenchi_cache = OrderedDict()
+_elenchi_lock = threading.Lock()
+_elenchi_generazione = 0
+metriche.IndicatoreCalcolato('cache_elenchi_nas_voci', 'Cartelle nella cache degli elenchi NAS',
+                             lambda: len(_elenchi_cache))
 
-    Returns:
-        list of dict: [{name, size, modified, is_dir, extension}, ...]
-    """
+# Criteri di ordinamento degli elenchi (le cartelle restano sempre prima dei file)
+ORDINAMENTI = {
+    'nome': lambda v: v['name'].lower(),
+    'dimensione': lambda v: v['size'],
+    'modifica': lambda v: v['modified'],
+    'tipo': lambda v: v['extension'],
+}
+
+
+def _leggi_cartella(username, subpath):
+    """Legge dal NAS le voci di una cartella, ordinate per nome con le cartelle prima."""
     logger.info(f"list_files chiamata per utente={username}, subpath={subpath}")
     ssh, sftp = _get_sftp()
     try:
-        subpath = _safe_subpath(subpath)
         base = _user_base_path(username)
         full_path = f"{base}/{subpath}" if subpath else base
         logger.info(f"Accesso a path NAS: {full_path}")
@@ -156,9 +235,212 @@ def list_files(username, subpath=''):
         ssh.close()
 
 
-def upload_file(username, subpath, file_obj, filename):
-    """Carica un file nella cartella dell'utente."""
+def _elenco_cartella(username, subpath, firma=None):
+    """Voce di cache di una cartella, riletta dal NAS se assente, scaduta o con un'altra firma."""
+    chiave = (username, subpath)
+    with _elenchi_lock:
+        voce = _elenchi_cache.get(chiave)
+        if voce and voce['firma'] == firma \
+                and time.monotonic() - voce['letto'] < Config.NAS_ELENCO_CACHE_SECONDI:
+            _elenchi_cache.move_to_end(chiave)
+            metriche.CACHE_RICHIESTE.inc(1, 'elenchi_nas', 'hit')
+            return voce
+        generazione = _elenchi_generazione
+    metriche.CACHE_RICHIESTE.inc(1, 'elenchi_nas', 'miss')
+
+    voce = {'letto': time.monotonic(), 'firma': firma, 'voci': _leggi_cartella(username, subpath), 'ordinati': {}}
+    with _elenchi_lock:
+        # Un'invalidazione durante la lettura rende l'elenco potenzialmente vecchio: non va in cache
+        if generazione == _elenchi_generazione:
+            _elenchi_cache[chiave] = voce
+            _elenchi_cache.move_to_end(chiave)
+            while len(_elenchi_cache) > Config.NAS_ELENCO_CACHE_MAX:
+                _elenchi_cache.popitem(last=False)
+    return voce
+
+
+def _invalida_elenchi(username, *percorsi):
+    """Scarta dalla cache la cartella che contiene ogni percorso, il percorso stesso e le sue sottocartelle."""
+    global _elenchi_generazione
+    cartelle = {p.rsplit('/', 1)[0] if '/' in p else '' for p in percorsi}
+    with _elenchi_lock:
+        _elenchi_generazione += 1
+        for chiave in list(_elenchi_cache):
+            utente, subpath = chiave
+            if utente != username:
+                continue
+            if subpath in cartelle or any(subpath == p or subpath.startswith(p + '/') for p in percorsi):
+                del _elenchi_cache[chiave]
+
+
+# Elenchi ordinati e filtrati tenuti per ogni cartella in cache (ordinamenti x insiemi di esclusi)
+ORDINATI_MAX = 16
+
+
+def _ordinati(voce, ordine, decrescente, esclusi=frozenset()):
+    """Voci visibili della cartella nell'ordine richiesto, ordinate e filtrate una sola volta
+    per voce di cache, ordinamento e insieme di nomi esclusi."""
+    chiave = (ordine, decrescente, esclusi)
+    ordinati = voce['ordinati'].get(chiave)
+    if ordinati is None:
+        # L'elenco di partenza e gia per nome: a parita di chiave l'ordine resta alfabetico
+        visibili = [v for v in voce['voci'] if v['name'] not in esclusi]
+        cartelle = [v for v in visibili if v['is_dir']]
+        file = [v for v in visibili if not v['is_dir']]
+        if ordine != 'nome' or decrescente:
+            cartelle.sort(key=ORDINAMENTI[ordine], reverse=decrescente)
+            file.sort(key=ORDINAMENTI[ordine], reverse=decrescente)
+        ordinati = cartelle + file
+        if len(voce['ordinati']) >= ORDINATI_MAX:
+            voce['ordinati'].clear()
+        voce['ordinati'][chiave] = ordinati
+    return ordinati
+
+
+def list_files(username, subpath=''):
+    """Lista file e cartelle nella directory dell'utente.
+
+    Returns:
+        list of dict: [{name, size, modified, is_dir, extension}, ...]
+    """
+    voce = _elenco_cartella(username, _safe_subpath(subpath))
+    return [dict(v) for v in voce['voci']]
+
+
+def list_files_pagina(username, subpath='', ordine='nome', decrescente=False, offset=0, limite=None,
+                      esclusi=None, firma=None):
+    """Una pagina dell'elenco di una cartella, ordinata lato server.
+
+    L'elenco completo e letto dal NAS una volta e tenuto in cache, insieme alle
+    sue versioni ordinate e filtrate: ogni pagina successiva con lo stesso
+    ordinamento e gli stessi esclusi costa una slice, qualunque sia la
+    dimensione della cartella.
+
+    Args:
+        ordine: una delle chiavi di ORDINAMENTI
+        offset: indice della prima voce della pagina
+        limite: voci per pagina (default NAS_ELENCO_PAGINA)
+        esclusi: nomi da non mostrare (file nel cestino o nascosti)
+        firma: versione delle modifiche allo spazio NAS (es. nas_operazioni.firma_modifiche);
+            un elenco in cache letto con una firma diversa viene riletto
+
+    Returns:
+        tupla (voci della pagina, totale delle voci visibili)
+    """
+    if ordine not in ORDINAMENTI:
+        ordine = 'nome'
+    limite = limite or Config.NAS_ELENCO_PAGINA
+    offset = max(offset, 0)
+
+    voci = _ordinati(_elenco_cartella(username, _safe_subpath(subpath), firma), ordine, decrescente,
+                     frozenset(esclusi or ()))
+    # Copie: chi chiama aggiunge campi alle voci della pagina
+    return [dict(v) for v in voci[offset:offset + limite]], len(voci)
+
+
+class QuotaSuperata(Exception):
+    """Il file caricato supera lo spazio disponibile nella quota dell'utente."""
+
+
+class OperazioneAnnullata(Exception):
+    """Sollevata da una callback di avanzamento per interrompere un trasferimento."""
+
+
+class IntegritaNonVerificata(Exception):
+    """Il contenuto letto dal NAS non corrisponde al checksum registrato."""
+
+
+# Bytes del digest di ogni blocco nelle firme a blocchi
+DIGEST_BLOCCO = 16
+
+
+def _digest_blocco(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_BLOCCO).digest()
+
+
+class _FirmaBlocchi:
+    """Firma a blocchi di NAS_DELTA_BLOCCO bytes di uno stream, calcolata incrementalmente.
+
+    La firma e la concatenazione dei digest dei blocchi nell'ordine del file
+    (l'ultimo blocco puo essere piu corto).
+    """
+
+    def __init__(self):
+        self._digest = []
+        self._blocco = hashlib.blake2b(digest_size=DIGEST_BLOCCO)
+        self._nel_blocco = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            parte = view[:Config.NAS_DELTA_BLOCCO - self._nel_blocco]
+            self._blocco.update(parte)
+            self._nel_blocco += len(parte)
+            view = view[len(parte):]
+            if self._nel_blocco == Config.NAS_DELTA_BLOCCO:
+                self._digest.append(self._blocco.digest())
+                self._blocco = hashlib.blake2b(digest_size=DIGEST_BLOCCO)
+                self._nel_blocco = 0
+
+    def digest(self):
+        finale = [self._blocco.digest()] if self._nel_blocco else []
+        return b''.join(self._digest + finale)
+
+
+class _LettoreConLimite:
+    """Wrapper di uno stream che conta i bytes letti, ne calcola SHA-256 e firma a blocchi
+    e interrompe oltre un limite."""
+
+    def __init__(self, file_obj, limite, progresso=None):
+        self._file_obj = file_obj
+        self._limite = limite
+        self._progresso = progresso
+        self.letti = 0
+        self.sha256 = hashlib.sha256()
+        self.blocchi = _FirmaBlocchi()
+
+    def read(self, size=-1):
+        data = self._file_obj.read(size)
+        self.letti += len(data)
+        self.sha256.update(data)
+        self.blocchi.update(data)
+        if self._limite is not None and self.letti > self._limite:
+            raise QuotaSuperata(f"Superati {self._limite} bytes disponibili")
+        if self._progresso:
+            self._progresso(self.letti)
+        return data
+
+
+def _misura_trasferimento(operazione, inizio, trasferiti):
+    """Aggiorna le metriche di un trasferimento completato (durata inclusa la connessione)."""
+    metriche.NAS_TRASFERIMENTO_DURATA.osserva(time.perf_counter() - inizio, operazione)
+    metriche.NAS_TRASFERIMENTO_BYTES.inc(trasferiti, operazione)
+
+
+def upload_file(username, subpath, file_obj, filename, limite=None, progresso=None, checksum=None):
+    """Carica un file nella cartella dell'utente.
+
+    Il file viene scritto su un nome temporaneo e rinominato solo a
+    trasferimento completato: un upload interrotto non tocca il file
+    eventualmente sovrascritto.
+
+    Args:
+        limite: bytes di spazio ancora disponibili per l'utente (None = nessun limite).
+            Lo spazio liberato sovrascrivendo un file esistente viene conteggiato.
+        progresso: callback(bytes trasferiti); puo sollevare OperazioneAnnullata
+        checksum: callback(dimensione, mtime, sha256, blocchi) chiamata a trasferimento completato,
+            con SHA-256 e firma a blocchi calcolati durante l'invio (nessuna seconda lettura)
+
+    Returns:
+        variazione in bytes dello spazio occupato, o None se errore
+
+    Raises:
+        QuotaSuperata: se il file supera lo spazio disponibile (trasferimento interrotto)
+        OperazioneAnnullata: se sollevata da progresso (trasferimento interrotto)
+    """
+    inizio = time.perf_counter()
     ssh, sftp = _get_sftp()
+    tmp_path = None
     try:
         subpath = _safe_subpath(subpath)
         base = _user_base_path(username)
@@ -167,37 +449,220 @@ def upload_file(username, subpath, file_obj, filename):
         _mkdir_recursive(sftp, target_dir)
 
         # Sanitizza il nome del file
-        safe_name = filename.replace('/', '_').replace('\\', '_')
+        safe_name = _safe_name(filename)
         remote_path = f"{target_dir}/{safe_name}"
 
-        sftp.putfo(file_obj, remote_path)
-        return True
-    except Exception:
-        return False
+        try:
+            dimensione_precedente = sftp.stat(remote_path).st_size or 0
+        except FileNotFoundError:
+            dimensione_precedente = 0
+        if limite is not None:
+            limite += dimensione_precedente
+
+        lettore = _LettoreConLimite(file_obj, limite, progresso)
+        tmp_path = f"{target_dir}/.{safe_name}.upload"
+        sftp.putfo(lettore, tmp_path)
+        try:
+            sftp.posix_rename(tmp_path, remote_path)
+        except IOError:
+            # Server senza estensione posix-rename: rename semplice non sovrascrive
+            if dimensione_precedente:
+                sftp.remove(remote_path)
+            sftp.rename(tmp_path, remote_path)
+        tmp_path = None
+        _invalida_elenchi(username, _build_path(subpath, safe_name))
+        if checksum:
+            attr = sftp.stat(remote_path)
+            checksum(attr.st_size or 0, int(attr.st_mtime or 0), lettore.sha256.hexdigest(),
+                     lettore.blocchi.digest())
+        _misura_trasferimento('upload', inizio, lettore.letti)
+        return lettore.letti - dimensione_precedente
+    except (QuotaSuperata, OperazioneAnnullata):
+        raise
+    except Exception as e:
+        logger.error(f"Errore upload {filename} per {username}: {type(e).__name__}: {e}")
+        return None
     finally:
+        if tmp_path:
+            try:
+                sftp.remove(tmp_path)
+            except IOError:
+                pass
         sftp.close()
         ssh.close()
 
 
-def download_file(username, subpath, filename):
+def upload_delta(username, subpath, file_obj, filename, firma, dimensione_attesa, mtime_atteso,
+                 limite=None, progresso=None, checksum=None):
+    """Aggiorna un file gia presente sul NAS inviando solo i blocchi modificati.
+
+    La firma a blocchi del file remoto e quella registrata al precedente
+    trasferimento: SFTP non permette di calcolarla sul server, quindi vale
+    solo finche dimensione e mtime remoti sono quelli attesi. I blocchi sono
+    confrontati alla stessa posizione e quelli diversi sono scritti nel file
+    remoto, che viene poi troncato alla nuova dimensione. La scrittura e in
+    place (SFTP non ha una copia lato server per preparare un temporaneo):
+    se si interrompe il chiamante deve ricaricare il file intero.
+
+    Args:
+        file_obj: file locale, letto due volte (confronto e invio dei blocchi)
+        firma: firma a blocchi registrata del file remoto
+        dimensione_attesa, mtime_atteso: dimensione e mtime remoti a cui si riferisce la firma
+        limite, progresso, checksum: come in upload_file; una volta iniziata la scrittura
+            l'annullamento da progresso viene ignorato per non lasciare il file a meta
+
+    Returns:
+        tupla (variazione in bytes dello spazio occupato, bytes inviati), o None se il file
+        remoto e cambiato o in caso di errore: il file va allora caricato con upload_file
+
+    Raises:
+        QuotaSuperata: se il file supera lo spazio disponibile (nessun blocco scritto)
+        OperazioneAnnullata: se sollevata da progresso prima della scrittura
+    """
+    inizio = time.perf_counter()
+    ssh, sftp = _get_sftp()
+    scrittura_iniziata = False
+    try:
+        subpath = _safe_subpath(subpath)
+        base = _user_base_path(username)
+        target_dir = f"{base}/{subpath}" if subpath else base
+        remote_path = f"{target_dir}/{_safe_name(filename)}"
+
+        attr = sftp.stat(remote_path)
+        dimensione_precedente = attr.st_size or 0
+        if (dimensione_precedente, int(attr.st_mtime or 0)) != (dimensione_attesa, mtime_atteso):
+            return None
+
+        # Confronto in locale: blocchi da inviare, SHA-256 e firma del nuovo contenuto
+        sha256 = hashlib.sha256()
+        nuova_firma = _FirmaBlocchi()
+        modificati = []
+        dimensione = 0
+        indice = 0
+        while True:
+            data = file_obj.read(Config.NAS_DELTA_BLOCCO)
+            if not data:
+                break
+            sha256.update(data)
+            nuova_firma.update(data)
+            offset = indice * Config.NAS_DELTA_BLOCCO
+            lunghezza_remota = min(Config.NAS_DELTA_BLOCCO, max(dimensione_precedente - offset, 0))
+            remoto = firma[indice * DIGEST_BLOCCO:(indice + 1) * DIGEST_BLOCCO]
+            if len(data) != lunghezza_remota or _digest_blocco(data) != remoto:
+                modificati.append(indice)
+            dimensione += len(data)
+            indice += 1
+
+        if limite is not None and dimensione - dimensione_precedente > limite:
+            raise QuotaSuperata(f"Il file richiede {dimensione - dimensione_precedente} bytes, disponibili {limite}")
+        if progresso:
+            progresso(0)
+
+        inviati = 0
+        scrittura_iniziata = True
+        with sftp.open(remote_path, 'r+b') as f:
+            f.set_pipelined(True)
+            for indice in modificati:
+                offset = indice * Config.NAS_DELTA_BLOCCO
+                file_obj.seek(offset)
+                data = file_obj.read(Config.NAS_DELTA_BLOCCO)
+                f.seek(offset)
+                f.write(data)
+                inviati += len(data)
+                if progresso:
+                    try:
+                        progresso(offset + len(data))
+                    except OperazioneAnnullata:
+                        progresso = None
+            if dimensione < dimensione_precedente:
+                f.truncate(dimensione)
+
+        _invalida_elenchi(username, _build_path(subpath, _safe_name(filename)))
+        if checksum:
+            attr = sftp.stat(remote_path)
+            checksum(attr.st_size or 0, int(attr.st_mtime or 0), sha256.hexdigest(), nuova_firma.digest())
+        logger.info(f"Upload delta {filename} per {username}: {len(modificati)} blocchi, "
+                    f"{format_size(inviati)} inviati su {format_size(dimensione)}")
+        _misura_trasferimento('delta', inizio, inviati)
+        return dimensione - dimensione_precedente, inviati
+    except (QuotaSuperata, OperazioneAnnullata):
+        raise
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        stato = 'file remoto da ricaricare' if scrittura_iniziata else 'nessun blocco scritto'
+        logger.error(f"Errore upload delta {filename} per {username} ({stato}): {type(e).__name__}: {e}")
+        return None
+    finally:
+        sftp.close()
+        ssh.close()
+
+
+def download_file(username, subpath, filename, checksum=None):
     """Scarica un file dalla cartella dell'utente.
 
+    Args:
+        checksum: callback(dimensione, mtime, sha256, blocchi) chiamata a lettura completata
+            con SHA-256 e firma a blocchi calcolati durante la lettura; puo sollevare IntegritaNonVerificata
+
     Returns:
         BytesIO object con il contenuto del file, o None se errore
+
+    Raises:
+        IntegritaNonVerificata: se sollevata da checksum
     """
+    inizio = time.perf_counter()
     ssh, sftp = _get_sftp()
     try:
         subpath = _safe_subpath(subpath)
-        safe_name = filename.replace('/', '_').replace('\\', '_')
+        safe_name = _safe_name(filename)
         base = _user_base_path(username)
         target_dir = f"{base}/{subpath}" if subpath else base
         remote_path = f"{target_dir}/{safe_name}"
 
+        attr = sftp.stat(remote_path)
+        size = attr.st_size or 0
         buffer = io.BytesIO()
-        sftp.getfo(remote_path, buffer)
+        sha256 = hashlib.sha256()
+        blocchi = _FirmaBlocchi()
+        with sftp.open(remote_path, 'rb') as f:
+            for blocco in _leggi_a_finestre(f, size):
+                sha256.update(blocco)
+                blocchi.update(blocco)
+                buffer.write(blocco)
+        if buffer.tell() != size:
+            raise IOError(f"Letti {buffer.tell()} bytes su {size}")
+        if checksum:
+            checksum(size, int(attr.st_mtime or 0), sha256.hexdigest(), blocchi.digest())
+        _misura_trasferimento('download', inizio, size)
         buffer.seek(0)
         return buffer
-    except Exception:
+    except IntegritaNonVerificata:
+        raise
+    except Exception as e:
+        logger.error(f"Errore download {filename} per {username}: {type(e).__name__}: {e}")
+        return None
+    finally:
+        sftp.close()
+        ssh.close()
+
+
+def stat_file(username, subpath, filename):
+    """Dimensione e data di modifica di un file nella cartella dell'utente.
+
+    Returns:
+        tupla (dimensione, mtime) o None se il file non esiste
+    """
+    ssh, sftp = _get_sftp()
+    try:
+        subpath = _safe_subpath(subpath)
+        base = _user_base_path(username)
+        target_dir = f"{base}/{subpath}" if subpath else base
+        attr = sftp.stat(f"{target_dir}/{_safe_name(filename)}")
+        if stat.S_ISDIR(attr.st_mode):
+            return None
+        return attr.st_size or 0, int(attr.st_mtime or 0)
+    except FileNotFoundError:
         return None
     finally:
         sftp.close()
@@ -209,14 +674,16 @@ def delete_file(username, subpath, filename):
     ssh, sftp = _get_sftp()
     try:
         subpath = _safe_subpath(subpath)
-        safe_name = filename.replace('/', '_').replace('\\', '_')
+        safe_name = _safe_name(filename)
         base = _user_base_path(username)
         target_dir = f"{base}/{subpath}" if subpath else base
         remote_path = f"{target_dir}/{safe_name}"
 
         sftp.remove(remote_path)
+        _invalida_elenchi(username, _build_path(subpath, safe_name))
         return True
-    except Exception:
+    except Exception as e:
+        logger.error(f"Errore eliminazione {filename} per {username}: {type(e).__name__}: {e}")
         return False
     finally:
         sftp.close()
@@ -228,7 +695,7 @@ def create_folder(username, subpath, folder_name):
     ssh, sftp = _get_sftp()
     try:
         subpath = _safe_subpath(subpath)
-        safe_name = folder_name.replace('/', '_').replace('\\', '_').strip()
+        safe_name = _safe_name(folder_name).strip()
         if not safe_name:
             return False
         base = _user_base_path(username)
@@ -236,8 +703,10 @@ def create_folder(username, subpath, folder_name):
         new_folder = f"{target_dir}/{safe_name}"
 
         _mkdir_recursive(sftp, new_folder)
+        _invalida_elenchi(username, _build_path(subpath, safe_name))
         return True
-    except Exception:
+    except Exception as e:
+        logger.error(f"Errore creazione cartella {folder_name} per {username}: {type(e).__name__}: {e}")
         return False
     finally:
         sftp.close()
@@ -249,8 +718,8 @@ def rename_item(username, subpath, old_name, new_name):
     ssh, sftp = _get_sftp()
     try:
         subpath = _safe_subpath(subpath)
-        safe_old = old_name.replace('/', '_').replace('\\', '_')
-        safe_new = new_name.replace('/', '_').replace('\\', '_').strip()
+        safe_old = _safe_name(old_name)
+        safe_new = _safe_name(new_name).strip()
         if not safe_new or safe_old == safe_new:
             return False
         base = _user_base_path(username)
@@ -266,8 +735,10 @@ def rename_item(username, subpath, old_name, new_name):
             pass
 
         sftp.rename(old_path, new_path)
+        _invalida_elenchi(username, _build_path(subpath, safe_old), _build_path(subpath, safe_new))
         return True
-    except Exception:
+    except Exception as e:
+        logger.error(f"Errore rinomina {old_name} in {new_name} per {username}: {type(e).__name__}: {e}")
         return False
     finally:
         sftp.close()
@@ -279,21 +750,504 @@ def delete_folder(username, subpath, folder_name):
     ssh, sftp = _get_sftp()
     try:
         subpath = _safe_subpath(subpath)
-        safe_name = folder_name.replace('/', '_').replace('\\', '_')
+        safe_name = _safe_name(folder_name)
         base = _user_base_path(username)
         target_dir = f"{base}/{subpath}" if subpath else base
         folder_path = f"{target_dir}/{safe_name}"
 
-        # Verifica che sia vuota
-        contents = sftp.listdir(folder_path)
-        if contents:
-            return False
-
+        # rmdir fallisce da solo se la cartella non e vuota: niente listdir preventivo
         sftp.rmdir(folder_path)
+        _invalida_elenchi(username, _build_path(subpath, safe_name))
         return True
-    except Exception:
+    except Exception as e:
+        logger.error(f"Errore eliminazione cartella {folder_name} per {username}: {type(e).__name__}: {e}")
+        return False
+    finally:
+        sftp.close()
+        ssh.close()
+
+
+def _walk(sftp, remote_dir, rel_prefix=''):
+    """Percorre ricorsivamente una directory remota.
+
+    Yields:
+        (percorso relativo, SFTPAttributes) per ogni file e cartella, cartelle prima del loro contenuto
+    """
+    entries = sorted(sftp.listdir_attr(remote_dir), key=lambda e: e.filename.lower())
+    for entry in entries:
+        rel_path = f"{rel_prefix}/{entry.filename}" if rel_prefix else entry.filename
+        yield rel_path, entry
+        if stat.S_ISDIR(entry.st_mode):
+            yield from _walk(sftp, f"{remote_dir}/{entry.filename}", rel_path)
+
+
+def _is_escluso(percorso, esclusi):
+    """True se il percorso o una delle sue cartelle padre e nell'insieme degli esclusi."""
+    if not esclusi:
         return False
+    parts = percorso.split('/')
+    return any('/'.join(parts[:i]) in esclusi for i in range(1, len(parts) + 1))
+
+
+class _ZipOutput(io.RawIOBase):
+    """Destinazione non seekable per zipfile: accumula i bytes da inviare al client."""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _metti_in_coda(coda, item, annullato):
+    """Inserisce in una coda limitata, rinunciando se il download e stato annullato."""
+    while not annullato.is_set():
+        try:
+            coda.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _leggi_a_finestre(f, size, annullato=None):
+    """Legge un file remoto aperto a finestre di richieste pipelined (readv).
+
+    Ogni finestra richiede NAS_ZIP_FINESTRA blocchi insieme invece di attendere
+    un round trip per blocco; la memoria resta limitata a una finestra.
+
+    Yields:
+        blocchi di bytes in ordine
+    """
+    offset = 0
+    while offset < size and not (annullato is not None and annullato.is_set()):
+        finestra = []
+        while offset < size and len(finestra) < Config.NAS_ZIP_FINESTRA:
+            length = min(Config.NAS_ZIP_CHUNK, size - offset)
+            finestra.append((offset, length))
+            offset += length
+        yield from f.readv(finestra)
+
+
+def _leggi_in_coda(canali, remote_path, size, coda, annullato):
+    """Legge un file remoto a finestre pipelined e mette i blocchi in una coda limitata."""
+    sftp = canali.get()
+    try:
+        with sftp.open(remote_path, 'rb') as f:
+            for data in _leggi_a_finestre(f, size, annullato):
+                if not _metti_in_coda(coda, data, annullato):
+                    return
+        _metti_in_coda(coda, None, annullato)
+    except Exception as e:
+        _metti_in_coda(coda, e, annullato)
+    finally:
+        canali.put(sftp)
+
+
+def zip_folder_stream(username, subpath, folder_name, esclusi=None):
+    """Prepara il download di una cartella come archivio ZIP64 generato al volo.
+
+    La cartella viene percorsa subito (cosi gli errori emergono prima di iniziare
+    la risposta); i file vengono poi letti in parallelo su piu canali SFTP della
+    stessa connessione SSH e scritti in modalita stored, senza file temporanei
+    e con memoria costante.
+
+    Args:
+        esclusi: insieme di percorsi relativi alla cartella utente da escludere
+                 (file nel cestino, file nascosti), incluso il loro contenuto
+
+    Returns:
+        generatore di bytes dell'archivio ZIP
+    """
+    ssh, sftp = _get_sftp()
+    try:
+        subpath = _safe_subpath(subpath)
+        safe_name = _safe_name(folder_name)
+        base = _user_base_path(username)
+        target_dir = f"{base}/{subpath}" if subpath else base
+        folder_path = f"{target_dir}/{safe_name}"
+        folder_rel = f"{subpath}/{safe_name}" if subpath else safe_name
+
+        if _is_escluso(folder_rel, esclusi):
+            raise FileNotFoundError(folder_rel)
+
+        voci = []
+        for rel_path, entry in _walk(sftp, folder_path):
+            if _is_escluso(f"{folder_rel}/{rel_path}", esclusi):
+                continue
+            voci.append((rel_path, entry))
+    except Exception:
+        sftp.close()
+        ssh.close()
+        raise
+
+    return _genera_zip(ssh, sftp, folder_path, safe_name, voci)
+
+
+def _apri_canali(ssh, sftp, n):
+    """Apre fino a n canali SFTP sulla stessa connessione SSH, sftp compreso.
+
+    Returns:
+        (coda dei canali disponibili, lista dei canali aggiuntivi da chiudere)
+    """
+    canali = queue.Queue()
+    canali.put(sftp)
+    extra = []
+    for _ in range(max(n, 1) - 1):
+        try:
+            extra.append(ssh.open_sftp())
+        except Exception:
+            break
+    for canale in extra:
+        canali.put(canale)
+    return canali, extra
+
+
+def _genera_zip(ssh, sftp, folder_path, root_name, voci):
+    """Generatore dell'archivio ZIP per zip_folder_stream."""
+    extra = []
+    annullato = threading.Event()
+    pool = None
+    try:
+        canali, extra = _apri_canali(ssh, sftp, Config.NAS_ZIP_CANALI)
+        n_canali = len(extra) + 1
+        pool = ThreadPoolExecutor(max_workers=n_canali, thread_name_prefix='nas-zip')
+
+        file_voci = [(rel, e) for rel, e in voci if not stat.S_ISDIR(e.st_mode)]
+        code = {}
+
+        def avvia(i):
+            rel, entry = file_voci[i]
+            coda = queue.Queue(maxsize=Config.NAS_ZIP_FINESTRA * 2)
+            code[i] = coda
+            pool.submit(_leggi_in_coda, canali, f"{folder_path}/{rel}", entry.st_size, coda, annullato)
+
+        # Lettura anticipata: al massimo un file per canale in corso
+        prossimo = 0
+        while prossimo < min(n_canali, len(file_voci)):
+            avvia(prossimo)
+            prossimo += 1
+
+        out = _ZipOutput()
+        indice_file = 0
+        with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for rel, entry in voci:
+                # Il formato ZIP non rappresenta date precedenti al 1980
+                date_time = max(datetime.fromtimestamp(entry.st_mtime).timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+                if stat.S_ISDIR(entry.st_mode):
+                    zf.writestr(zipfile.ZipInfo(f"{root_name}/{rel}/", date_time=date_time), b'')
+                    yield out.pop()
+                    continue
+
+                zinfo = zipfile.ZipInfo(f"{root_name}/{rel}", date_time=date_time)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                zinfo.file_size = entry.st_size
+                coda = code.pop(indice_file)
+                with zf.open(zinfo, 'w', force_zip64=True) as dest:
+                    while True:
+                        data = coda.get()
+                        if data is None:
+                            break
+                        if isinstance(data, Exception):
+                            raise data
+                        dest.write(data)
+                        yield out.pop()
+                indice_file += 1
+                if prossimo < len(file_voci):
+                    avvia(prossimo)
+                    prossimo += 1
+                yield out.pop()
+        yield out.pop()
+    except Exception as e:
+        logger.error(f"Errore durante lo ZIP di {folder_path}: {type(e).__name__}: {e}")
+        raise
+    finally:
+        annullato.set()
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for canale in extra:
+            canale.close()
+        sftp.close()
+        ssh.close()
+
+
+def _build_path(cartella, nome):
+    return f"{cartella}/{nome}" if cartella else nome
+
+
+def _percorso_remoto(username, percorso):
+    percorso = _safe_subpath(percorso)
+    base = _user_base_path(username)
+    return f"{base}/{percorso}" if percorso else base
+
+
+def _esegui_su_canali(canali, funzione, elementi, progresso=None, avanzamento=None):
+    """Esegue funzione(canale, elemento) in parallelo, un canale SFTP per worker.
+
+    Args:
+        avanzamento: funzione(elemento) -> quantita da sommare al progresso (default 1)
+    """
+    def _esegui(elemento):
+        canale = canali.get()
+        try:
+            funzione(canale, elemento)
+        finally:
+            canali.put(canale)
+        return elemento
+
+    totale = sum(avanzamento(e) for e in elementi) if avanzamento else len(elementi)
+    fatti = 0
+    with ThreadPoolExecutor(max_workers=canali.qsize(), thread_name_prefix='nas-albero') as pool:
+        try:
+            for elemento in pool.map(_esegui, elementi):
+                fatti += avanzamento(elemento) if avanzamento else 1
+                if progresso:
+                    progresso(fatti, totale)
+        except BaseException:
+            # Al primo errore non avvia le operazioni ancora in coda
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def _elimina_albero(sftp, canali, remote_path, progresso=None):
+    """Elimina un albero remoto: file in parallelo, poi cartelle dal basso verso l'alto."""
+    voci = list(_walk(sftp, remote_path))
+    files = [rel for rel, entry in voci if not stat.S_ISDIR(entry.st_mode)]
+    cartelle = [rel for rel, entry in voci if stat.S_ISDIR(entry.st_mode)]
+    totale = len(voci) + 1
+
+    def _progresso_file(fatti, _totale):
+        if progresso:
+            progresso(fatti, totale)
+
+    _esegui_su_canali(canali, lambda canale, rel: canale.remove(f"{remote_path}/{rel}"),
+                      files, _progresso_file)
+    fatti = len(files)
+    # _walk restituisce le cartelle prima del loro contenuto: al contrario, figlie prima dei padri
+    for rel in reversed(cartelle):
+        sftp.rmdir(f"{remote_path}/{rel}")
+        fatti += 1
+        if progresso:
+            progresso(fatti, totale)
+    sftp.rmdir(remote_path)
+    if progresso:
+        progresso(totale, totale)
+    return totale
+
+
+def delete_trees(username, percorsi, progresso=None):
+    """Elimina definitivamente piu file e cartelle, con tutto il contenuto.
+
+    Tutte le eliminazioni usano un'unica connessione SSH: stat e rimozione dei
+    file avvengono in parallelo su piu canali SFTP, le cartelle vengono
+    percorse una sola volta ed eliminate dal basso verso l'alto. Un errore su
+    un percorso non interrompe gli altri.
+
+    Args:
+        percorsi: percorsi relativi alla cartella utente
+        progresso: callback(percorsi elaborati, totale)
+
+    Returns:
+        lista dei percorsi eliminati (compresi quelli gia inesistenti)
+    """
+    percorsi = [p for p in dict.fromkeys(_safe_subpath(p) for p in percorsi) if p]
+    if not percorsi:
+        return []
+    totale = len(percorsi)
+    tipi = {}
+    errori = set()
+
+    def _stat(canale, percorso):
+        try:
+            tipi[percorso] = stat.S_ISDIR(canale.stat(_percorso_remoto(username, percorso)).st_mode)
+        except FileNotFoundError:
+            tipi[percorso] = None
+        except Exception as e:
+            logger.error(f"Errore eliminazione {username}/{percorso}: {type(e).__name__}: {e}")
+            errori.add(percorso)
+
+    def _rimuovi(canale, percorso):
+        try:
+            canale.remove(_percorso_remoto(username, percorso))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Errore eliminazione {username}/{percorso}: {type(e).__name__}: {e}")
+            errori.add(percorso)
+
+    ssh, sftp = _get_sftp()
+    extra = []
+    try:
+        canali, extra = _apri_canali(ssh, sftp, Config.NAS_ALBERO_CANALI)
+        _esegui_su_canali(canali, _stat, percorsi)
+        files = [p for p in percorsi if tipi.get(p) is False]
+        cartelle = [p for p in percorsi if tipi.get(p) is True]
+        fatti = totale - len(files) - len(cartelle)
+
+        def _progresso_file(eseguiti, _totale):
+            if progresso:
+                progresso(fatti + eseguiti, totale)
+
+        _esegui_su_canali(canali, _rimuovi, files, _progresso_file)
+        fatti += len(files)
+        for percorso in cartelle:
+            try:
+                _elimina_albero(sftp, canali, _percorso_remoto(username, percorso))
+            except FileNotFoundError:
+                pass  # contenuta in una cartella gia eliminata
+            except Exception as e:
+                logger.error(f"Errore eliminazione {username}/{percorso}: {type(e).__name__}: {e}")
+                errori.add(percorso)
+            fatti += 1
+            if progresso:
+                progresso(fatti, totale)
+        return [p for p in percorsi if p not in errori]
+    finally:
+        _invalida_elenchi(username, *percorsi)
+        for canale in extra:
+            canale.close()
+        sftp.close()
+        ssh.close()
+
+
+def _verifica_destinazione(sftp, username, sorgente, destinazione):
+    """Controlli comuni a spostamento e copia; restituisce i percorsi remoti."""
+    if not sorgente or not destinazione or destinazione == sorgente \
+            or destinazione.startswith(sorgente + '/'):
+        raise ValueError("Destinazione non valida")
+    remote_src = _percorso_remoto(username, sorgente)
+    remote_dst = _percorso_remoto(username, destinazione)
+    sftp.stat(remote_src)
+    try:
+        sftp.stat(remote_dst)
+        raise FileExistsError(destinazione)
+    except FileNotFoundError:
+        pass
+    return remote_src, remote_dst
+
+
+def move_item(username, sorgente, cartella_destinazione):
+    """Sposta un file o una cartella, con tutto il contenuto, in un'altra cartella.
+
+    Lo spostamento e un solo rename remoto: nessun dato viene copiato anche
+    per alberi di grandi dimensioni.
+
+    Returns:
+        nuovo percorso relativo, o None se errore
+    """
+    ssh, sftp = _get_sftp()
+    try:
+        sorgente = _safe_subpath(sorgente)
+        cartella_destinazione = _safe_subpath(cartella_destinazione)
+        destinazione = _build_path(cartella_destinazione, sorgente.rsplit('/', 1)[-1])
+        remote_src, remote_dst = _verifica_destinazione(sftp, username, sorgente, destinazione)
+        _mkdir_recursive(sftp, remote_dst.rsplit('/', 1)[0])
+        sftp.rename(remote_src, remote_dst)
+        _invalida_elenchi(username, sorgente, destinazione)
+        return destinazione
+    except Exception as e:
+        logger.error(f"Errore spostamento {sorgente} in {cartella_destinazione} per {username}: {type(e).__name__}: {e}")
+        return None
+    finally:
+        sftp.close()
+        ssh.close()
+
+
+def _copia_file(canale, remote_src, remote_dst, size):
+    with canale.open(remote_src, 'rb') as fin, canale.open(remote_dst, 'wb') as fout:
+        # Scritture in pipeline: non si attende la conferma di ogni blocco
+        fout.set_pipelined(True)
+        for blocco in _leggi_a_finestre(fin, size):
+            fout.write(blocco)
+
+
+def copy_tree(username, sorgente, cartella_destinazione, limite=None, esclusi=None, progresso=None):
+    """Copia un file o una cartella, con tutto il contenuto, in un'altra cartella.
+
+    L'albero viene percorso una sola volta; i file vengono copiati in parallelo
+    su piu canali SFTP della stessa connessione, con letture e scritture in
+    pipeline. In caso di errore la copia parziale viene rimossa.
+
+    Args:
+        limite: bytes disponibili nella quota dell'utente (None = nessun limite)
+        esclusi: percorsi relativi alla cartella utente da non copiare (es. cestino)
+        progresso: callback(bytes copiati, bytes totali)
+
+    Returns:
+        tupla (nuovo percorso relativo, bytes copiati)
+
+    Raises:
+        QuotaSuperata: se la copia supera lo spazio disponibile (nulla viene copiato)
+    """
+    ssh, sftp = _get_sftp()
+    extra = []
+    destinazione = None
+    try:
+        sorgente = _safe_subpath(sorgente)
+        cartella_destinazione = _safe_subpath(cartella_destinazione)
+        destinazione = _build_path(cartella_destinazione, sorgente.rsplit('/', 1)[-1])
+        remote_src, remote_dst = _verifica_destinazione(sftp, username, sorgente, destinazione)
+
+        attr = sftp.stat(remote_src)
+        if stat.S_ISDIR(attr.st_mode):
+            voci = [(rel, entry) for rel, entry in _walk(sftp, remote_src)
+                    if not _is_escluso(f"{sorgente}/{rel}", esclusi)]
+        else:
+            voci = [('', attr)]
+        files = [(rel, entry.st_size or 0) for rel, entry in voci if not stat.S_ISDIR(entry.st_mode)]
+        totale = sum(size for rel, size in files)
+        if limite is not None and totale > limite:
+            raise QuotaSuperata(f"La copia richiede {totale} bytes, disponibili {limite}")
+
+        _mkdir_recursive(sftp, remote_dst.rsplit('/', 1)[0])
+        canali, extra = _apri_canali(ssh, sftp, Config.NAS_ALBERO_CANALI)
+        try:
+            if stat.S_ISDIR(attr.st_mode):
+                sftp.mkdir(remote_dst)
+                for rel, entry in voci:
+                    if stat.S_ISDIR(entry.st_mode):
+                        sftp.mkdir(f"{remote_dst}/{rel}")
+
+            def _copia(canale, voce):
+                rel, size = voce
+                suffisso = f"/{rel}" if rel else ''
+                _copia_file(canale, remote_src + suffisso, remote_dst + suffisso, size)
+
+            _esegui_su_canali(canali, _copia, files, progresso, avanzamento=lambda voce: voce[1])
+        except Exception:
+            # Rimuove la copia parziale
+            try:
+                if stat.S_ISDIR(attr.st_mode):
+                    _elimina_albero(sftp, canali, remote_dst)
+                else:
+                    sftp.remove(remote_dst)
+            except Exception as e:
+                logger.warning(f"Copia parziale {remote_dst} non rimossa: {e}")
+            raise
+        return destinazione, totale
     finally:
+        if destinazione:
+            _invalida_elenchi(username, destinazione)
+        for canale in extra:
+            canale.close()
         sftp.close()
         ssh.close()
 
@@ -0,0 +1,215 @@
+"""
+Profiler a campionamento per le richieste lente.
+
+Una richiesta viene profilata se il suo endpoint e in PROFILER_ENDPOINT (con
+probabilita PROFILER_FRAZIONE) oppure se un admin la richiede con l'header
+"X-Profilo: 1" o il parametro "?_profilo=1". Durante la richiesta un thread
+campionatore legge ogni PROFILER_INTERVALLO_MS lo stack del thread che la
+serve (sys._current_frames): il codice dell'applicazione non viene
+strumentato e le richieste non profilate non pagano nulla.
+
+Gli ultimi PROFILER_MAX profili del processo restano in memoria (buffer
+circolare) e si scaricano dall'area admin come stack collassati (formato di
+flamegraph.pl / inferno) o JSON per speedscope.app.
+"""
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+PROFONDITA_MASSIMA = 200  # frame per campione, dalla cima dello stack
+
+_profili = deque(maxlen=Config.PROFILER_MAX)
+_profili_lock = threading.Lock()
+_contatore_id = itertools.count(1)
+
+# Richieste in corso di profilazione: {id del thread: profilo}
+_attivi = {}
+_attivi_lock = threading.Lock()
+_attivi_evento = threading.Event()
+_campionatore = None
+
+
+def _stack(frame):
+    """Frame dalla radice alla cima come tuple (funzione, file, prima riga)."""
+    frame_list = []
+    while frame is not None and len(frame_list) < PROFONDITA_MASSIMA:
+        codice = frame.f_code
+        frame_list.append((codice.co_name, codice.co_filename, codice.co_firstlineno))
+        frame = frame.f_back
+    frame_list.reverse()
+    return tuple(frame_list)
+
+
+def _campiona():
+    """Loop del thread campionatore: attivo solo mentre c'e almeno una richiesta profilata."""
+    while True:
+        _attivi_evento.wait()
+        inizio = time.perf_counter()
+        with _attivi_lock:
+            attivi = list(_attivi.items())
+            if not attivi:
+                _attivi_evento.clear()
+                continue
+        frames = sys._current_frames()
+        for thread_id, profilo in attivi:
+            frame = frames.get(thread_id)
+            if frame is None or len(profilo['campioni']) >= Config.PROFILER_CAMPIONI_MAX:
+                continue
+            stack = _stack(frame)
+            indice = profilo['indici'].get(stack)
+            if indice is None:
+                indice = profilo['indici'][stack] = len(profilo['stack'])
+                profilo['stack'].append(stack)
+            profilo['campioni'].append(indice)
+            profilo['pesi'].append(inizio - profilo['ultimo'])
+            profilo['ultimo'] = inizio
+        del frames, frame
+        time.sleep(max(Config.PROFILER_INTERVALLO_MS / 1000 - (time.perf_counter() - inizio), 0.0005))
+
+
+def _avvia_campionatore():
+    global _campionatore
+    with _attivi_lock:
+        if _campionatore is None:
+            _campionatore = threading.Thread(target=_campiona, daemon=True, name='profiler')
+            _campionatore.start()
+
+
+def inizia():
+    """Inizia a profilare il thread corrente; restituisce il profilo."""
+    _avvia_campionatore()
+    adesso = time.perf_counter()
+    profilo = {
+        'id': next(_contatore_id),
+        'data': datetime.now(),
+        'inizio': adesso,
+        'ultimo': adesso,
+        'stack': [],      # stack distinti
+        'indici': {},     # stack -> indice in 'stack'
+        'campioni': [],   # indice dello stack di ogni campione, in ordine di tempo
+        'pesi': [],       # secondi rappresentati da ogni campione
+    }
+    with _attivi_lock:
+        _attivi[threading.get_ident()] = profilo
+        _attivi_evento.set()
+    return profilo
+
+
+def termina(profilo, **dettagli):
+    """Smette di profilare il thread corrente e salva il profilo nel buffer."""
+    with _attivi_lock:
+        _attivi.pop(threading.get_ident(), None)
+    profilo['durata'] = time.perf_counter() - profilo['inizio']
+    profilo.update(dettagli)
+    with _profili_lock:
+        _profili.append(profilo)
+
+
+def elenco():
+    """Profili nel buffer, dal piu recente."""
+    with _profili_lock:
+        return list(reversed(_profili))
+
+
+def get(profilo_id):
+    with _profili_lock:
+        for profilo in _profili:
+            if profilo['id'] == profilo_id:
+                return profilo
+    return None
+
+
+def _nome_frame(frame):
+    funzione, file, riga = frame
+    return f"{funzione} ({os.path.basename(file)}:{riga})".replace(';', ',')
+
+
+def funzioni_costose(profilo, limite=15):
+    """Funzioni in cima allo stack per numero di campioni (tempo proprio): [(nome, campioni, percentuale)]."""
+    conteggi = Counter(profilo['stack'][i][-1] for i in profilo['campioni'] if profilo['stack'][i])
+    totale = len(profilo['campioni']) or 1
+    return [(_nome_frame(frame), n, n * 100 / totale) for frame, n in conteggi.most_common(limite)]
+
+
+def collassato(profilo):
+    """Stack collassati: una riga "radice;...;cima campioni" per stack distinto."""
+    conteggi = Counter(profilo['campioni'])
+    return ''.join(
+        f"{';'.join(_nome_frame(f) for f in profilo['stack'][indice])} {n}\n"
+        for indice, n in sorted(conteggi.items())
+    )
+
+
+def speedscope(profilo):
+    """Profilo nel formato JSON di speedscope (profilo "sampled", pesi in millisecondi)."""
+    frames = {}
+    for stack in profilo['stack']:
+        for frame in stack:
+            frames.setdefault(frame, len(frames))
+    stack_indici = [[frames[f] for f in stack] for stack in profilo['stack']]
+    # Un campione preso mentre la richiesta terminava puo avere l'indice ma non ancora il peso
+    campioni = min(len(profilo['campioni']), len(profilo['pesi']))
+    nome = f"{profilo['metodo']} {profilo['percorso']}"
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': nome,
+        'exporter': 'maqueta-web',
+        'shared': {'frames': [{'name': funzione, 'file': file, 'line': riga}
+                              for (funzione, file, riga) in frames]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': nome,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': profilo['durata'] * 1000,
+            'samples': [stack_indici[i] for i in profilo['campioni'][:campioni]],
+            'weights': [peso * 1000 for peso in profilo['pesi'][:campioni]],
+        }],
+    }
+
+
+def _da_profilare():
+    if request.endpoint in Config.PROFILER_ENDPOINT and random.random() < Config.PROFILER_FRAZIONE:
+        return True
+    richiesto = request.headers.get('X-Profilo') == '1' or request.args.get('_profilo') == '1'
+    return richiesto and current_user.is_authenticated and current_user.is_admin
+
+
+def init_app(app):
+    """Registra l'avvio e la chiusura della profilazione per le richieste selezionate."""
+    if not Config.PROFILER:
+        return
+
+    @app.before_request
+    def _inizia_profilo():
+        if _da_profilare():
+            g.profilo = inizia()
+
+    @app.after_request
+    def _header_profilo(response):
+        profilo = g.get('profilo')
+        if profilo is not None:
+            response.headers['X-Profilo'] = str(profilo['id'])
+            profilo['stato'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def _termina_profilo(exc):
+        profilo = g.pop('profilo', None)
+        if profilo is None:
+            return
+        termina(profilo, metodo=request.method, percorso=request.full_path.rstrip('?'),
+                endpoint=request.endpoint, stato=profilo.get('stato', 500))
+        logger.info(f"Profilo {profilo['id']} {request.method} {request.path}: "
+                    f"{len(profilo['campioni'])} campioni in {profilo['durata'] * 1000:.0f} ms")
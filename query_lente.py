@@ -0,0 +1,46 @@
+"""
+Consultazione del log delle query lente.
+
+Le query oltre Config.SQL_LENTE_SOGLIA_MS sono registrate dal cursore di
+database.py nella tabella query_lente, una riga per forma della query
+(valori letterali e liste di parametri normalizzati) con numero di
+esecuzioni lente, durata totale e massima e l'ultimo piano EXPLAIN.
+"""
+import json
+from database import get_db_connection
+
+# Ordinamenti dell'elenco: chiave -> espressione SQL (decrescente)
+ORDINAMENTI = {
+    'totale': 'durata_totale_ms',
+    'media': 'durata_totale_ms / esecuzioni',
+    'massima': 'durata_max_ms',
+    'esecuzioni': 'esecuzioni',
+    'recenti': 'data_ultima',
+}
+
+
+def elenco(ordine='totale', limite=100):
+    """Query lente dalla peggiore secondo ordine, con il piano EXPLAIN decodificato."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT *, durata_totale_ms / esecuzioni AS durata_media_ms FROM query_lente
+        ORDER BY {ORDINAMENTI.get(ordine, ORDINAMENTI['totale'])} DESC
+        LIMIT %s
+    ''', (limite,))
+    righe = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    for riga in righe:
+        riga['piano'] = json.loads(riga['piano']) if riga['piano'] else []
+    return righe
+
+
+def azzera():
+    """Svuota il log delle query lente."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM query_lente')
+    conn.commit()
+    cursor.close()
+    conn.close()
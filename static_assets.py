@@ -0,0 +1,100 @@
+"""
+Fingerprint degli asset statici e cache HTTP a lungo termine.
+
+All'avvio viene costruito un manifest {percorso: hash} dei file in static/:
+url_for('static', ...) aggiunge l'hash come parametro ?v=, quindi il lookup
+al momento del render e un semplice accesso a dizionario. Gli URL con
+fingerprint (e gli upload, che hanno gia nomi univoci) vengono serviti con
+Cache-Control immutable.
+"""
+import hashlib
+import logging
+import os
+import threading
+from flask import request, current_app
+
+logger = logging.getLogger(__name__)
+
+CACHE_IMMUTABILE = 'public, max-age=31536000, immutable'
+
+# Cartella (relativa a static/) i cui file hanno nomi univoci e non cambiano mai
+PREFISSO_UPLOADS = 'uploads/'
+
+_manifest = {}
+_manifest_lock = threading.Lock()
+_static_folder = None
+
+
+def _hash_file(path):
+    hasher = hashlib.blake2b(digest_size=6)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def costruisci_manifest(static_folder):
+    """Calcola l'hash di tutti gli asset statici (esclusi gli upload)."""
+    global _static_folder
+    _static_folder = static_folder
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        rel_root = os.path.relpath(root, static_folder).replace(os.sep, '/')
+        if rel_root == '.':
+            rel_root = ''
+        if (rel_root + '/').startswith(PREFISSO_UPLOADS):
+            dirs[:] = []
+            continue
+        for name in files:
+            rel_path = f"{rel_root}/{name}" if rel_root else name
+            try:
+                manifest[rel_path] = _hash_file(os.path.join(root, name))
+            except OSError:
+                continue
+    with _manifest_lock:
+        _manifest.clear()
+        _manifest.update(manifest)
+    logger.info(f"Manifest asset statici: {len(manifest)} file")
+    return manifest
+
+
+def fingerprint(filename):
+    """Restituisce l'hash di un asset statico, o None per upload e file inesistenti.
+
+    I file aggiunti dopo l'avvio vengono calcolati alla prima richiesta e memorizzati.
+    """
+    v = _manifest.get(filename)
+    if v is not None or _static_folder is None or filename.startswith(PREFISSO_UPLOADS):
+        return v
+    path = os.path.join(_static_folder, filename)
+    if not os.path.isfile(path):
+        return None
+    v = _hash_file(path)
+    with _manifest_lock:
+        _manifest[filename] = v
+    return v
+
+
+def init_app(app):
+    """Costruisce il manifest e registra gli hook per fingerprint e cache."""
+    costruisci_manifest(app.static_folder)
+
+    @app.url_defaults
+    def _aggiungi_fingerprint(endpoint, values):
+        if endpoint == 'static' and 'v' not in values:
+            v = fingerprint(values.get('filename', ''))
+            if v:
+                values['v'] = v
+
+    @app.after_request
+    def _cache_statici(response):
+        if request.endpoint != 'static' or response.status_code not in (200, 206, 304):
+            return response
+        # In debug gli asset possono cambiare senza riavvio: niente cache immutabile
+        if current_app.debug:
+            return response
+        filename = (request.view_args or {}).get('filename', '')
+        v = request.args.get('v')
+        if filename.startswith(PREFISSO_UPLOADS) or (v and v == fingerprint(filename)):
+            response.headers['Cache-Control'] = CACHE_IMMUTABILE
+        return response
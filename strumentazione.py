@@ -0,0 +1,83 @@
+"""
+Strumentazione SQL per richiesta.
+
+Le query eseguite durante una richiesta vengono registrate dal cursore di
+database.py (testo, durata, righe e codice chiamante). A fine richiesta:
+
+- l'header Server-Timing riporta tempo e numero delle query SQL e il tempo
+  totale della richiesta (visibili negli strumenti per sviluppatori del browser),
+  solo per gli admin, con l'app in modalita debug o con SQL_SERVER_TIMING_TUTTI
+  (load test);
+- le query con la stessa forma ripetute almeno SQL_N_PIU_1_SOGLIA volte sono
+  segnalate nel log come possibili N+1; oltre SQL_N_PIU_1_LIMITE ripetizioni,
+  se impostato, la richiesta fallisce con QueryRipetute (per i test);
+- con SQL_PANNELLO le pagine HTML viste dagli admin includono in fondo un
+  pannello con l'elenco delle query.
+"""
+import logging
+import time
+from flask import g, request, current_app
+from flask_login import current_user
+from config import Config
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRipetute(Exception):
+    """Una richiesta ha ripetuto la stessa query oltre SQL_N_PIU_1_LIMITE volte."""
+
+
+def _inserisci_pannello(response, registrate, ripetute, durata_sql):
+    html = response.get_data(as_text=True)
+    fine_body = html.rfind('</body>')
+    if fine_body == -1:
+        return
+    pannello = current_app.jinja_env.get_template('pannello_sql.html').render(
+        query=registrate, ripetute=ripetute, durata_sql=durata_sql,
+        forme_ripetute={r['forma'] for r in ripetute}, forma_query=database.forma_query,
+    )
+    response.set_data(html[:fine_body] + pannello + html[fine_body:])
+
+
+def init_app(app):
+    """Registra la registrazione delle query per richiesta (da chiamare dopo compressione.init_app)."""
+    if not Config.SQL_STRUMENTAZIONE:
+        return
+
+    @app.before_request
+    def _inizia_registrazione():
+        g.inizio_richiesta = time.perf_counter()
+        database.inizia_registrazione()
+
+    @app.after_request
+    def _riepiloga_query(response):
+        registrate = database.termina_registrazione()
+        if registrate is None:
+            return response
+        durata_sql = sum(q['durata'] for q in registrate)
+
+        ripetute = database.query_ripetute(registrate, Config.SQL_N_PIU_1_SOGLIA)
+        for r in ripetute:
+            logger.warning(f"Possibile N+1 in {request.method} {request.path}: {r['volte']} query "
+                           f"\"{r['forma'][:200]}\" da {', '.join(r['chiamanti'])}")
+        limite = Config.SQL_N_PIU_1_LIMITE
+        if limite and ripetute and ripetute[0]['volte'] >= limite:
+            raise QueryRipetute(f"{request.path}: {ripetute[0]['volte']} query \"{ripetute[0]['forma'][:200]}\"")
+
+        admin = current_user.is_authenticated and current_user.is_admin
+        # Tempi e numero di query non vanno mostrati ai visitatori: solo admin, modalita debug
+        # o load test (benchmarks/carico.py legge il numero di query di ogni route da qui)
+        if admin or current_app.debug or Config.SQL_SERVER_TIMING_TUTTI:
+            response.headers.add('Server-Timing', f'sql;dur={durata_sql * 1000:.1f};desc="{len(registrate)} query"')
+            response.headers.add('Server-Timing', f'app;dur={(time.perf_counter() - g.inizio_richiesta) * 1000:.1f}')
+
+        if (Config.SQL_PANNELLO and admin and response.mimetype == 'text/html'
+                and not response.direct_passthrough and not response.is_streamed):
+            _inserisci_pannello(response, registrate, ripetute, durata_sql)
+        return response
+
+    @app.teardown_request
+    def _termina_registrazione(exc):
+        # Richieste terminate con un errore prima di after_request
+        database.termina_registrazione()
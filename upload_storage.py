@@ -0,0 +1,197 @@
+"""
+Storage content-addressed per static/uploads.
+
+Ogni file caricato prende il nome dall'hash BLAKE2 del suo contenuto, quindi
+la stessa immagine usata da un album, dal suo singolo e da una news viene
+salvata una sola volta. Un file viene eliminato solo quando nessun record
+lo referenzia piu.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from config import Config
+from database import get_db_connection
+import immagini
+
+logger = logging.getLogger(__name__)
+
+# Colonne che possono contenere il nome di un file in static/uploads
+COLONNE_RIFERIMENTI = [
+    ('artisti', 'foto'),
+    ('artisti', 'foto_copertina'),
+    ('dischi', 'copertina'),
+    ('news', 'immagine'),
+    ('servizi', 'foto'),
+    ('membri_band', 'foto'),
+    ('eventi', 'immagine'),
+]
+
+# Colonne di testo in cui le immagini sono inserite come <img src="/static/uploads/...">
+# (galleria dell'editor delle news)
+COLONNE_TESTO = [
+    ('news', 'contenuto'),
+]
+PREFISSO_URL = '/static/uploads/'
+_RE_URL = re.compile(re.escape(PREFISSO_URL) + r"""([^/"'\s?#<>]+)""")
+
+CHUNK_SIZE = 64 * 1024
+
+# Lock per nome file (a strisce): il riuso di un duplicato in salva e il controllo
+# riferimenti + eliminazione in rilascia non devono intrecciarsi
+_file_lock = [threading.Lock() for _ in range(64)]
+
+
+def _lock(filename):
+    return _file_lock[hash(filename) % len(_file_lock)]
+
+
+def salva(stream, ext):
+    """Salva il contenuto di uno stream in static/uploads con nome content-addressed.
+
+    L'hash viene calcolato mentre il file viene scritto su un file temporaneo,
+    senza una seconda lettura. Se esiste gia un file identico il temporaneo
+    viene scartato.
+
+    Returns:
+        nome del file salvato (es. '3f2a...9c.jpg')
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    tmp_path = os.path.join(Config.UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'wb') as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                tmp.write(chunk)
+
+        filename = f"{hasher.hexdigest()}.{ext}"
+        filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
+        with _lock(filename):
+            if os.path.exists(filepath):
+                # Duplicato: rinnova l'mtime cosi il garbage collector non lo
+                # elimina prima che il record che lo usa venga salvato
+                os.remove(tmp_path)
+                os.utime(filepath)
+            else:
+                os.replace(tmp_path, filepath)
+        return filename
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _like(filename):
+    """Pattern LIKE che trova l'URL del file dentro una colonna di testo."""
+    url = PREFISSO_URL + filename
+    return '%' + url.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def conta_riferimenti(filename):
+    """Conta quanti record referenziano un file caricato, anche come immagine nel testo."""
+    subquery = ' + '.join(
+        [f'(SELECT COUNT(*) FROM {tabella} WHERE {colonna} = %s)' for tabella, colonna in COLONNE_RIFERIMENTI]
+        + [f'(SELECT COUNT(*) FROM {tabella} WHERE {colonna} LIKE %s)' for tabella, colonna in COLONNE_TESTO]
+    )
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {subquery} AS cnt',
+                   (filename,) * len(COLONNE_RIFERIMENTI) + (_like(filename),) * len(COLONNE_TESTO))
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return int(row['cnt'])
+
+
+def file_referenziati():
+    """Restituisce l'insieme dei nomi file referenziati da almeno un record."""
+    union = ' UNION '.join(
+        f'SELECT {colonna} AS filename FROM {tabella} WHERE {colonna} IS NOT NULL'
+        for tabella, colonna in COLONNE_RIFERIMENTI
+    )
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(union)
+    result = {row['filename'] for row in cursor.fetchall()}
+    for tabella, colonna in COLONNE_TESTO:
+        cursor.execute(f'SELECT {colonna} AS testo FROM {tabella} WHERE {colonna} LIKE %s',
+                       ('%' + PREFISSO_URL + '%',))
+        for row in cursor.fetchall():
+            result.update(_RE_URL.findall(row['testo']))
+    cursor.close()
+    conn.close()
+    return result
+
+
+def _elimina(filename):
+    filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    immagini.elimina_varianti(filename)
+
+
+def _in_periodo_di_grazia(filepath):
+    try:
+        return time.time() - os.path.getmtime(filepath) < Config.UPLOAD_GC_GRAZIA
+    except OSError:
+        return False
+
+
+def rilascia(filename):
+    """Elimina un file (e le sue varianti) se nessun record lo referenzia piu.
+
+    I file caricati da poco vengono lasciati al garbage collector: potrebbero
+    appartenere a un record in fase di salvataggio in un'altra richiesta.
+
+    Returns:
+        True se il file e stato eliminato
+    """
+    if not filename or os.path.basename(filename) != filename:
+        return False
+    filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
+    with _lock(filename):
+        if _in_periodo_di_grazia(filepath):
+            return False
+        if conta_riferimenti(filename) > 0:
+            return False
+        # Ricontrollo subito prima di eliminare: un salva di un altro processo puo aver
+        # riusato il file (rinnovandone l'mtime) durante il conteggio
+        if _in_periodo_di_grazia(filepath):
+            return False
+        _elimina(filename)
+    return True
+
+
+def garbage_collect():
+    """Elimina i file in static/uploads non referenziati da nessun record.
+
+    Returns:
+        lista dei file eliminati
+    """
+    if not os.path.isdir(Config.UPLOAD_FOLDER):
+        return []
+    referenziati = file_referenziati()
+    eliminati = []
+    for entry in os.scandir(Config.UPLOAD_FOLDER):
+        if not entry.is_file() or entry.name in referenziati:
+            continue
+        if entry.name.startswith('.upload-'):
+            # Temporaneo rimasto da un upload interrotto
+            if not _in_periodo_di_grazia(entry.path):
+                os.remove(entry.path)
+            continue
+        if '.' not in entry.name or entry.name.rsplit('.', 1)[1].lower() not in Config.ALLOWED_EXTENSIONS:
+            continue
+        with _lock(entry.name):
+            if _in_periodo_di_grazia(entry.path):
+                continue
+            _elimina(entry.name)
+        eliminati.append(entry.name)
+    if eliminati:
+        logger.info(f"Garbage collection uploads: eliminati {len(eliminati)} file non referenziati")
+    return eliminati